@@ -17,53 +17,362 @@ Example
 =======
     $ python rebase_ipynb.py --repo /home/username/repo --first_commit 1234567890 --last_commit 0987654321 --new_branch temp_branch
 
+Reading and writing git objects in-process with dulwich
+    $ python rebase_ipynb.py --repo /home/username/repo --first 1234567890 --last 0987654321 --branch temp_branch --engine plumbing --backend dulwich
+
+Moving images larger than 10k characters to .ipynb_outputs/ and back
+    $ python rebase_ipynb.py --repo /home/username/repo --first 1234567890 --last 0987654321 --branch temp_branch --externalize-threshold 10000
+    $ python rebase_ipynb.py restore --outputs-folder .ipynb_outputs notebook.ipynb
+
+Checking that the worktree and the plumbing engines write the same commits
+    $ python rebase_ipynb.py compare --repo /home/username/repo --first 1234567890 --last 0987654321 --config-a '{"engine": "worktree"}' --config-b '{"engine": "plumbing"}'
+
+Cleaning the notebooks of the working tree in place, e.g. from a pre-commit hook;
+only the notebooks changed since the last run are processed
+    $ python rebase_ipynb.py normalize
+
+Readable `git diff` and `git log -p` of the notebooks, cached by blob sha
+    $ python rebase_ipynb.py install-textconv --repo /home/username/repo
+
+Where the bytes of the notebooks are, by path, cell type, output mime type and colab metadata
+    $ python rebase_ipynb.py analyze --repo /home/username/repo --first 1234567890 --last 0987654321 --output bytes.csv
+
+One commit on top of HEAD cleaning every notebook of the tree, without rewriting the history
+    $ python rebase_ipynb.py snapshot --repo /home/username/repo --branch cleaned
+
+Collapsing the autosave bursts : commits of the same author within 5 minutes become one commit
+    $ python rebase_ipynb.py --repo /home/username/repo --first 1234567890 --last 0987654321 --branch temp_branch --coalesce-window 300 --map sha_map.json
+
+Many repositories sharing one worker pool and one processed blob cache
+    $ python rebase_ipynb.py fleet manifest.jsonl --cache /home/username/ipynb_cache --summary summary.json
+
 """
 
+import abc
 import argparse
+import calendar
+import collections
+import contextlib
+import csv
+import difflib
+import functools
+import hashlib
 import json
 import os
 import pathlib
 import pprint
+import shlex
 import shutil
 import sys
 import tempfile
+import time
 import subprocess
+import urllib.parse
+
+from typing import TYPE_CHECKING, Callable, Dict, Iterator, List, Tuple, Union
 
-from typing import Dict, List, Tuple
+# heavy imports are deferred to the functions using them : short runs start fast
+if TYPE_CHECKING:
+    import nbformat
 
-import nbformat
 
+def process_commits(repo:pathlib.Path, first_commit:str, last_commit:str, new_branch:str, drop_empty:bool=False, engine:str=None, sparse:bool=False, cache:'BlobCache'=None, reporter:'ProgressReporter'=None, clean_options:Dict=None, verifier:'Verifier'=None, backend:str='subprocess', job:str=None, jobs:int=None, coalesce_window:int=None, memory_budget:int=None, nice:int=None, ionice:bool=False) -> Dict[str, str]:
+    """
+    Rewrite the commits from first_commit to last_commit on the new branch
 
-def process_commits(repo:pathlib.Path, first_commit:str, last_commit:str, new_branch:str):
+    Returns the mapping from the original commit sha to the rewritten one.
+    With drop_empty, commits becoming empty after processing are skipped
+    and mapped to the rewritten commit they were folded into.
 
-    start_parent = git_parent_sha(repo=repo, commit=first_commit)
+    engine
+    ======
+        * 'worktree' : checkout each commit in the working tree
+        * 'plumbing' : build trees and commits from git objects; no working tree needed
+        * None : 'plumbing' for bare repositories, 'worktree' otherwise
+
+    With sparse, the 'worktree' engine checks out only the folders
+    of the changed files during the run.
+
+    The 'plumbing' engine reuses the processed blobs in the cache, if any.
+
+    The reporter receives the progress of each commit.
+
+    clean_options : see get_clean_options()
+
+    verifier : how much of the processed ipynb to verify (default: all);
+        a 'deferred' verifier audits the whole rewritten range at the end
+        and keeps the mismatches in verifier.mismatches
+
+    backend : git access of the 'plumbing' engine, see get_backends()
+
+    job : with the 'plumbing' engine, write the new branch as refs/rebase_ipynb/<job>/heads/<new_branch>
+        so that jobs sharing the repository do not touch each other's refs
+
+    jobs : with the 'plumbing' engine and more than 1, process the notebooks
+        in up to this many worker processes, the largest first, see BlobScheduler
+
+    memory_budget : bytes the jobs may take, see ResourceGovernor (default: half of the available memory);
+        with 1 job, one notebook at a time is in memory anyway
+
+    nice, ionice : niceness increment and idle io class of the worker processes, see lower_priority()
+
+    coalesce_window : seconds; consecutive commits of the same author within this window
+        from the first one of them become one rewritten commit,
+        with the cleaned tree and the commit info of the last one, see get_coalesced_groups().
+        Each of the original commits is mapped to it.
+
+    A lock file for the new branch ref, and one for the working tree with the 'worktree' engine,
+    make a second job on the same target fail at once instead of clobbering the first one.
+    """
+
+    if engine is None:
+        engine = get_default_engine(repo)
+
+    if reporter is None:
+        reporter = ProgressReporter()
+
+    if verifier is None:
+        verifier = Verifier()
+
+    new_ref = get_new_branch_ref(new_branch, job)
+
+    assert (job is None) or ('plumbing' == engine), "per-job ref namespaces need the plumbing engine"
+    assert (jobs is None) or (jobs <= 1) or ('plumbing' == engine), "worker processes need the plumbing engine"
+
+    with contextlib.ExitStack() as locks:
+        locks.enter_context(job_lock(get_ref_lock_path(repo, new_ref), job or new_branch))
+
+        if 'worktree' == engine:
+            # checkout and switch change the one working tree
+            locks.enter_context(job_lock(get_git_dir(repo) / 'rebase_ipynb' / 'worktree.lock', job or new_branch))
+
+        start_parent = git_parent_sha(repo=repo, commit=first_commit)
+
+        if 'plumbing' == engine:
+            with get_backends()[backend](repo) as git_backend:
+                commit_list = git_backend.list_range(start_parent=start_parent, end=git_rev_parse(repo, last_commit))
+
+                assert any(map(lambda x: x.startswith(first_commit), commit_list)), (first_commit, commit_list)
+
+                reporter.start(new_branch=new_branch, n_commits=len(commit_list))
+
+                if coalesce_window is None:
+                    groups = None
+                else:
+                    with reporter.stage('read'):
+                        groups = get_coalesced_groups(
+                            [git_backend.get_commit_info(commit) for commit in commit_list], coalesce_window
+                        )
+
+                sha_map = process_commits_plumbing(
+                    backend=git_backend, commit_list=commit_list, start_parent=start_parent,
+                    new_ref=new_ref, drop_empty=drop_empty, cache=cache, reporter=reporter,
+                    clean_options=clean_options, verifier=verifier,
+                    governor=ResourceGovernor(memory_budget=memory_budget, max_workers=jobs, nice=nice, ionice=ionice) if (jobs is not None and 1 < jobs) else None,
+                    groups=groups,
+                )
+
+            finish_verification(repo, sha_map, verifier, reporter, groups=groups, start_parent=start_parent)
+            reporter.finish()
+            return sha_map
+
+        commit_list = git_log_hash(repo=repo, start_parent=start_parent, end=last_commit)
+
+        assert any(map(lambda x: x.startswith(first_commit), commit_list)), (first_commit, commit_list)
+        assert any(map(lambda x: x.startswith(last_commit), commit_list)), (last_commit, commit_list)
+
+        reporter.start(new_branch=new_branch, n_commits=len(commit_list))
+
+        assert 'worktree' == engine, engine
+        assert is_inside_work_tree(repo), f"{repo} has no working tree; try the plumbing engine"
+
+        if sparse:
+            sparse_context = sparse_checkout(
+                repo, get_sparse_folders(git_log_fnames(repo=repo, start_parent=start_parent, end=last_commit)),
+                job=job or new_branch,
+            )
+        else:
+            sparse_context = contextlib.nullcontext()
+
+        if coalesce_window is None:
+            groups = tuple((commit,) for commit in commit_list)
+        else:
+            with reporter.stage('read'):
+                groups = get_coalesced_groups(
+                    [git_show_info(repo=repo, commit=commit) for commit in commit_list], coalesce_window
+                )
+
+        sha_map = {}
+
+        with sparse_context:
+            start_temporary_branch_head(repo=repo, start_parent=start_parent, new_branch=new_branch)
+
+            for group, base in zip(groups, get_group_bases(groups, start_parent)):
+                new_commit = process_a_commit(
+                    repo=repo, commit=group[-1], new_branch=new_branch, drop_empty=drop_empty,
+                    reporter=reporter, clean_options=clean_options, verifier=verifier, base=base,
+                )
+                for commit in group:
+                    sha_map[commit] = new_commit
+                    reporter.commit_done(commit, new_commit)
+
+        finish_verification(repo, sha_map, verifier, reporter, groups=groups, start_parent=start_parent)
+        reporter.finish()
+
+        return sha_map
+
+
+def get_coalesced_groups(commit_infos:List[Dict[str, str]], window:int) -> Tuple[Tuple[str]]:
+    """
+    Consecutive commits of the same author, dated within the window seconds
+    from the first commit of the group, as autosaves would be
+
+    Returns the shas of each group, in order
+    """
+    groups = []
+
+    for info in commit_infos:
+        author = (info['author'], info['author_email'])
+        timestamp = parse_git_date(info['date'])[0]
+
+        if groups and (author == group_author) and (0 <= (timestamp - group_start) <= window):
+            groups[-1].append(info['sha'])
+        else:
+            groups.append([info['sha']])
+            group_author, group_start = author, timestamp
+
+    return tuple(map(tuple, groups))
+
+
+def get_group_bases(groups:Tuple[Tuple[str]], start_parent:str) -> Tuple[str]:
+    """
+    The commit before each group, to take the changes of the whole group from
+    None for a single commit, diffed with its own parent(s) as usual
+    """
+    bases = []
+    previous = start_parent
+
+    for group in groups:
+        bases.append(None if 1 == len(group) else previous)
+        previous = group[-1]
 
-    commit_list = git_log_hash(repo=repo, start_parent=start_parent, end=last_commit)
+    return tuple(bases)
 
-    assert any(map(lambda x: x.startswith(first_commit), commit_list)), (first_commit, commit_list)
-    assert any(map(lambda x: x.startswith(last_commit), commit_list)), (last_commit, commit_list)
 
-    start_temporary_branch_head(repo=repo, start_parent=start_parent, new_branch=new_branch)
+@contextlib.contextmanager
+def sparse_checkout(repo:pathlib.Path, folders:Tuple[str], job:str=None):
+    """
+    Cone mode sparse checkout of the folders for the duration of the run
+
+    A sparse checkout already set up by the user is left as it is.
+
+    `git sparse-checkout set` and `disable` write core.sparseCheckout,
+    which may be shared by all the worktrees :
+    the lock in the common git directory, held meanwhile,
+    makes a second sparse job on the repository fail at once.
+    """
+    with job_lock(get_git_common_dir(repo) / 'rebase_ipynb' / 'locks' / 'sparse-checkout.lock', job):
+        if is_sparse_checkout(repo):
+            yield
+            return
+
+        check_output(get_sparse_checkout_set_cmd(folders), repo=repo)
+
+        try:
+            yield
+        finally:
+            check_output(get_sparse_checkout_disable_cmd(), repo=repo)
+
+
+def is_sparse_checkout(repo:pathlib.Path) -> bool:
+    result = subprocess.run(
+        get_config_bool_cmd('core.sparseCheckout'),
+        cwd=repo, encoding='utf-8', stdout=subprocess.PIPE
+    )
+    return 'true' == result.stdout.strip()
+
+
+def get_config_bool_cmd(key:str) -> List[str]:
+    return ['git', 'config', '--bool', key]
+
+
+def get_sparse_checkout_set_cmd(folders:Tuple[str]) -> List[str]:
+    return ['git', 'sparse-checkout', 'set', '--cone', *folders]
+
+
+def get_sparse_checkout_disable_cmd() -> List[str]:
+    return ['git', 'sparse-checkout', 'disable']
+
 
-    for commit in commit_list:
-        process_a_commit(repo=repo, commit=commit, new_branch=new_branch)
+def get_sparse_folders(fnames:Tuple[str]) -> Tuple[str]:
+    """
+    Folders of the files; files at the top level are always checked out in cone mode
+    """
+    folders = set(
+        str(pathlib.PurePosixPath(f).parent) for f in fnames
+    )
+    folders.discard('.')
+
+    return tuple(sorted(folders))
+
+
+def git_log_fnames(repo:pathlib.Path, start_parent:str, end:str) -> Tuple[str]:
+    """
+    All the files changed in the range, in one git call
+    """
+    return tuple(
+        sorted(
+            set(
+                filter(None, check_output(get_log_fnames_cmd(start_parent, end), repo=repo).split('\0'))
+            )
+        )
+    )
 
 
-def process_a_commit(repo:pathlib.Path, commit:str, new_branch:str):
+def get_log_fnames_cmd(start_parent:str, end:str) -> List[str]:
+    return ['git', 'log', '--pretty=format:', '--name-only', '-z', f'{start_parent}..{end}']
+
+
+def process_a_commit(repo:pathlib.Path, commit:str, new_branch:str, drop_empty:bool=False, reporter:'ProgressReporter'=None, clean_options:Dict=None, verifier:'Verifier'=None, base:str=None) -> str:
     """
     Checkout the commit
     Get the commit info
     Copy the changed files to a temporary folder
     Process the ipynb files
     Switch to the temporary branch
-    Add the changed files
+    Update the index with the changed and deleted files
+    Commit unless the commit became empty and drop_empty is set
+
+    With base, the changes from base to the commit go into the one rewritten commit
+
+    Returns the sha of the rewritten commit
     """
 
-    git_checkout(repo=repo, commit=commit)
+    if reporter is None:
+        reporter = ProgressReporter()
 
-    commit_info = git_show_info(repo=repo, commit=commit)
+    if verifier is None:
+        verifier = Verifier()
 
-    changed_files = git_diff_fnames(repo=repo, commit=commit)
+    clean_options = get_clean_options(**(clean_options or {}))
+
+    with reporter.stage('checkout'):
+        git_checkout(repo=repo, commit=commit)
+
+    with reporter.stage('read'):
+        commit_info = git_show_info(repo=repo, commit=commit)
+
+        if base is None:
+            entries = git_diff_tree_raw(repo=repo, commit=commit)
+        else:
+            entries = git_diff_trees_raw(repo=repo, tree_a=base, tree_b=commit)
+
+    changed_files = tuple(e['path'] for e in entries if 'D' != e['status'])
+    deleted_files = tuple(e['path'] for e in entries if 'D' == e['status'])
+    notebooks = tuple(e['path'] for e in entries if is_ipynb_entry(e))
+    original_shas = {e['path']: e['new_sha'] for e in entries}
+
+    externalized = []
 
     with tempfile.TemporaryDirectory() as tmp_dir:
         tmp_path = pathlib.Path(tmp_dir)
@@ -104,290 +413,3309 @@ def process_a_commit(repo:pathlib.Path, commit:str, new_branch:str):
 
             shutil.copy(tmp_path / f, repo / f)
 
-            if f.endswith('.ipynb'):
-                process_ipynb(repo / f)
+            if f in notebooks:
+                with reporter.stage('process'):
+                    externalized += process_ipynb(
+                        repo / f, clean_options, repo / clean_options['externalize_folder']
+                    )
 
-                assert verify_processed_ipynb(tmp_path / f, repo / f)
+                with reporter.stage('verify'):
+                    assert verifier.verify(tmp_path / f, repo / f, original_shas[f]), (f, commit)
 
-    git_add(repo=repo, files=changed_files)
-    git_commit(
-        repo=repo,
-        commit_info=commit_info
-    )
+                reporter.notebook_done((tmp_path / f).stat().st_size, (repo / f).stat().st_size)
 
+    for f in deleted_files:
+        if (repo / f).exists() or (repo / f).is_symlink():
+            (repo / f).unlink()
 
-def git_checkout(repo:pathlib.Path, commit:str):
-    check_output(get_checkout_cmd(commit), repo=repo)
+    with reporter.stage('index'):
+        # same filters as `git add` for the processed notebooks
+        processed_files = notebooks + tuple(
+            sorted(set(p.relative_to(repo).as_posix() for p in externalized))
+        )
+        blob_shas = dict(zip(processed_files, git_hash_objects_w(repo=repo, paths=processed_files)))
 
+        git_update_index_info(repo=repo, lines=get_index_info_lines(entries, blob_shas))
 
-def git_add(repo:pathlib.Path, files:List[str]):
-    check_output(get_add_cmd(files), repo=repo)
+    with reporter.stage('commit'):
+        if drop_empty and is_index_same_as_head(repo):
+            return git_rev_parse(repo, 'HEAD')
 
+        git_commit(
+            repo=repo,
+            commit_info=commit_info
+        )
 
-def git_commit(repo:pathlib.Path, commit_info:Dict[str, str]):
-    git_config_committer_name(repo, commit_info)
-    git_config_committer_email(repo, commit_info)
-    set_commit_date(commit_info)
-    check_output(get_commit_cmd(commit_info), repo=repo)
+        return git_rev_parse(repo, 'HEAD')
 
 
-def set_commit_date(commit_info:Dict[str, str]):
+def process_commits_plumbing(backend:'GitBackend', commit_list:Tuple[str], start_parent:str, new_ref:str, drop_empty:bool=False, cache:'BlobCache'=None, reporter:'ProgressReporter'=None, clean_options:Dict=None, verifier:'Verifier'=None, governor:'ResourceGovernor'=None, groups:Tuple[Tuple[str]]=None) -> Dict[str, str]:
     """
-    Set the commit date
+    Rewrite the commits without touching any working tree
+
+    With a governor, the ipynb blobs of the whole range are processed
+    in its worker pool by the BlobScheduler while the commits are written in order.
+
+    groups : commits to write as one commit each, see get_coalesced_groups() (default: one by one)
 
-    https://stackoverflow.com/questions/454734
+    The new ref is created only after all the commits are written.
     """
-    os.environ["GIT_COMMITTER_DATE"] = commit_info["commit_date"]
+    if reporter is None:
+        reporter = ProgressReporter()
 
+    if groups is None:
+        groups = tuple((commit,) for commit in commit_list)
 
-def check_output(cmd:List[str], repo:pathlib.Path=None, stderr=None) -> str:
-    return subprocess.check_output(cmd, cwd=repo, encoding='utf-8', stderr=stderr)
+    bases = get_group_bases(groups, start_parent)
 
+    sha_map = {}
 
-def get_checkout_cmd(commit):
-    return ['git', '-c', "advice.detachedHead=false", 'checkout', commit]
+    new_head = start_parent
+    new_tree = backend.get_tree(start_parent)
 
+    if governor is None:
+        for group, base in zip(groups, bases):
+            new_head, new_tree = process_a_commit_plumbing(
+                backend=backend, commit=group[-1], new_parent=new_head, new_parent_tree=new_tree,
+                drop_empty=drop_empty, cache=cache, reporter=reporter,
+                clean_options=clean_options, verifier=verifier, base=base,
+            )
+            for commit in group:
+                sha_map[commit] = new_head
+                reporter.commit_done(commit, new_head)
+    else:
+        with reporter.stage('read'):
+            commit_infos = [backend.get_commit_info(group[-1]) for group in groups]
+            changes = [backend.get_changes(group[-1], base) for group, base in zip(groups, bases)]
 
-def get_add_cmd(files:List[str]) -> List[str]:
-    return ['git', 'add', *files]
+        scheduler = BlobScheduler(
+            backend, governor, cache=cache, reporter=reporter, clean_options=clean_options, verifier=verifier
+        )
 
+        for group, commit_info, entries, blob_shas in zip(groups, commit_infos, changes, scheduler.run(changes)):
+            new_head, new_tree = write_a_commit_plumbing(
+                backend, commit_info, entries, blob_shas, new_parent=new_head, new_parent_tree=new_tree,
+                drop_empty=drop_empty, reporter=reporter,
+            )
+            for commit in group:
+                sha_map[commit] = new_head
+                reporter.commit_done(commit, new_head)
 
-def git_config_committer_name(repo:pathlib.Path, commit_info:Dict[str, str]) -> List[str]:
-    return check_output([
-        'git', 'config', 'user.name', commit_info["committer"],
-    ], repo=repo)
+    backend.create_ref(new_ref, new_head)
 
+    return sha_map
 
-def git_config_committer_email(repo:pathlib.Path, commit_info:Dict[str, str]) -> List[str]:
-    return check_output([
-        'git', 'config', 'user.email', commit_info["committer_email"],
-    ], repo=repo)
 
+def process_a_commit_plumbing(backend:'GitBackend', commit:str, new_parent:str, new_parent_tree:str, drop_empty:bool=False, cache:'BlobCache'=None, reporter:'ProgressReporter'=None, clean_options:Dict=None, verifier:'Verifier'=None, base:str=None) -> Tuple[str, str]:
+    """
+    Process the ipynb blobs
+    Apply the changes of the commit to the tree of the new parent
+    Write the commit on top of the new parent
 
-def get_commit_cmd(commit_info) -> List[str]:
-    return [
-        'git', 'commit',
-            '--allow-empty',
-            '-m', commit_info["message"],
-            '--date', commit_info["date"],
-            '--author', f'{commit_info["author"]} <{commit_info["author_email"]}>',
-    ]
+    With base, the changes from base to the commit go into the one rewritten commit
 
+    Returns the sha of the rewritten commit and its tree
+    """
+    if reporter is None:
+        reporter = ProgressReporter()
 
-def git_show_info(repo:pathlib.Path, commit:str) -> Dict[str, str]:
-    return get_commit_info_from_show(
-        check_output(
-            get_show_stat_commit(commit),
-            repo=repo
-        )
-    )
+    with reporter.stage('read'):
+        commit_info = backend.get_commit_info(commit)
 
+        entries = backend.get_changes(commit, base)
 
-def get_show_stat_commit(commit:str) -> List[str]:
-    return ['git', 'show', '--stat', "--format=fuller",commit]
+    blob_shas = process_ipynb_blobs(
+        backend, tuple(filter(is_ipynb_entry, entries)),
+        cache=cache, reporter=reporter, clean_options=clean_options, verifier=verifier,
+    )
 
+    return write_a_commit_plumbing(
+        backend, commit_info, entries, blob_shas, new_parent=new_parent, new_parent_tree=new_parent_tree,
+        drop_empty=drop_empty, reporter=reporter,
+    )
 
-def git_parent_sha(repo:pathlib.Path, commit:str) -> str:
-    return git_show_info(repo, commit+'^')["sha"]
 
+def write_a_commit_plumbing(backend:'GitBackend', commit_info:Dict[str, str], entries:Tuple[Dict[str, str]], blob_shas:Dict[str, str], new_parent:str, new_parent_tree:str, drop_empty:bool=False, reporter:'ProgressReporter'=None) -> Tuple[str, str]:
+    """
+    Apply the changes, with the processed blobs, to the tree of the new parent
+    Write the commit on top of the new parent
 
-def get_commit_info_from_show(output:str) -> Dict[str, str]:
-    lines = output.splitlines()
+    Returns the sha of the rewritten commit and its tree
+    """
+    if reporter is None:
+        reporter = ProgressReporter()
 
-    body = get_commit_message_body(lines)
+    with reporter.stage('index'):
+        tree = backend.update_tree(new_parent_tree, get_tree_changes(entries, blob_shas))
 
-    result = {
-        "sha": lines[0].split('commit')[1].strip(),
-        "author": lines[1].split('Author:')[1].strip().split('<')[0].strip(),
-        "author_email": lines[1].split('<')[1].strip().strip('>'),
-        "date": lines[2].split('Date:')[1].strip(),
-        "committer": lines[3].split('Commit:')[1].strip().split('<')[0].strip(),
-        "committer_email": lines[3].split('<')[1].strip().strip('>'),
-        "commit_date": lines[4].split('Date:')[1].strip(),
-        'message': body,
-    }
+    with reporter.stage('commit'):
+        if drop_empty and (tree == new_parent_tree):
+            return new_parent, new_parent_tree
 
-    return result
+        return backend.create_commit(tree=tree, parent=new_parent, commit_info=commit_info), tree
 
 
-def get_commit_message_body(lines:List[str]) -> str:
-    last_line = lines[-1].strip()
+def process_ipynb_blobs(backend:'GitBackend', entries:Tuple[Dict[str, str]], cache:'BlobCache'=None, reporter:'ProgressReporter'=None, clean_options:Dict=None, verifier:'Verifier'=None) -> Dict[str, str]:
+    """
+    Process the ipynb blobs of the entries in a temporary folder
+    and write them to the object database at once
 
-    if ("file changed" in last_line) or ("files changed" in last_line):
-        n_files_str = last_line.split('file')[0].strip()
+    Blobs found in the cache are not processed again.
 
-        assert n_files_str.isnumeric(), (
-            pprint.pformat(lines),
-            last_line,
-            last_line.split('files')
-        )
+    Returns the processed blob sha of each path,
+    including the externalized output files
+    """
+    if reporter is None:
+        reporter = ProgressReporter()
 
-        n_files = int(n_files_str)
+    clean_options = get_clean_options(**(clean_options or {}))
 
-        body = '\n'.join(
-            map(
-                lambda s:s.strip(),
-                lines[5:-n_files-1]
-            )
-        ).strip()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_path = pathlib.Path(tmp_dir)
 
-    else:
-        # if no file changed
-        body = '\n'.join(
-            map(
-                lambda s:s.strip(),
-                lines[5:]
-            )
-        ).strip()
+        processed_paths = []
+        outputs = {}
 
-    return body
+        for i, entry in enumerate(entries):
+            folder = tmp_path / str(i)
+            outputs_folder = folder / 'outputs'
 
+            cache_key = get_cache_key(entry['new_sha'], clean_options)
+            cached = None if cache is None else cache.get(cache_key)
 
-def assert_git_repo(repo:pathlib.Path) -> bool:
-    assert repo.exists()
-    assert repo.is_dir()
+            if cached is None:
+                processed_path, externalized = process_ipynb_blob(
+                    backend, entry['new_sha'], entry['path'], folder,
+                    reporter=reporter, clean_options=clean_options, outputs_folder=outputs_folder,
+                    verifier=verifier,
+                )
+                if cache is not None:
+                    cache.put(cache_key, processed_path.read_bytes())
+                    for output_path in externalized:
+                        cache.put(output_path.name, output_path.read_bytes())
+            else:
+                reporter.cache_hit()
+                folder.mkdir()
+                processed_path = folder / 'cached.ipynb'
+                processed_path.write_bytes(cached)
+                externalized = cache.copy_outputs(
+                    get_external_output_names(json.loads(cached)), outputs_folder
+                )
 
-    repo_git_path = repo / '.git'
+            processed_paths.append(processed_path)
 
-    assert repo_git_path.exists()
-    assert repo_git_path.is_dir()
+            for output_path in externalized:
+                outputs[f"{clean_options['externalize_folder']}/{output_path.name}"] = output_path
 
+        output_names = tuple(sorted(outputs))
 
-def start_temporary_branch_head(repo:pathlib.Path, start_parent:str, new_branch:str=None):
-    assert_git_repo(repo)
+        with reporter.stage('write'):
+            blob_shas = backend.write_blobs(processed_paths + [outputs[name] for name in output_names])
 
-    check_output(get_checkout_head_cmd(start_parent, new_branch), repo=repo)
+    return dict(zip(tuple(e['path'] for e in entries) + output_names, blob_shas))
 
 
-def get_checkout_head_cmd(start_parent:str, new_branch:str=None) -> List[str]:
-    cmd = ['git', 'checkout', start_parent]
+def process_ipynb_blob(backend:'GitBackend', blob_sha:str, fname:str, folder:pathlib.Path, reporter:'ProgressReporter'=None, clean_options:Dict=None, outputs_folder:pathlib.Path=None, verifier:'Verifier'=None) -> Tuple[pathlib.Path, Tuple[pathlib.Path]]:
+    """
+    Process an ipynb blob in the folder
 
-    if new_branch is not None:
-        cmd += ['-b', new_branch]
+    Returns the path of the processed file
+    and the output files externalized to the outputs_folder
+    """
+    if reporter is None:
+        reporter = ProgressReporter()
 
-    return cmd
+    if verifier is None:
+        verifier = Verifier()
 
+    src = folder / 'original' / pathlib.PurePosixPath(fname).name
+    dest = folder / 'processed' / src.name
 
-def switch_to_temporary_branch(repo:pathlib.Path, branch:str):
-    assert_git_repo(repo)
+    src.parent.mkdir(parents=True)
+    dest.parent.mkdir(parents=True)
 
-    check_output(get_switch_cmd(branch), repo=repo)
+    with reporter.stage('read'):
+        src.write_bytes(backend.read_blob(blob_sha))
+        shutil.copy(src, dest)
 
+    with reporter.stage('process'):
+        externalized = process_ipynb(dest, clean_options, outputs_folder)
 
-def get_switch_cmd(branch:str) -> List[str]:
-    return ['git', 'switch', branch]
+    with reporter.stage('verify'):
+        assert verifier.verify(src, dest, blob_sha), (fname, blob_sha)
 
+    reporter.notebook_done(src.stat().st_size, dest.stat().st_size)
 
-def get_repo_folder_path(parsed:argparse.Namespace) -> pathlib.Path:
-    p = pathlib.Path(parsed.repo).resolve(strict=True)
+    return dest, externalized
 
-    assert p.exists()
-    assert p.is_dir()
 
-    p_git = p / '.git'
-    assert p_git.exists()
-    assert p.is_dir()
+class BlobScheduler:
+    """
+    Process the ipynb blobs of a whole range in the worker pool of the governor,
+    the largest first, and release the processed blobs commit by commit in the original order
 
-    return p
+    Processed blobs of later commits wait in the reorder buffer
+    until all the blobs of the commits before them are done.
 
+    The 'queues' events report the depth of each stage :
+    'pending' blobs not submitted yet, 'running' in the pool,
+    'buffered' processed but held for an earlier commit
+    """
 
-def git_log_hash(repo:pathlib.Path, start_parent:str, end:str) -> Tuple[str]:
-    return tuple(
-        check_output(get_hash_log_cmd(start_parent, end), repo=repo).splitlines()
-    )
+    def __init__(self, backend:'GitBackend', governor:'ResourceGovernor', cache:'BlobCache'=None, reporter:'ProgressReporter'=None, clean_options:Dict=None, verifier:'Verifier'=None):
+        self.backend = backend
+        self.governor = governor
+        self.cache = cache
+        self.reporter = ProgressReporter() if reporter is None else reporter
+        self.clean_options = get_clean_options(**(clean_options or {}))
+        self.verifier = Verifier() if verifier is None else verifier
+
+    def run(self, changes:List[Tuple[Dict[str, str]]]) -> Iterator[Dict[str, str]]:
+        """
+        changes : diff entries of each commit
+
+        Yields the processed blob sha of each path of each commit, as process_ipynb_blobs()
+
+        Each worker reads its own blob once the governor admits it, see clean_ipynb_blob();
+        cached blobs are copied out when their first commit is written.
+        The folder of a blob is removed after the last commit needing it is written.
+        """
+        needed = [
+            tuple(dict.fromkeys(entry['new_sha'] for entry in entries if is_ipynb_entry(entry)))
+            for entries in changes
+        ]
+
+        last_use = {}
+        for k, shas in enumerate(needed):
+            for sha in shas:
+                last_use[sha] = k
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tmp_path = pathlib.Path(tmp_dir)
+
+            hits = set()
+            misses = []
+
+            for blob_sha in last_use:
+                if (self.cache is not None) and self.cache.get_path(get_cache_key(blob_sha, self.clean_options)).exists():
+                    hits.add(blob_sha)
+                else:
+                    misses.append(blob_sha)
+
+            srcs = [tmp_path / blob_sha / 'original.ipynb' for blob_sha in misses]
+
+            with self.reporter.stage('read'):
+                sizes = self.backend.get_blob_sizes(misses)
+
+            results = self.governor.imap_unordered(
+                clean_ipynb_blob,
+                sizes,
+                [type(self.backend)] * len(misses),
+                [self.backend.repo] * len(misses),
+                misses,
+                srcs,
+                [src.with_name('processed.ipynb') for src in srcs],
+                [self.clean_options] * len(misses),
+                [src.with_name('outputs') for src in srcs],
+            )
 
+            # blob sha : (processed path, externalized paths)
+            done = {}
+            written = {}
 
-def get_hash_log_cmd(start_parent:str, end:str) -> List[str]:
-    return ['git', 'log', '--reverse', '--pretty=format:%H', f'{start_parent}..{end}']
+            for k, (shas, entries) in enumerate(zip(needed, changes)):
+                for blob_sha in shas:
+                    if (blob_sha in hits) and (blob_sha not in done):
+                        done[blob_sha] = self.copy_cached(blob_sha, tmp_path / blob_sha)
 
+                while any(map(lambda sha: sha not in done, shas)):
+                    with self.reporter.stage('process'):
+                        i, externalized = next(results)
 
-def git_diff_fnames(repo:pathlib.Path, commit:str) -> Tuple[str]:
-    return tuple(
-        check_output(get_chg_files_cmd(commit), repo=repo).splitlines()
-    )
+                    done[misses[i]] = self.finish_blob(misses[i], srcs[i], externalized)
 
+                    self.reporter.emit(
+                        'queues', **self.governor.depths,
+                        buffered=sum(1 for sha in done if ('notebook', sha) not in written),
+                    )
 
-def get_chg_files_cmd(commit:str) -> List[str]:
-    return ['git', 'diff-tree', '--no-commit-id', '--name-only', '-r', commit]
+                yield self.write_blobs(entries, done, written)
 
+                for blob_sha in shas:
+                    if k == last_use[blob_sha]:
+                        shutil.rmtree(tmp_path / blob_sha, ignore_errors=True)
+                        del done[blob_sha]
 
-def git_switch_c(repo:pathlib.Path, commit:str, branch:str):
-    check_output(get_switch_c_cmd(commit, branch), repo=repo)
+    def copy_cached(self, blob_sha:str, folder:pathlib.Path) -> Tuple[pathlib.Path, Tuple[pathlib.Path]]:
+        cached = self.cache.get(get_cache_key(blob_sha, self.clean_options))
 
+        self.reporter.cache_hit()
 
-def get_switch_c_cmd(commit:str, branch:str) -> List[str]:
-    return ['git', 'switch', commit, '-c', branch]
+        folder.mkdir(parents=True, exist_ok=True)
+        (folder / 'processed.ipynb').write_bytes(cached)
 
+        return (
+            folder / 'processed.ipynb',
+            self.cache.copy_outputs(get_external_output_names(json.loads(cached)), folder / 'outputs'),
+        )
 
-def get_current_branch(repo:pathlib.Path) -> str:
-    return check_output(
-        get_current_branch_cmd(),
-        repo=repo
-    ).strip()
+    def finish_blob(self, blob_sha:str, src:pathlib.Path, externalized:Tuple[pathlib.Path]) -> Tuple[pathlib.Path, Tuple[pathlib.Path]]:
+        dest = src.with_name('processed.ipynb')
 
+        with self.reporter.stage('verify'):
+            assert self.verifier.verify(src, dest, blob_sha), blob_sha
 
-def get_current_branch_cmd() -> List[str]:
-    return ['git', 'branch', '--show-current']
+        self.reporter.notebook_done(src.stat().st_size, dest.stat().st_size)
 
+        if self.cache is not None:
+            self.cache.put(get_cache_key(blob_sha, self.clean_options), dest.read_bytes())
+            for output_path in externalized:
+                self.cache.put(output_path.name, output_path.read_bytes())
 
-def git_branch(repo:pathlib.Path) -> Tuple[str]:
-    return tuple(
-        check_output(get_branch_cmd(), repo=repo).splitlines()
-    )
+        return dest, externalized
 
+    def write_blobs(self, entries:Tuple[Dict[str, str]], done:Dict[str, Tuple], written:Dict[Tuple[str, str], str]) -> Dict[str, str]:
+        """
+        Write the files of the commit not written yet, in one call
 
-def get_branch_cmd() -> List[str]:
-    return ['git', 'branch']
+        written : new sha of ('notebook', original blob sha) and ('output', path) already written
+        """
+        notebooks = tuple(filter(is_ipynb_entry, entries))
 
+        files = {}
+        output_names = []
 
-def process_ipynb(src_path:pathlib.Path):
-    """
-    rewrite ipynb file using `jupyter nbconver --to notebook`
-    """
-    assert src_path.exists()
-    assert src_path.is_file()
-    assert src_path.suffix == '.ipynb'
+        for entry in notebooks:
+            processed_path, externalized = done[entry['new_sha']]
 
-    with tempfile.TemporaryDirectory() as tmpdir:
-        tmpdir = pathlib.Path(tmpdir)
+            files[('notebook', entry['new_sha'])] = processed_path
 
-        src_after_ipynb_path = tmpdir / (src_path.name)
+            for output_path in externalized:
+                name = f"{self.clean_options['externalize_folder']}/{output_path.name}"
+                files[('output', name)] = output_path
+                output_names.append(name)
 
-        remove_colab_button(src_path, src_after_ipynb_path)
+        new_keys = [key for key in files if key not in written]
 
-    remove_id_from_file(src_path, src_path)
+        with self.reporter.stage('write'):
+            written.update(zip(new_keys, self.backend.write_blobs([files[key] for key in new_keys])))
 
+        result = {entry['path']: written[('notebook', entry['new_sha'])] for entry in notebooks}
+        result.update((name, written[('output', name)]) for name in sorted(set(output_names)))
 
-def jupyter_nbconvert_notebook(input_path:pathlib.Path, output_path:pathlib.Path, my_null):
-    check_output(get_nbconvert_ipynb_cmd(input_path, output_path), stderr=my_null)
+        return result
 
 
-def get_nbconvert_ipynb_cmd(input_path:pathlib.Path, output_path:pathlib.Path) -> List[str]:
+def clean_ipynb_blob(backend_class:type, repo:pathlib.Path, blob_sha:str, src:pathlib.Path, dest:pathlib.Path, clean_options:Dict, outputs_folder:pathlib.Path) -> Tuple[pathlib.Path]:
+    """
+    Read the blob to src, then clean_ipynb_copy()
+
+    In the worker processes : a blob is read only once the governor admits it
+    """
+    src.parent.mkdir(parents=True, exist_ok=True)
+
+    with backend_class(repo) as backend:
+        backend.read_blob_to_file(blob_sha, src)
+
+    return clean_ipynb_copy(src, dest, clean_options, outputs_folder)
+
+
+def clean_ipynb_copy(src:pathlib.Path, dest:pathlib.Path, clean_options:Dict, outputs_folder:pathlib.Path) -> Tuple[pathlib.Path]:
+    """
+    process_ipynb() a copy, keeping the original for the verification
+
+    In the worker processes
+    """
+    shutil.copy(src, dest)
+    return process_ipynb(dest, clean_options, outputs_folder)
+
+
+def process_snapshot(repo:pathlib.Path, ref:str, new_branch:str, message:str='Unify ipynb format', cache:'BlobCache'=None, reporter:'ProgressReporter'=None, clean_options:Dict=None, max_workers:int=None, governor:'ResourceGovernor'=None, verifier:'Verifier'=None) -> str:
+    """
+    Clean all the ipynb files in the tree of ref and write one commit on top of it
+
+    The notebooks are processed in a pool of worker processes, sized by the governor if any.
+    verifier : how much of the processed ipynb to verify (default: all), see Verifier;
+        'deferred' keeps only the fingerprints, as there is no range to audit
+    The author and the committer come from the git configuration or the environment, as `git commit`.
+    Without any change, the new branch points to the commit of ref.
+
+    Returns the sha of the commit of the new branch
+    """
+    if reporter is None:
+        reporter = ProgressReporter()
+
+    clean_options = get_clean_options(**(clean_options or {}))
+
+    parent = git_rev_parse(repo, ref + '^{commit}')
+    tree = git_rev_parse(repo, parent + '^{tree}')
+
+    reporter.start(new_branch=new_branch, n_commits=1)
+
+    with reporter.stage('read'):
+        entries = tuple(filter(is_ipynb_entry, git_ls_tree_entries(repo, parent)))
+
+    blob_shas = process_ipynb_blobs_parallel(
+        repo, entries, cache=cache, reporter=reporter, clean_options=clean_options,
+        max_workers=max_workers, governor=governor, verifier=verifier,
+    )
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        index_env = get_index_env(pathlib.Path(tmp_dir) / 'index')
+
+        with reporter.stage('index'):
+            check_output(get_read_tree_cmd(parent), repo=repo, env=index_env)
+            git_update_index_info(repo=repo, lines=get_index_info_lines(entries, blob_shas), env=index_env)
+            new_tree = check_output(get_write_tree_cmd(), repo=repo, env=index_env).strip()
+
+    with reporter.stage('commit'):
+        if new_tree == tree:
+            new_commit = parent
+        else:
+            new_commit = check_output(
+                get_commit_tree_cmd(new_tree, parent), repo=repo, input=get_clean_message(message)
+            ).strip()
+
+        git_create_branch_ref(repo, new_branch, new_commit)
+
+    reporter.commit_done(parent, new_commit)
+    reporter.finish()
+
+    return new_commit
+
+
+def process_ipynb_blobs_parallel(repo:pathlib.Path, entries:Tuple[Dict[str, str]], cache:'BlobCache'=None, reporter:'ProgressReporter'=None, clean_options:Dict=None, max_workers:int=None, governor:'ResourceGovernor'=None, verifier:'Verifier'=None) -> Dict[str, str]:
+    """
+    Same as process_ipynb_blobs(), with the distinct blobs processed in a process pool
+
+    The blobs are streamed to the temporary folder in one git call, then processed there;
+    each is verified before it is written to the object database.
+    """
+    if reporter is None:
+        reporter = ProgressReporter()
+
+    if verifier is None:
+        verifier = Verifier()
+
+    clean_options = get_clean_options(**(clean_options or {}))
+
+    blob_list = sorted(set(entry['new_sha'] for entry in entries))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_path = pathlib.Path(tmp_dir)
+
+        processed = {}
+        externalized = {}
+        misses = []
+
+        for blob_sha in blob_list:
+            folder = tmp_path / blob_sha
+            folder.mkdir()
+            processed[blob_sha] = folder / 'processed.ipynb'
+
+            cached = None if cache is None else cache.get(get_cache_key(blob_sha, clean_options))
+
+            if cached is None:
+                misses.append(blob_sha)
+            else:
+                reporter.cache_hit()
+                processed[blob_sha].write_bytes(cached)
+                externalized[blob_sha] = cache.copy_outputs(
+                    get_external_output_names(json.loads(cached)), folder / 'outputs'
+                )
+
+        originals = [processed[blob_sha].with_name('original.ipynb') for blob_sha in misses]
+
+        with reporter.stage('read'):
+            git_cat_file_batch_to_files(repo, misses, originals)
+
+        with reporter.stage('process'):
+            externalized.update(
+                zip(
+                    misses,
+                    map_ipynb_files(
+                        originals,
+                        clean_options,
+                        [processed[blob_sha].parent / 'outputs' for blob_sha in misses],
+                        max_workers=max_workers,
+                        governor=governor,
+                        dests=[processed[blob_sha] for blob_sha in misses],
+                    )
+                )
+            )
+
+        for blob_sha, original in zip(misses, originals):
+            with reporter.stage('verify'):
+                assert verifier.verify(original, processed[blob_sha], blob_sha), blob_sha
+
+            reporter.notebook_done(original.stat().st_size, processed[blob_sha].stat().st_size)
+
+            if cache is not None:
+                cache.put(get_cache_key(blob_sha, clean_options), processed[blob_sha].read_bytes())
+                for output_path in externalized[blob_sha]:
+                    cache.put(output_path.name, output_path.read_bytes())
+
+        outputs = {}
+        for blob_sha in blob_list:
+            for output_path in externalized[blob_sha]:
+                outputs[f"{clean_options['externalize_folder']}/{output_path.name}"] = output_path
+
+        output_names = tuple(sorted(outputs))
+
+        with reporter.stage('write'):
+            written = git_hash_objects_w(
+                repo=repo,
+                paths=[processed[blob_sha] for blob_sha in blob_list] + [outputs[name] for name in output_names],
+                no_filters=True
+            )
+
+    new_shas = dict(zip(blob_list, written))
+
+    result = {entry['path']: new_shas[entry['new_sha']] for entry in entries}
+    result.update(zip(output_names, written[len(blob_list):]))
+
+    return result
+
+
+def map_ipynb_files(paths:List[pathlib.Path], clean_options:Dict, outputs_folders:List[pathlib.Path], max_workers:int=None, governor:'ResourceGovernor'=None, dests:List[pathlib.Path]=None) -> List[Tuple[pathlib.Path]]:
+    """
+    process_ipynb() the files in place in a process pool;
+    with dests, process copies there, keeping the originals
+
+    Returns the externalized output files of each
+    """
+    if governor is None:
+        governor = ResourceGovernor(max_workers=max_workers)
+
+    if dests is None:
+        return governor.map(
+            process_ipynb, [path.stat().st_size for path in paths],
+            paths, [clean_options] * len(paths), outputs_folders
+        )
+
+    return governor.map(
+        clean_ipynb_copy, [path.stat().st_size for path in paths],
+        paths, dests, [clean_options] * len(paths), outputs_folders
+    )
+
+
+class ResourceGovernor:
+    """
+    Sizes the worker pool by the cores and the load of the host
+    and admits the notebooks within a memory budget
+
+    Loading and rewriting a notebook takes about memory_factor times its size,
+    on top of worker_memory for each worker process.
+    A notebook larger than the whole budget runs alone.
+
+    parent_memory : what the main process itself holds, taken off the budget first
+        (default: worker_memory); it streams the blobs to disk, see git_cat_file_batch_to_files()
+
+    nice, ionice : lower the cpu and the io priority of the workers
+    """
+
+    def __init__(self, memory_budget:int=None, max_workers:int=None, memory_factor:float=10, worker_memory:int=64 * 2**20, nice:int=None, ionice:bool=False, parent_memory:int=None):
+        self.memory_budget = get_default_memory_budget() if memory_budget is None else memory_budget
+        self.max_workers = max_workers
+        self.memory_factor = memory_factor
+        self.worker_memory = worker_memory
+        self.parent_memory = worker_memory if parent_memory is None else parent_memory
+        self.nice = nice
+        self.ionice = ionice
+
+        self.depths = {'pending': 0, 'running': 0}
+
+    def estimate(self, size:int) -> int:
+        return int(size * self.memory_factor)
+
+    def get_pool_budget(self) -> int:
+        """
+        The memory budget left to the workers after the main process; None if unlimited
+        """
+        if self.memory_budget is None:
+            return None
+
+        return max(0, self.memory_budget - self.parent_memory)
+
+    def get_n_workers(self, n_items:int) -> int:
+        """
+        Idle cores, within max_workers, the memory budget and the number of items
+        """
+        n_workers = get_idle_cores()
+
+        if self.max_workers is not None:
+            n_workers = min(n_workers, self.max_workers)
+
+        if self.memory_budget is not None:
+            n_workers = min(n_workers, self.get_pool_budget() // self.worker_memory)
+
+        return max(1, min(n_workers, n_items))
+
+    def map(self, function:Callable, sizes:List[int], *iterables) -> List:
+        """
+        function(*args) for the args of the iterables in the worker processes
+
+        sizes : size in bytes of the notebook of each call
+        Returns the results in the order of the arguments
+        """
+        results = [None] * len(sizes)
+
+        for i, result in self.imap_unordered(function, sizes, *iterables):
+            results[i] = result
+
+        return results
+
+    def imap_unordered(self, function:Callable, sizes:List[int], *iterables) -> Iterator[Tuple[int, object]]:
+        """
+        (index, function(*args)) of each call as they complete
+
+        With more than one worker, the largest notebooks go first :
+        a large one started last would keep the pool waiting for it alone.
+        Without a pool, the calls run in order in this process.
+
+        self.depths counts the 'pending' calls not submitted yet and the 'running' ones
+        """
+        args_list = list(zip(*iterables))
+        assert len(sizes) == len(args_list), (len(sizes), len(args_list))
+
+        n_workers = self.get_n_workers(len(args_list))
+
+        if 1 == n_workers:
+            for i, args in enumerate(args_list):
+                self.depths = {'pending': len(args_list) - i - 1, 'running': 1}
+                yield i, function(*args)
+            self.depths = {'pending': 0, 'running': 0}
+            return
+
+        import concurrent.futures
+
+        pending = collections.deque(sorted(range(len(args_list)), key=lambda i: -sizes[i]))
+        pool_budget = self.get_pool_budget()
+
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=n_workers, initializer=lower_priority, initargs=(self.nice, self.ionice)
+        ) as executor:
+            running = {}
+            in_use = 0
+
+            while pending or running:
+                while pending and (
+                    (not running)
+                    or (pool_budget is None)
+                    or (in_use + self.estimate(sizes[pending[0]]) <= pool_budget)
+                ):
+                    i = pending.popleft()
+                    running[executor.submit(function, *args_list[i])] = i
+                    in_use += self.estimate(sizes[i])
+
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+
+                for future in done:
+                    i = running.pop(future)
+                    in_use -= self.estimate(sizes[i])
+                    self.depths = {'pending': len(pending), 'running': len(running)}
+                    yield i, future.result()
+
+
+def get_idle_cores() -> int:
+    """
+    Cores available to this process minus the 1 minute load average
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        n_cores = len(os.sched_getaffinity(0))
+    else:
+        n_cores = os.cpu_count() or 1
+
+    try:
+        load = os.getloadavg()[0]
+    except (AttributeError, OSError):
+        load = 0.0
+
+    return max(1, min(n_cores, round(n_cores - load)))
+
+
+def get_default_memory_budget() -> int:
+    """
+    Half of the available memory; None if unknown
+    """
+    try:
+        for line in pathlib.Path('/proc/meminfo').read_text().splitlines():
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1]) * 1024 // 2
+    except (OSError, ValueError, IndexError):
+        pass
+
+    return None
+
+
+def lower_priority(nice:int=None, ionice:bool=False):
+    """
+    Initializer of the worker processes; the main process keeps its priority
+    """
+    if nice:
+        os.nice(nice)
+
+    # idle io class, where supported
+    if ionice and shutil.which('ionice'):
+        subprocess.run(
+            ['ionice', '-c', '3', '-p', str(os.getpid())],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False
+        )
+
+
+class GitBackend(abc.ABC):
+    """
+    Git access of the 'plumbing' engine
+
+    Use as a context manager;
+    a backend missing any of the abstract methods fails when instantiated
+    """
+
+    def __init__(self, repo:pathlib.Path):
+        self.repo = repo
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        pass
+
+    @abc.abstractmethod
+    def list_range(self, start_parent:str, end:str) -> Tuple[str]:
+        """
+        Commits reachable from end but not from start_parent, oldest first, as `git log --reverse`
+        """
+
+    @abc.abstractmethod
+    def get_commit_info(self, commit:str) -> Dict[str, str]:
+        """
+        Same as git_show_info()
+        """
+
+    @abc.abstractmethod
+    def get_tree(self, commit:str) -> str:
+        ...
+
+    @abc.abstractmethod
+    def get_changes(self, commit:str, base:str=None) -> Tuple[Dict[str, str]]:
+        """
+        Same as git_diff_tree_raw()
+        With base, the changes from base to the commit, as git_diff_trees_raw()
+        """
+
+    @abc.abstractmethod
+    def read_blob(self, sha:str) -> bytes:
+        ...
+
+    def read_blob_to_file(self, sha:str, path:pathlib.Path):
+        pathlib.Path(path).write_bytes(self.read_blob(sha))
+
+    def get_blob_sizes(self, shas:List[str]) -> Tuple[int]:
+        """
+        Size of each blob, reading one blob at a time
+        """
+        return tuple(len(self.read_blob(sha)) for sha in shas)
+
+    @abc.abstractmethod
+    def write_blobs(self, paths:List[pathlib.Path]) -> Tuple[str]:
+        """
+        Write the files as they are, without filters
+        """
+
+    @abc.abstractmethod
+    def update_tree(self, tree:str, changes:List[Tuple[str, str, str]]) -> str:
+        """
+        Write a new tree applying the (mode, sha, path) changes to the tree
+        Mode '0' removes the path
+        """
+
+    @abc.abstractmethod
+    def create_commit(self, tree:str, parent:str, commit_info:Dict[str, str]) -> str:
+        ...
+
+    @abc.abstractmethod
+    def create_ref(self, ref:str, sha:str):
+        """
+        The ref must not exist yet
+        """
+
+
+class SubprocessBackend(GitBackend):
+    """
+    One git process per call
+
+    A temporary index file holds the last written tree.
+    """
+
+    def __init__(self, repo:pathlib.Path):
+        super().__init__(repo)
+
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.index_env = get_index_env(pathlib.Path(self.tmp_dir.name) / 'index')
+        self.index_tree = None
+
+    def close(self):
+        self.tmp_dir.cleanup()
+
+    def list_range(self, start_parent:str, end:str) -> Tuple[str]:
+        return git_log_hash(repo=self.repo, start_parent=start_parent, end=end)
+
+    def get_commit_info(self, commit:str) -> Dict[str, str]:
+        return git_show_info(repo=self.repo, commit=commit)
+
+    def get_tree(self, commit:str) -> str:
+        return git_rev_parse(self.repo, commit + '^{tree}')
+
+    def get_changes(self, commit:str, base:str=None) -> Tuple[Dict[str, str]]:
+        if base is None:
+            return git_diff_tree_raw(repo=self.repo, commit=commit)
+
+        return git_diff_trees_raw(repo=self.repo, tree_a=base, tree_b=commit)
+
+    def read_blob(self, sha:str) -> bytes:
+        return git_cat_file_blob(self.repo, sha)
+
+    def read_blob_to_file(self, sha:str, path:pathlib.Path):
+        # streamed by git itself
+        with open(path, 'wb') as f:
+            subprocess.run(get_cat_file_blob_cmd(sha), cwd=self.repo, stdout=f, check=True)
+
+    def get_blob_sizes(self, shas:List[str]) -> Tuple[int]:
+        return git_cat_file_sizes(self.repo, shas)
+
+    def write_blobs(self, paths:List[pathlib.Path]) -> Tuple[str]:
+        return git_hash_objects_w(repo=self.repo, paths=paths, no_filters=True)
+
+    def update_tree(self, tree:str, changes:List[Tuple[str, str, str]]) -> str:
+        if tree != self.index_tree:
+            check_output(get_read_tree_cmd(tree), repo=self.repo, env=self.index_env)
+
+        git_update_index_info(
+            repo=self.repo,
+            lines=[get_index_info_line(*change) for change in changes],
+            env=self.index_env
+        )
+
+        self.index_tree = check_output(get_write_tree_cmd(), repo=self.repo, env=self.index_env).strip()
+
+        return self.index_tree
+
+    def create_commit(self, tree:str, parent:str, commit_info:Dict[str, str]) -> str:
+        return git_commit_tree(repo=self.repo, tree=tree, parent=parent, commit_info=commit_info)
+
+    def create_ref(self, ref:str, sha:str):
+        git_create_ref(self.repo, ref, sha)
+
+
+class DulwichBackend(GitBackend):
+    """
+    In-process git access with dulwich; no process per commit
+
+    Writes the same commits as SubprocessBackend
+    """
+
+    def __init__(self, repo:pathlib.Path):
+        super().__init__(repo)
+
+        try:
+            import dulwich.repo
+        except ImportError as e:
+            raise ImportError("the dulwich backend needs `pip install dulwich`") from e
+
+        self.dulwich_repo = dulwich.repo.Repo(str(repo))
+        self.store = self.dulwich_repo.object_store
+
+    def close(self):
+        self.dulwich_repo.close()
+
+    def list_range(self, start_parent:str, end:str) -> Tuple[str]:
+        walker = self.dulwich_repo.get_walker(include=[end.encode()], exclude=[start_parent.encode()])
+
+        return tuple(reversed([entry.commit.id.decode() for entry in walker]))
+
+    def get_commit_info(self, commit:str) -> Dict[str, str]:
+        c = self.store[commit.encode()]
+
+        author, author_email = split_identity(c.author.decode())
+        committer, committer_email = split_identity(c.committer.decode())
+
+        return {
+            "sha": commit,
+            "author": author,
+            "author_email": author_email,
+            "date": format_git_date(c.author_time, c.author_timezone),
+            "committer": committer,
+            "committer_email": committer_email,
+            "commit_date": format_git_date(c.commit_time, c.commit_timezone),
+            # as get_commit_info_from_show() reads `git show`
+            "message": '\n'.join(map(lambda s: s.strip(), c.message.decode().splitlines())).strip(),
+        }
+
+    def get_tree(self, commit:str) -> str:
+        return self.store[commit.encode()].tree.decode()
+
+    def get_changes(self, commit:str, base:str=None) -> Tuple[Dict[str, str]]:
+        from dulwich.diff_tree import tree_changes
+
+        c = self.store[commit.encode()]
+
+        if base is not None:
+            parent_tree = self.store[base.encode()].tree
+        elif 1 != len(c.parents):
+            # `git diff-tree` shows nothing for root and merge commits
+            return tuple()
+        else:
+            parent_tree = self.store[c.parents[0]].tree
+
+        result = []
+
+        for change in tree_changes(self.store, parent_tree, c.tree):
+            # a missing side is None or an entry of Nones depending on the dulwich version
+            old_mode, old_sha = (change.old.mode, change.old.sha) if getattr(change.old, 'path', None) else (0, None)
+            new_mode, new_sha = (change.new.mode, change.new.sha) if getattr(change.new, 'path', None) else (0, None)
+
+            if new_sha is None:
+                status, path = 'D', change.old.path
+            elif old_sha is None:
+                status, path = 'A', change.new.path
+            else:
+                status, path = 'M', change.new.path
+
+            result.append({
+                'old_mode': f'{old_mode:06o}',
+                'new_mode': f'{new_mode:06o}',
+                'old_sha': (old_sha or b'0' * 40).decode(),
+                'new_sha': (new_sha or b'0' * 40).decode(),
+                'status': status,
+                'path': path.decode(),
+            })
+
+        return tuple(result)
+
+    def read_blob(self, sha:str) -> bytes:
+        return self.store[sha.encode()].as_raw_string()
+
+    def write_blobs(self, paths:List[pathlib.Path]) -> Tuple[str]:
+        from dulwich.objects import Blob
+
+        result = []
+
+        for path in paths:
+            blob = Blob.from_string(pathlib.Path(path).read_bytes())
+            self.store.add_object(blob)
+            result.append(blob.id.decode())
+
+        return tuple(result)
+
+    def update_tree(self, tree:str, changes:List[Tuple[str, str, str]]) -> str:
+        from dulwich.object_store import commit_tree_changes
+
+        dulwich_changes = []
+
+        for mode, sha, path in changes:
+            if '0' == mode:
+                dulwich_changes.append((path.encode(), None, None))
+            else:
+                dulwich_changes.append((path.encode(), int(mode, 8), sha.encode()))
+
+        new_tree = commit_tree_changes(self.store, self.store[tree.encode()], dulwich_changes)
+
+        # a Tree in older dulwich
+        return getattr(new_tree, 'id', new_tree).decode()
+
+    def create_commit(self, tree:str, parent:str, commit_info:Dict[str, str]) -> str:
+        from dulwich.objects import Commit
+
+        c = Commit()
+        c.tree = tree.encode()
+        c.parents = [parent.encode()]
+        c.author = f'{commit_info["author"]} <{commit_info["author_email"]}>'.encode()
+        c.author_time, c.author_timezone = parse_git_date(commit_info["date"])
+        c.committer = f'{commit_info["committer"]} <{commit_info["committer_email"]}>'.encode()
+        c.commit_time, c.commit_timezone = parse_git_date(commit_info["commit_date"])
+        c.message = get_clean_message(commit_info["message"]).encode()
+
+        self.store.add_object(c)
+
+        return c.id.decode()
+
+    def create_ref(self, ref:str, sha:str):
+        assert self.dulwich_repo.refs.add_if_new(ref.encode(), sha.encode()), ref
+
+
+def get_backends() -> Dict[str, type]:
+    return {
+        'subprocess': SubprocessBackend,
+        'dulwich': DulwichBackend,
+    }
+
+
+def split_identity(identity:str) -> Tuple[str, str]:
+    """
+    'name <email>' -> ('name', 'email')
+    """
+    name, email = identity.rsplit('<', 1)
+    return name.strip(), email.strip().rstrip('>')
+
+
+def format_git_date(timestamp:int, tz_offset:int) -> str:
+    """
+    As `git show` prints : 'Wed Jan 18 20:57:54 2023 +0900'
+    """
+    t = time.gmtime(timestamp + tz_offset)
+
+    sign = '-' if tz_offset < 0 else '+'
+    minutes = abs(tz_offset) // 60
+
+    weekday = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')[t.tm_wday]
+    month = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')[t.tm_mon - 1]
+
+    return (
+        f'{weekday} {month} {t.tm_mday} {t.tm_hour:02d}:{t.tm_min:02d}:{t.tm_sec:02d} {t.tm_year} '
+        f'{sign}{minutes // 60:02d}{minutes % 60:02d}'
+    )
+
+
+def parse_git_date(date:str) -> Tuple[int, int]:
+    """
+    'Wed Jan 18 20:57:54 2023 +0900' -> (timestamp, offset in seconds)
+    """
+    fields = date.split()
+    month = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec').index(fields[1]) + 1
+    day = int(fields[2])
+    hour, minute, second = map(int, fields[3].split(':'))
+    year = int(fields[4])
+
+    tz = fields[5]
+    tz_offset = (1 if '+' == tz[0] else -1) * (int(tz[1:3]) * 3600 + int(tz[3:5]) * 60)
+
+    timestamp = calendar.timegm((year, month, day, hour, minute, second)) - tz_offset
+
+    return timestamp, tz_offset
+
+
+class Verifier:
+    """
+    How much of the processed ipynb to verify
+
+    level
+    =====
+        * 'none' : no verification
+        * 'sample' : one out of sample_rate original blobs, chosen by the blob sha
+        * 'full' : every original blob
+        * 'nbconvert' : every original blob, comparing `jupyter nbconvert --to python` outputs
+        * 'deferred' : record the code and markdown fingerprint of every original blob
+            and audit the whole rewritten range at the end
+
+    'sample' and 'full' compare the code and markdown in-process, see get_notebook_text();
+    'nbconvert' runs the jupyter stack twice for each blob.
+
+    Before, 'full' was the `jupyter nbconvert --to python` round-trip;
+    now it compares nothing but the code and markdown. 'nbconvert' is the old check.
+
+    The same original blob is verified only once.
+    """
+
+    levels = ('none', 'sample', 'full', 'deferred', 'nbconvert')
+
+    def __init__(self, level:str='full', sample_rate:int=10, max_workers:int=None):
+        assert level in self.levels, level
+
+        self.level = level
+        self.sample_rate = sample_rate
+        self.max_workers = max_workers
+
+        self.verified = set()
+        self.fingerprints = {}
+        self.mismatches = []
+
+    def verify(self, src_ipynb_path:pathlib.Path, dest_ipynb_path:pathlib.Path, blob_sha:str) -> bool:
+        if 'none' == self.level:
+            return True
+
+        if 'deferred' == self.level:
+            if blob_sha not in self.fingerprints:
+                self.fingerprints[blob_sha] = get_notebook_fingerprint(
+                    json.loads(src_ipynb_path.read_text(encoding="utf-8"))
+                )
+            return True
+
+        if blob_sha in self.verified:
+            return True
+
+        if ('sample' == self.level) and (not is_sampled(blob_sha, self.sample_rate)):
+            return True
+
+        if 'nbconvert' == self.level:
+            result = verify_processed_ipynb(src_ipynb_path, dest_ipynb_path)
+        else:
+            result = is_same_notebook_text(src_ipynb_path, dest_ipynb_path)
+
+        if result:
+            self.verified.add(blob_sha)
+
+        return result
+
+
+def is_same_notebook_text(src_ipynb_path:pathlib.Path, dest_ipynb_path:pathlib.Path) -> bool:
+    return get_notebook_text(
+        json.loads(src_ipynb_path.read_text(encoding="utf-8"))
+    ) == get_notebook_text(
+        json.loads(dest_ipynb_path.read_text(encoding="utf-8"))
+    )
+
+
+def is_sampled(blob_sha:str, sample_rate:int) -> bool:
+    # the same blobs every run
+    return 0 == (int(blob_sha[:8], 16) % sample_rate)
+
+
+def finish_verification(repo:pathlib.Path, sha_map:Dict[str, str], verifier:Verifier, reporter:'ProgressReporter', groups:Tuple[Tuple[str]]=None, start_parent:str=None):
+    if 'deferred' == verifier.level:
+        with reporter.stage('audit'):
+            verifier.mismatches = audit_rewrite(
+                repo, sha_map, fingerprints=verifier.fingerprints, max_workers=verifier.max_workers,
+                groups=groups, start_parent=start_parent,
+            )
+
+
+def audit_rewrite(repo:pathlib.Path, sha_map:Dict[str, str], fingerprints:Dict[str, str]=None, max_workers:int=None, groups:Tuple[Tuple[str]]=None, start_parent:str=None) -> List[Dict[str, str]]:
+    """
+    Compare the code and markdown of every ipynb changed by the original commits
+    with the same path in the rewritten commits, in parallel
+
+    fingerprints : known fingerprints of the original blobs
+
+    groups : commits coalesced into one rewritten commit, see get_coalesced_groups()
+        (default: one by one); a group is compared as the range from the commit before it,
+        start_parent for the first group, to its last commit
+
+    Returns all the mismatches
+    """
+    import concurrent.futures
+
+    if fingerprints is None:
+        fingerprints = {}
+
+    if groups is None:
+        groups = tuple((commit,) for commit in sha_map)
+
+    bases = get_group_bases(groups, start_parent)
+
+    assert (start_parent is not None) or all(1 == len(group) for group in groups[:1]), "start_parent of the first group"
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [
+            pool.submit(audit_a_commit, repo, group[-1], sha_map[group[-1]], fingerprints, base)
+            for group, base in zip(groups, bases)
+        ]
+
+        return [mismatch for f in futures for mismatch in f.result()]
+
+
+def audit_a_commit(repo:pathlib.Path, commit:str, new_commit:str, fingerprints:Dict[str, str], base:str=None) -> List[Dict[str, str]]:
+    if base is None:
+        entries = tuple(filter(is_ipynb_entry, git_diff_tree_raw(repo=repo, commit=commit)))
+    else:
+        entries = tuple(filter(is_ipynb_entry, git_diff_trees_raw(repo=repo, tree_a=base, tree_b=commit)))
+
+    if not entries:
+        return []
+
+    # original blobs without fingerprints and the rewritten blobs, in one git call
+    unknown_shas = sorted(set(e['new_sha'] for e in entries if e['new_sha'] not in fingerprints))
+    new_revs = [f"{new_commit}:{e['path']}" for e in entries]
+
+    contents = get_cat_file_batch_objects(
+        check_output(
+            get_cat_file_batch_cmd(),
+            repo=repo,
+            input=''.join(map(lambda rev: f'{rev}\n', unknown_shas + new_revs)).encode(),
+            encoding=None
+        )
+    )
+
+    known = dict(fingerprints)
+    for sha, content in contents[:len(unknown_shas)]:
+        known[sha] = get_notebook_fingerprint(json.loads(content))
+
+    mismatches = []
+
+    for entry, (_, new_content) in zip(entries, contents[len(unknown_shas):]):
+        if (new_content is None) or (known[entry['new_sha']] != get_notebook_fingerprint(json.loads(new_content))):
+            mismatches.append({'commit': commit, 'new_commit': new_commit, 'path': entry['path']})
+
+    return mismatches
+
+
+def get_notebook_fingerprint(ipynb_json:Dict) -> str:
+    return hashlib.sha256(get_notebook_text(ipynb_json).encode()).hexdigest()
+
+
+def get_notebook_text(ipynb_json:Dict) -> str:
+    """
+    Code and markdown of the notebook, in-process
+    """
+    lines = []
+
+    for cell in ipynb_json["cells"]:
+        if cell.get("cell_type") in ("code", "markdown"):
+            source = cell.get("source", "")
+            if isinstance(source, list):
+                source = ''.join(source)
+
+            lines.append(f'# In[{cell["cell_type"]}]:')
+            lines.append(source)
+            lines.append('')
+
+    return '\n'.join(lines)
+
+
+def textconv_notebook(ipynb_path:pathlib.Path, cache:'BlobCache'=None) -> str:
+    """
+    Code and markdown of the notebook for `git diff` and `git log -p`
+
+    The cache is keyed by the git blob sha of the file content.
+    """
+    content = pathlib.Path(ipynb_path).read_bytes()
+
+    if cache is None:
+        return get_textconv_text(content)
+
+    blob_sha = get_git_blob_sha(content)
+
+    cached = cache.get(blob_sha)
+
+    if cached is not None:
+        return cached.decode('utf-8')
+
+    text = get_textconv_text(content)
+    cache.put(blob_sha, text.encode('utf-8'))
+
+    return text
+
+
+def get_textconv_text(content:bytes) -> str:
+    """
+    The content as it is if not a v4 notebook
+    """
+    try:
+        return get_notebook_text(json.loads(content))
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return content.decode('utf-8', errors='replace')
+
+
+def get_git_blob_sha(content:bytes) -> str:
+    """
+    Same as `git hash-object`, without a git process
+    """
+    return hashlib.sha1(b'blob %d\0' % len(content) + content).hexdigest()
+
+
+def install_textconv(repo:pathlib.Path, driver:str='ipynb', cache_folder:pathlib.Path=None):
+    """
+    Register the textconv diff driver for *.ipynb files of the repository
+
+    Git keeps the converted text in refs/notes/textconv/<driver> with cachetextconv;
+    the blob cache in the git directory also serves the working tree files and other drivers.
+    The attribute goes to info/attributes not to change any tracked file;
+    both in the common git directory, the only one git reads info/attributes from,
+    shared with the linked worktrees.
+    """
+    git_dir = get_git_common_dir(repo)
+
+    if cache_folder is None:
+        cache_folder = git_dir / 'rebase_ipynb' / 'textconv'
+
+    textconv_cmd = ' '.join(
+        map(shlex.quote, (sys.executable, str(pathlib.Path(__file__).resolve()), 'textconv', '--cache', str(cache_folder)))
+    )
+
+    check_output(['git', 'config', f'diff.{driver}.textconv', textconv_cmd], repo=repo)
+    check_output(['git', 'config', f'diff.{driver}.cachetextconv', 'true'], repo=repo)
+
+    attributes_path = git_dir / 'info' / 'attributes'
+    attribute = f'*.ipynb diff={driver}'
+
+    lines = attributes_path.read_text(encoding="utf-8").splitlines() if attributes_path.exists() else []
+
+    if attribute not in lines:
+        attributes_path.parent.mkdir(parents=True, exist_ok=True)
+        attributes_path.write_text('\n'.join(lines + [attribute]) + '\n', encoding="utf-8")
+
+
+def compare_rewrites(repo:pathlib.Path, first_commit:str, last_commit:str, configs:Tuple[Dict, Dict], branches:Tuple[str, str]=('determinism-a', 'determinism-b')) -> Dict:
+    """
+    Rewrite the range with two configurations and compare the results commit by commit
+
+    configs : keyword arguments of process_commits(), one dict for each rewrite
+    branches : new branch of each rewrite; left in place for inspection
+
+    Returns the number of commits compared and the first divergence, if any
+    """
+    sha_maps = [
+        process_commits(repo, first_commit, last_commit, branch, **config)
+        for config, branch in zip(configs, branches)
+    ]
+
+    return {
+        'identical': sha_maps[0] == sha_maps[1],
+        'commits': len(sha_maps[0]),
+        'branches': list(branches),
+        'divergence': get_first_divergence(repo, *sha_maps),
+    }
+
+
+def get_first_divergence(repo:pathlib.Path, sha_map_a:Dict[str, str], sha_map_b:Dict[str, str]) -> Dict:
+    """
+    First original commit rewritten differently, with the commit, tree and blob shas on both sides
+
+    The diff is between the pretty printed notebooks if the first differing path is an ipynb file,
+    between the commit objects if only the commit metadata differ.
+    None if all the rewritten commits are the same
+    """
+    for commit, new_commit_a in sha_map_a.items():
+        new_commit_b = sha_map_b.get(commit)
+
+        if new_commit_a == new_commit_b:
+            continue
+
+        divergence = {'commit': commit, 'new_commit_a': new_commit_a, 'new_commit_b': new_commit_b}
+
+        if new_commit_b is None:
+            return divergence
+
+        divergence['tree_a'] = git_rev_parse(repo, new_commit_a + '^{tree}')
+        divergence['tree_b'] = git_rev_parse(repo, new_commit_b + '^{tree}')
+
+        if divergence['tree_a'] == divergence['tree_b']:
+            objects = git_cat_file_batch(repo, [new_commit_a, new_commit_b])
+            divergence['diff'] = get_text_diff(
+                objects[new_commit_a].decode(), objects[new_commit_b].decode(), 'commit'
+            )
+            return divergence
+
+        entry = git_diff_trees_raw(repo, divergence['tree_a'], divergence['tree_b'])[0]
+
+        divergence['path'] = entry['path']
+        divergence['blob_a'] = entry['old_sha']
+        divergence['blob_b'] = entry['new_sha']
+
+        if is_ipynb_entry(entry) and (entry['status'] not in 'AD'):
+            objects = git_cat_file_batch(repo, [entry['old_sha'], entry['new_sha']])
+            divergence['diff'] = get_text_diff(
+                get_pretty_notebook(objects[entry['old_sha']]),
+                get_pretty_notebook(objects[entry['new_sha']]),
+                entry['path']
+            )
+
+        return divergence
+
+    return None
+
+
+def get_pretty_notebook(content:bytes) -> str:
+    """
+    One json item per line, keys sorted, so that the diff shows the notebook fields
+    """
+    return json.dumps(json.loads(content), indent=1, sort_keys=True, ensure_ascii=False)
+
+
+def get_text_diff(text_a:str, text_b:str, name:str) -> str:
+    return ''.join(
+        difflib.unified_diff(
+            text_a.splitlines(keepends=True), text_b.splitlines(keepends=True),
+            fromfile=f'a/{name}', tofile=f'b/{name}'
+        )
+    )
+
+
+class ProgressReporter:
+    """
+    Progress of a run as json lines events and a prometheus textfile
+
+    Without an event stream or a textfile, only counts.
+
+    events : text stream, for example sys.stderr
+    prometheus_path : file for the textfile collector of the node exporter
+    """
+
+    def __init__(self, events=None, prometheus_path:pathlib.Path=None, labels:Dict[str, str]=None):
+        self.events = events
+        self.prometheus_path = None if prometheus_path is None else pathlib.Path(prometheus_path)
+        self.labels = dict(labels or {})
+
+        self.n_commits = 0
+        self.commits_done = 0
+        self.notebooks = 0
+        self.cache_hits = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.stage_seconds = {}
+
+        self.start_time = time.monotonic()
+
+    def start(self, new_branch:str, n_commits:int):
+        self.labels.setdefault('branch', new_branch)
+        self.n_commits = n_commits
+        self.start_time = time.monotonic()
+
+        self.emit('start')
+
+    @contextlib.contextmanager
+    def stage(self, name:str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_seconds[name] = self.stage_seconds.get(name, 0.0) + (time.perf_counter() - start)
+
+    def notebook_done(self, bytes_in:int, bytes_out:int):
+        self.notebooks += 1
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+
+    def cache_hit(self):
+        self.cache_hits += 1
+
+    def commit_done(self, commit:str, new_commit:str):
+        self.commits_done += 1
+
+        self.emit('commit', commit=commit, new_commit=new_commit)
+
+    def finish(self):
+        self.emit('finish')
+
+    def get_eta_seconds(self) -> float:
+        if 0 == self.commits_done:
+            return None
+
+        elapsed = time.monotonic() - self.start_time
+
+        return elapsed / self.commits_done * (self.n_commits - self.commits_done)
+
+    def get_state(self) -> Dict:
+        return {
+            'commits_done': self.commits_done,
+            'commits_remaining': self.n_commits - self.commits_done,
+            'notebooks': self.notebooks,
+            'cache_hits': self.cache_hits,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'stage_seconds': dict(self.stage_seconds),
+            'elapsed_seconds': time.monotonic() - self.start_time,
+            'eta_seconds': self.get_eta_seconds(),
+        }
+
+    def emit(self, event:str, **info):
+        if (self.events is None) and (self.prometheus_path is None):
+            return
+
+        state = self.get_state()
+
+        if self.events is not None:
+            record = {'event': event, 'time': time.time(), **self.labels, **info, **state}
+            self.events.write(json.dumps(record) + '\n')
+            self.events.flush()
+
+        if self.prometheus_path is not None:
+            write_prometheus_textfile(self.prometheus_path, state, self.labels)
+
+
+def write_prometheus_textfile(path:pathlib.Path, state:Dict, labels:Dict[str, str]):
+    """
+    Write then rename so that the collector never reads a partial file
+    """
+    tmp_path = path.with_name(path.name + f'.{os.getpid()}.tmp')
+    tmp_path.write_text(get_prometheus_text(state, labels), encoding="utf-8")
+    os.replace(tmp_path, path)
+
+
+def get_prometheus_text(state:Dict, labels:Dict[str, str]) -> str:
+    def metric(name:str, value, extra:Dict[str, str]=None, kind:str='gauge') -> List[str]:
+        all_labels = {**labels, **(extra or {})}
+        label_txt = ','.join(f'{k}="{v}"' for k, v in sorted(all_labels.items()))
+        return [
+            f'# TYPE rebase_ipynb_{name} {kind}',
+            f'rebase_ipynb_{name}{{{label_txt}}} {value}',
+        ]
+
+    lines = []
+    lines += metric('commits_done', state['commits_done'], kind='counter')
+    lines += metric('commits_remaining', state['commits_remaining'])
+    lines += metric('notebooks_total', state['notebooks'], kind='counter')
+    lines += metric('cache_hits_total', state['cache_hits'], kind='counter')
+    lines += metric('bytes_in_total', state['bytes_in'], kind='counter')
+    lines += metric('bytes_out_total', state['bytes_out'], kind='counter')
+
+    lines.append('# TYPE rebase_ipynb_stage_seconds_total counter')
+    for stage, seconds in sorted(state['stage_seconds'].items()):
+        lines += metric('stage_seconds_total', seconds, {'stage': stage}, kind='counter')[1:]
+
+    if state['eta_seconds'] is not None:
+        lines += metric('eta_seconds', state['eta_seconds'])
+
+    # for stall alerts : time() - last_progress_timestamp_seconds
+    lines += metric('last_progress_timestamp_seconds', time.time())
+
+    return '\n'.join(lines) + '\n'
+
+
+class BlobCache:
+    """
+    Processed ipynb contents keyed by the sha of the original blob
+
+    Git blob shas depend only on the content,
+    so one cache folder can be shared by many repositories and processes.
+    """
+
+    def __init__(self, folder:pathlib.Path):
+        self.folder = pathlib.Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    def get_path(self, blob_sha:str) -> pathlib.Path:
+        return self.folder / blob_sha[:2] / blob_sha[2:]
+
+    def get(self, blob_sha:str) -> bytes:
+        path = self.get_path(blob_sha)
+
+        if path.exists():
+            self.hits += 1
+            return path.read_bytes()
+        else:
+            self.misses += 1
+            return None
+
+    def copy_outputs(self, names:Tuple[str], folder:pathlib.Path) -> Tuple[pathlib.Path]:
+        """
+        Copy the externalized output files stored with the cached notebook
+        """
+        result = []
+
+        for name in names:
+            if not folder.exists():
+                folder.mkdir(parents=True)
+            shutil.copy(self.get_path(name), folder / name)
+            result.append(folder / name)
+
+        return tuple(result)
+
+    def put(self, blob_sha:str, content:bytes):
+        path = self.get_path(blob_sha)
+        path.parent.mkdir(exist_ok=True)
+
+        # other processes may be reading : write then rename
+        with tempfile.NamedTemporaryFile(dir=path.parent, delete=False) as f:
+            f.write(content)
+
+        os.replace(f.name, path)
+
+
+def get_cache_key(blob_sha:str, clean_options:Dict) -> str:
+    """
+    The blob sha itself with the default options
+    """
+    output_options = get_output_options(clean_options)
+
+    if output_options == get_output_options(get_clean_options()):
+        return blob_sha
+    else:
+        return hashlib.sha1(
+            (blob_sha + json.dumps(output_options, sort_keys=True)).encode()
+        ).hexdigest()
+
+
+def process_fleet(jobs:List[Dict[str, str]], cache_folder:pathlib.Path, max_workers:int=None, nice:int=None, ionice:bool=False) -> List[Dict]:
+    """
+    Process the jobs of many repositories in one worker pool
+    sharing one blob cache
+
+    nice, ionice : lower the priority of the worker processes, see lower_priority();
+        the nice and ionice of a job apply to its own workers on top of these
+
+    Returns the summary of each job
+    """
+    import concurrent.futures
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, initializer=lower_priority, initargs=(nice, ionice)) as pool:
+        futures = [
+            pool.submit(process_fleet_job, job, cache_folder)
+            for job in jobs
+        ]
+
+        return [f.result() for f in futures]
+
+
+def process_fleet_job(job:Dict[str, str], cache_folder:pathlib.Path) -> Dict:
+    """
+    Errors are reported in the summary so that the other jobs can go on
+    """
+    cache = BlobCache(cache_folder)
+
+    summary = dict(job)
+
+    start = time.perf_counter()
+
+    try:
+        sha_map = process_commits(
+            pathlib.Path(job['repo']), job['first'], job['last'], job['branch'],
+            drop_empty=job.get('drop_empty', False),
+            engine=job.get('engine', 'plumbing'),
+            backend=job.get('backend', 'subprocess'),
+            job=job.get('job'),
+            jobs=job.get('jobs'),
+            memory_budget=job.get('memory_budget'),
+            nice=job.get('nice'),
+            ionice=job.get('ionice', False),
+            coalesce_window=job.get('coalesce_window'),
+            cache=cache,
+        )
+    except Exception as e:
+        summary['status'] = 'error'
+        summary['error'] = repr(e)
+    else:
+        summary['status'] = 'ok'
+        summary['commits'] = len(sha_map)
+        summary['new_commits'] = len(set(sha_map.values()))
+        summary['head'] = sha_map[tuple(sha_map)[-1]]
+
+    summary['cache_hits'] = cache.hits
+    summary['cache_misses'] = cache.misses
+    summary['seconds'] = time.perf_counter() - start
+
+    return summary
+
+
+def read_fleet_manifest(manifest_path:pathlib.Path) -> List[Dict[str, str]]:
+    """
+    One json object per line : repo, first, last, branch,
+    optionally drop_empty, engine, backend, job, jobs, memory_budget (bytes), nice, ionice and coalesce_window
+
+    Relative repo paths are relative to the manifest file
+    """
+    jobs = []
+
+    for line in manifest_path.read_text(encoding="utf-8").splitlines():
+        if line.strip():
+            job = json.loads(line)
+            job['repo'] = str((manifest_path.parent / job['repo']).resolve())
+            jobs.append(job)
+
+    return jobs
+
+
+def normalize_notebooks(root:pathlib.Path, paths:List[str]=None, cache_path:pathlib.Path=None, clean_options:Dict=None, max_workers:int=None, governor:'ResourceGovernor'=None) -> Dict[str, List[str]]:
+    """
+    Clean the notebooks of a working tree in place, for pre-commit use
+
+    paths : notebooks relative to the root (default: all tracked and untracked, not ignored, ipynb files)
+    cache_path : stat cache (default: rebase_ipynb/normalize.json in the git directory)
+    governor : worker pool and memory budget (default: up to max_workers processes)
+
+    Like the stat data of the git index, the stat cache keeps
+    the mtime, size, inode and content hash of each cleaned notebook;
+    only the notebooks whose stat changed are read again.
+
+    Returns the relative paths of the 'modified', 'unchanged' and 'skipped' notebooks
+    """
+    root = pathlib.Path(root)
+    clean_options = get_clean_options(**(clean_options or {}))
+
+    if cache_path is None:
+        cache_path = get_git_dir(root) / 'rebase_ipynb' / 'normalize.json'
+
+    cache = read_stat_cache(cache_path, clean_options)
+    dirty = False
+
+    if paths is None:
+        paths = tuple(filter(lambda path: (root / path).is_file(), git_ls_ipynb_files(root)))
+
+        for path in set(cache['entries']) - set(paths):
+            del cache['entries'][path]
+            dirty = True
+
+    result = {'modified': [], 'unchanged': [], 'skipped': []}
+
+    candidates = []
+
+    for path in paths:
+        st = os.stat(root / path)
+        entry = cache['entries'].get(path)
+
+        if is_stat_clean(entry, st, cache['mtime_ns']):
+            result['skipped'].append(path)
+        elif (entry is not None) and (entry['sha256'] == get_file_sha256(root / path)):
+            # touched but the same content : refresh the stat only
+            cache['entries'][path] = get_stat_entry(st, entry['sha256'])
+            result['skipped'].append(path)
+            dirty = True
+        else:
+            candidates.append(path)
+
+    if governor is None:
+        governor = ResourceGovernor(max_workers=max_workers)
+
+    normalized = governor.map(
+        normalize_a_notebook,
+        [os.stat(root / path).st_size for path in candidates],
+        [root / path for path in candidates],
+        [clean_options] * len(candidates),
+        [root / clean_options['externalize_folder']] * len(candidates),
+    )
+
+    for path, (modified, entry) in zip(candidates, normalized):
+        cache['entries'][path] = entry
+        result['modified' if modified else 'unchanged'].append(path)
+
+    if candidates or dirty:
+        write_stat_cache(cache_path, cache)
+
+    return result
+
+
+def normalize_a_notebook(ipynb_path:pathlib.Path, clean_options:Dict, outputs_folder:pathlib.Path) -> Tuple[bool, Dict]:
+    """
+    Returns whether the notebook changed and its stat cache entry
+    """
+    before = ipynb_path.read_bytes()
+
+    process_ipynb(ipynb_path, clean_options, outputs_folder)
+
+    after = ipynb_path.read_bytes()
+
+    return (after != before), get_stat_entry(os.stat(ipynb_path), hashlib.sha256(after).hexdigest())
+
+
+def get_stat_entry(st:os.stat_result, sha256:str) -> Dict:
+    return {'mtime_ns': st.st_mtime_ns, 'size': st.st_size, 'ino': st.st_ino, 'sha256': sha256}
+
+
+def is_stat_clean(entry:Dict, st:os.stat_result, cache_mtime_ns:int) -> bool:
+    """
+    As git does with its index, the stat of a file not older than the cache file
+    is not trusted : the file may have changed again within the same timestamp
+    """
+    return (
+        (entry is not None)
+        and (entry['mtime_ns'] == st.st_mtime_ns)
+        and (entry['size'] == st.st_size)
+        and (entry['ino'] == st.st_ino)
+        and (st.st_mtime_ns < cache_mtime_ns)
+    )
+
+
+def get_file_sha256(path:pathlib.Path) -> str:
+    return hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+def read_stat_cache(cache_path:pathlib.Path, clean_options:Dict) -> Dict:
+    """
+    An empty cache if missing, unreadable or written with other clean options
+    """
+    options = json.dumps(get_output_options(clean_options), sort_keys=True)
+
+    try:
+        cache = json.loads(cache_path.read_text(encoding="utf-8"))
+        cache_mtime_ns = os.stat(cache_path).st_mtime_ns
+    except (OSError, ValueError):
+        cache = None
+
+    if (not isinstance(cache, dict)) or (options != cache.get('options')):
+        return {'options': options, 'entries': {}, 'mtime_ns': 0}
+
+    return {'options': options, 'entries': cache.get('entries', {}), 'mtime_ns': cache_mtime_ns}
+
+
+def write_stat_cache(cache_path:pathlib.Path, cache:Dict):
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+
+    with tempfile.NamedTemporaryFile('w', dir=cache_path.parent, delete=False, encoding="utf-8") as f:
+        json.dump({'options': cache['options'], 'entries': cache['entries']}, f)
+
+    os.replace(f.name, cache_path)
+
+
+def git_ls_ipynb_files(repo:pathlib.Path) -> Tuple[str]:
+    return tuple(
+        filter(None, check_output(get_ls_ipynb_files_cmd(), repo=repo).split('\0'))
+    )
+
+
+def get_ls_ipynb_files_cmd() -> List[str]:
+    return ['git', 'ls-files', '-z', '--cached', '--others', '--exclude-standard', '--deduplicate', '--', '*.ipynb']
+
+
+def is_ipynb_entry(entry:Dict[str, str]) -> bool:
+    return (
+        ('D' != entry['status'])
+        and entry['path'].endswith('.ipynb')
+        and is_regular_file_mode(entry['new_mode'])
+    )
+
+
+def is_regular_file_mode(mode:str) -> bool:
+    # not a symbolic link (120000) or a submodule (160000)
+    return mode.startswith('100')
+
+
+def get_default_engine(repo:pathlib.Path) -> str:
+    """
+    'plumbing' for a git directory, bare or the .git of a clone; 'worktree' otherwise
+    """
+    if is_inside_git_dir(repo) or (not is_inside_work_tree(repo)):
+        return 'plumbing'
+    else:
+        return 'worktree'
+
+
+def get_index_env(index_file:pathlib.Path) -> Dict[str, str]:
+    env = dict(os.environ)
+    env['GIT_INDEX_FILE'] = str(index_file)
+    return env
+
+
+def get_commit_env(commit_info:Dict[str, str]) -> Dict[str, str]:
+    env = dict(os.environ)
+    env.update({
+        'GIT_AUTHOR_NAME': commit_info["author"],
+        'GIT_AUTHOR_EMAIL': commit_info["author_email"],
+        'GIT_AUTHOR_DATE': commit_info["date"],
+        'GIT_COMMITTER_NAME': commit_info["committer"],
+        'GIT_COMMITTER_EMAIL': commit_info["committer_email"],
+        'GIT_COMMITTER_DATE': commit_info["commit_date"],
+    })
+    return env
+
+
+def get_read_tree_cmd(tree_ish:str) -> List[str]:
+    return ['git', 'read-tree', tree_ish]
+
+
+def get_index_info_lines(entries:Tuple[Dict[str, str]], blob_shas:Dict[str, str]) -> List[str]:
+    """
+    `git update-index -z --index-info` records of the diff entries
+    """
+    return [get_index_info_line(*change) for change in get_tree_changes(entries, blob_shas)]
+
+
+def get_tree_changes(entries:Tuple[Dict[str, str]], blob_shas:Dict[str, str]) -> List[Tuple[str, str, str]]:
+    """
+    (mode, sha, path) of the diff entries; mode '0' removes the path
+
+    blob_shas : replacement blob sha of the processed files;
+        paths not in the entries are added as regular files
+    """
+    changes = []
+
+    entry_paths = set(entry['path'] for entry in entries)
+
+    for path, sha in blob_shas.items():
+        if path not in entry_paths:
+            changes.append(('100644', sha, path))
+
+    for entry in entries:
+        if 'D' == entry['status']:
+            changes.append(('0', '0' * 40, entry['path']))
+        else:
+            changes.append(
+                (
+                    entry['new_mode'],
+                    blob_shas.get(entry['path'], entry['new_sha']),
+                    entry['path']
+                )
+            )
+
+    return changes
+
+
+def get_index_info_line(mode:str, sha:str, path:str) -> str:
+    return f'{mode} {sha}\t{path}\0'
+
+
+def git_update_index_info(repo:pathlib.Path, lines:List[str], env:Dict[str, str]=None):
+    check_output(get_update_index_info_cmd(), repo=repo, env=env, input=''.join(lines))
+
+
+def get_update_index_info_cmd() -> List[str]:
+    return ['git', 'update-index', '-z', '--index-info']
+
+
+def git_cat_file_blob(repo:pathlib.Path, sha:str) -> bytes:
+    return check_output(get_cat_file_blob_cmd(sha), repo=repo, encoding=None)
+
+
+def get_cat_file_blob_cmd(sha:str) -> List[str]:
+    return ['git', 'cat-file', 'blob', sha]
+
+
+def git_hash_objects_w(repo:pathlib.Path, paths:List[pathlib.Path], no_filters:bool=False, object_type:str='blob') -> Tuple[str]:
+    """
+    Write the files to the object database in one git call
+    """
+    if not paths:
+        return tuple()
+
+    return tuple(
+        check_output(
+            get_hash_objects_w_cmd(no_filters, object_type),
+            repo=repo,
+            input=''.join(map(lambda p: f'{p}\n', paths))
+        ).splitlines()
+    )
+
+
+def get_hash_objects_w_cmd(no_filters:bool=False, object_type:str='blob') -> List[str]:
+    cmd = ['git', 'hash-object', '-w', '-t', object_type, '--stdin-paths']
+
+    if no_filters:
+        cmd.append('--no-filters')
+
+    return cmd
+
+
+def git_commit_tree(repo:pathlib.Path, tree:str, parent:str, commit_info:Dict[str, str]) -> str:
+    return check_output(
+        get_commit_tree_cmd(tree, parent),
+        repo=repo,
+        env=get_commit_env(commit_info),
+        input=get_clean_message(commit_info["message"]),
+    ).strip()
+
+
+def get_commit_tree_cmd(tree:str, parent:str) -> List[str]:
+    return ['git', 'commit-tree', tree, '-p', parent]
+
+
+def get_clean_message(message:str) -> str:
+    """
+    Same as `git commit -m` would store the message
+    (`git stripspace` without removing comments)
+    """
+    lines = []
+
+    for line in message.splitlines():
+        line = line.rstrip()
+        if line or (lines and lines[-1]):
+            lines.append(line)
+
+    while lines and not lines[-1]:
+        lines.pop()
+
+    return ''.join(map(lambda s: s + '\n', lines))
+
+
+def git_create_branch_ref(repo:pathlib.Path, branch:str, sha:str):
+    git_create_ref(repo, f'refs/heads/{branch}', sha)
+
+
+def git_create_ref(repo:pathlib.Path, ref:str, sha:str):
+    check_output(get_create_ref_cmd(ref, sha), repo=repo)
+
+
+def get_create_ref_cmd(ref:str, sha:str) -> List[str]:
+    # all zero old value : the ref must not exist yet
+    return ['git', 'update-ref', ref, sha, '0' * 40]
+
+
+def get_new_branch_ref(new_branch:str, job:str=None) -> str:
+    if job is None:
+        return f'refs/heads/{new_branch}'
+    else:
+        return f'refs/rebase_ipynb/{job}/heads/{new_branch}'
+
+
+@contextlib.contextmanager
+def job_lock(lock_path:pathlib.Path, job:str):
+    """
+    Exclusive lock file for the duration of the job, as git's *.lock files
+
+    A lock left by a killed job has to be removed by hand.
+    """
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+
+    try:
+        fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        raise FileExistsError(
+            f"{lock_path} exists : {lock_path.read_text(errors='replace').strip()} is running; "
+            "remove the file if that job is gone"
+        ) from None
+
+    with os.fdopen(fd, 'w') as f:
+        f.write(f'job {job} pid {os.getpid()}\n')
+
+    try:
+        yield lock_path
+    finally:
+        lock_path.unlink()
+
+
+def get_ref_lock_path(repo:pathlib.Path, ref:str) -> pathlib.Path:
+    """
+    In the common git directory, shared by all the worktrees
+    """
+    return get_git_common_dir(repo) / 'rebase_ipynb' / 'locks' / (urllib.parse.quote(ref, safe='') + '.lock')
+
+
+def get_git_common_dir(repo:pathlib.Path) -> pathlib.Path:
+    return pathlib.Path(check_output(get_git_common_dir_cmd(), repo=repo).strip())
+
+
+def get_git_common_dir_cmd() -> List[str]:
+    return ['git', 'rev-parse', '--path-format=absolute', '--git-common-dir']
+
+
+def git_diff_tree_raw(repo:pathlib.Path, commit:str) -> Tuple[Dict[str, str]]:
+    return get_diff_tree_raw_entries(
+        check_output(get_diff_tree_raw_cmd(commit), repo=repo)
+    )
+
+
+def get_diff_tree_raw_cmd(commit:str) -> List[str]:
+    return ['git', 'diff-tree', '--no-commit-id', '--raw', '--no-renames', '-z', '-r', commit]
+
+
+def git_ls_tree_entries(repo:pathlib.Path, tree_ish:str) -> Tuple[Dict[str, str]]:
+    """
+    All the files of the tree, as the entries of git_diff_tree_raw() adding them
+    """
+    return get_ls_tree_entries(check_output(get_ls_tree_cmd(tree_ish), repo=repo))
+
+
+def get_ls_tree_cmd(tree_ish:str) -> List[str]:
+    return ['git', 'ls-tree', '-r', '-z', '--full-tree', tree_ish]
+
+
+def get_ls_tree_entries(output:str) -> Tuple[Dict[str, str]]:
+    """
+    `<mode> <type> <sha>\t<path>\0` for each file
+    """
+    result = []
+
+    for record in filter(None, output.split('\0')):
+        info, path = record.split('\t', 1)
+        mode, _, sha = info.split()
+
+        result.append({
+            'old_mode': '000000',
+            'new_mode': mode,
+            'old_sha': '0' * 40,
+            'new_sha': sha,
+            'status': 'A',
+            'path': path,
+        })
+
+    return tuple(result)
+
+
+def git_diff_trees_raw(repo:pathlib.Path, tree_a:str, tree_b:str) -> Tuple[Dict[str, str]]:
+    return get_diff_tree_raw_entries(
+        check_output(get_diff_trees_raw_cmd(tree_a, tree_b), repo=repo)
+    )
+
+
+def get_diff_trees_raw_cmd(tree_a:str, tree_b:str) -> List[str]:
+    return ['git', 'diff-tree', '--raw', '--no-renames', '-z', '-r', tree_a, tree_b]
+
+
+def get_diff_tree_raw_entries(output:str) -> Tuple[Dict[str, str]]:
+    """
+    Parse `git diff-tree --raw -z` output
+    `:old_mode new_mode old_sha new_sha status\0path\0`
+    """
+    fields = output.split('\0')
+
+    result = []
+
+    for info, path in zip(fields[0::2], fields[1::2]):
+        old_mode, new_mode, old_sha, new_sha, status = info.lstrip(':').split()
+        result.append({
+            'old_mode': old_mode,
+            'new_mode': new_mode,
+            'old_sha': old_sha,
+            'new_sha': new_sha,
+            'status': status,
+            'path': path,
+        })
+
+    return tuple(result)
+
+
+def rewrite_refs(repo:pathlib.Path, sha_map:Dict[str, str], patterns:List[str]) -> Dict[str, str]:
+    """
+    Point the refs matching the patterns to the rewritten commits
+    in one `git update-ref --stdin` transaction
+
+    Annotated tags get new tag objects, written in one git call.
+    Signatures of signed tags are dropped as they would not be valid anymore.
+
+    Returns the new object sha of each updated ref
+    """
+    refs = git_for_each_ref(repo=repo, patterns=patterns)
+
+    updates = {}
+
+    for ref in refs:
+        if ('commit' == ref['objecttype']) and (ref['objectname'] in sha_map):
+            updates[ref['refname']] = sha_map[ref['objectname']]
+
+    tags = tuple(
+        filter(
+            lambda ref: ('tag' == ref['objecttype']) and (ref['peeled'] in sha_map),
+            refs
+        )
+    )
+
+    updates.update(rewrite_tag_objects(repo=repo, tags=tags, sha_map=sha_map))
+
+    old_shas = {ref['refname']: ref['objectname'] for ref in refs}
+
+    git_update_ref_stdin(
+        repo=repo,
+        lines=[
+            f'update {refname} {new_sha} {old_shas[refname]}\n'
+            for refname, new_sha in updates.items()
+        ]
+    )
+
+    return updates
+
+
+def rewrite_tag_objects(repo:pathlib.Path, tags:Tuple[Dict[str, str]], sha_map:Dict[str, str]) -> Dict[str, str]:
+    """
+    Returns the new tag object sha of each tag ref
+    """
+    contents = git_cat_file_batch(repo=repo, shas=[tag['objectname'] for tag in tags])
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_path = pathlib.Path(tmp_dir)
+
+        tag_paths = []
+
+        for i, tag in enumerate(tags):
+            tag_path = tmp_path / str(i)
+            tag_path.write_bytes(
+                get_rewritten_tag(contents[tag['objectname']], sha_map[tag['peeled']])
+            )
+            tag_paths.append(tag_path)
+
+        new_shas = git_hash_objects_w(repo=repo, paths=tag_paths, no_filters=True, object_type='tag')
+
+    return dict(zip((tag['refname'] for tag in tags), new_shas))
+
+
+def get_rewritten_tag(content:bytes, new_object:str) -> bytes:
+    """
+    Tag object content pointing to the new object, without signature
+    """
+    header, message = content.split(b'\n\n', 1)
+
+    header_lines = header.split(b'\n')
+    assert header_lines[0].startswith(b'object '), header_lines[0]
+    header_lines[0] = b'object ' + new_object.encode()
+
+    for marker in (b'-----BEGIN PGP SIGNATURE-----', b'-----BEGIN SSH SIGNATURE-----', b'-----BEGIN SIGNED MESSAGE-----'):
+        if message.startswith(marker):
+            message = b''
+        elif (b'\n' + marker) in message:
+            message = message[:message.index(b'\n' + marker) + 1]
+
+    return b'\n'.join(header_lines) + b'\n\n' + message
+
+
+def git_for_each_ref(repo:pathlib.Path, patterns:List[str]) -> Tuple[Dict[str, str]]:
+    result = []
+
+    for line in check_output(get_for_each_ref_cmd(patterns), repo=repo).splitlines():
+        fields = line.split()
+        result.append({
+            'refname': fields[0],
+            'objecttype': fields[1],
+            'objectname': fields[2],
+            # what an annotated tag points to
+            'peeled': fields[3] if 3 < len(fields) else None,
+        })
+
+    return tuple(result)
+
+
+def get_for_each_ref_cmd(patterns:List[str]) -> List[str]:
+    return ['git', 'for-each-ref', '--format=%(refname) %(objecttype) %(objectname) %(*objectname)', *patterns]
+
+
+def git_update_ref_stdin(repo:pathlib.Path, lines:List[str]):
+    if lines:
+        check_output(get_update_ref_stdin_cmd(), repo=repo, input=''.join(lines))
+
+
+def get_update_ref_stdin_cmd() -> List[str]:
+    # all updates or none
+    return ['git', 'update-ref', '--stdin']
+
+
+def git_cat_file_batch(repo:pathlib.Path, shas:List[str]) -> Dict[str, bytes]:
+    """
+    Read the objects in one git call
+    """
+    if not shas:
+        return {}
+
+    output = check_output(
+        get_cat_file_batch_cmd(),
+        repo=repo,
+        input=''.join(map(lambda sha: f'{sha}\n', shas)).encode(),
+        encoding=None
+    )
+
+    return dict(get_cat_file_batch_objects(output))
+
+
+def git_cat_file_batch_iter(repo:pathlib.Path, shas:List[str]) -> Iterator[Tuple[str, bytes]]:
+    """
+    (sha, content) of the objects one at a time from one git call
+
+    Only the object being yielded is in memory
+    """
+    if not shas:
+        return
+
+    # a file as stdin : git may block writing its output before reading all the input
+    with tempfile.TemporaryFile() as stdin:
+        stdin.write(''.join(map(lambda sha: f'{sha}\n', shas)).encode())
+        stdin.seek(0)
+
+        with subprocess.Popen(get_cat_file_batch_cmd(), cwd=repo, stdin=stdin, stdout=subprocess.PIPE) as proc:
+            for sha in shas:
+                header = proc.stdout.readline().decode().split()
+                assert 3 == len(header), (sha, header)
+
+                content = proc.stdout.read(int(header[2]))
+                assert int(header[2]) == len(content), (sha, header)
+                assert b'\n' == proc.stdout.read(1), sha
+
+                yield sha, content
+
+    assert 0 == proc.returncode, proc.returncode
+
+
+def git_cat_file_batch_to_files(repo:pathlib.Path, shas:List[str], paths:List[pathlib.Path], chunk_size:int=2**20) -> Tuple[int]:
+    """
+    Stream the blobs to the files in one git call
+
+    At most chunk_size bytes of a blob are in memory at a time.
+    Returns the size of each blob
+    """
+    if not shas:
+        return tuple()
+
+    sizes = []
+
+    # a file as stdin : git may block writing its output before reading all the input
+    with tempfile.TemporaryFile() as stdin:
+        stdin.write(''.join(map(lambda sha: f'{sha}\n', shas)).encode())
+        stdin.seek(0)
+
+        with subprocess.Popen(get_cat_file_batch_cmd(), cwd=repo, stdin=stdin, stdout=subprocess.PIPE) as proc:
+            for sha, path in zip(shas, paths):
+                header = proc.stdout.readline().decode().split()
+                assert 3 == len(header), (sha, header)
+
+                remaining = int(header[2])
+                sizes.append(remaining)
+
+                with open(path, 'wb') as f:
+                    while remaining:
+                        chunk = proc.stdout.read(min(chunk_size, remaining))
+                        assert chunk, (sha, remaining)
+                        f.write(chunk)
+                        remaining -= len(chunk)
+
+                assert b'\n' == proc.stdout.read(1), sha
+
+    assert 0 == proc.returncode, proc.returncode
+
+    return tuple(sizes)
+
+
+def git_cat_file_sizes(repo:pathlib.Path, shas:List[str]) -> Tuple[int]:
+    """
+    Sizes of the objects in one git call, without reading them
+    """
+    if not shas:
+        return tuple()
+
+    output = check_output(
+        get_cat_file_batch_check_cmd(), repo=repo, input=''.join(map(lambda sha: f'{sha}\n', shas))
+    )
+
+    return tuple(int(line.split()[2]) for line in output.splitlines())
+
+
+def get_cat_file_batch_check_cmd() -> List[str]:
+    return ['git', 'cat-file', '--batch-check']
+
+
+def get_cat_file_batch_cmd() -> List[str]:
+    return ['git', 'cat-file', '--batch']
+
+
+def get_cat_file_batch_objects(output:bytes) -> List[Tuple[str, bytes]]:
+    """
+    Parse `git cat-file --batch` output
+    `<sha> <type> <size>\n<content>\n` for each object
+    `<name> missing\n` for each missing object, with None as the content
+    """
+    result = []
+
+    start = 0
+
+    while start < len(output):
+        end_of_header = output.index(b'\n', start)
+        header = output[start:end_of_header].decode().split()
+
+        if 'missing' == header[-1]:
+            result.append((header[0], None))
+            start = end_of_header + 1
+            continue
+
+        sha, _, size = header
+
+        content_start = end_of_header + 1
+        content_end = content_start + int(size)
+
+        result.append((sha, output[content_start:content_end]))
+
+        # skip the newline after the content
+        start = content_end + 1
+
+    return result
+
+
+def repack_rewritten(repo:pathlib.Path, start_parent:str, last_commit:str, new_branch:str, window:int=250, depth:int=50, job:str=None) -> Dict:
+    """
+    Pack only the objects new to the rewritten branch with tuned delta settings,
+    remove the loose copies, and write the commit-graph and the multi-pack-index
+
+    Returns the report comparing the original and the rewritten ranges
+    """
+    new_ref = get_new_branch_ref(new_branch, job)
+
+    report = {
+        'original': measure_range(repo, start_parent, last_commit),
+        'rewritten_before_repack': measure_range(repo, start_parent, new_ref),
+        'loose_before_repack': git_count_objects(repo),
+    }
+
+    pack_base = get_git_dir(repo) / 'objects' / 'pack' / 'pack'
+
+    report['pack'] = check_output(
+        get_pack_objects_cmd(pack_base, window, depth),
+        repo=repo,
+        # reachable from the new branch but not from the original
+        input=f'{new_ref}\n^{last_commit}\n',
+    ).strip()
+
+    check_output(get_prune_packed_cmd(), repo=repo)
+    check_output(get_commit_graph_write_cmd(), repo=repo)
+    check_output(get_multi_pack_index_write_cmd(), repo=repo)
+
+    report['rewritten'] = measure_range(repo, start_parent, new_ref)
+    report['loose_after_repack'] = git_count_objects(repo)
+
+    return report
+
+
+def measure_range(repo:pathlib.Path, start_parent:str, end:str) -> Dict[str, int]:
+    """
+    Number of objects reachable from end but not from start_parent
+    with their total size and their size on disk
+    """
+    object_shas = [
+        line.split()[0]
+        for line in check_output(get_rev_list_objects_cmd(start_parent, end), repo=repo).splitlines()
+    ]
+
+    result = {'objects': len(object_shas), 'size': 0, 'disk_size': 0}
+
+    if object_shas:
+        for line in check_output(
+                get_cat_file_batch_check_size_cmd(),
+                repo=repo,
+                input=''.join(map(lambda sha: f'{sha}\n', object_shas))
+            ).splitlines():
+
+            size, disk_size = line.split()
+            result['size'] += int(size)
+            result['disk_size'] += int(disk_size)
+
+    return result
+
+
+def get_rev_list_objects_cmd(start_parent:str, end:str) -> List[str]:
+    return ['git', 'rev-list', '--objects', f'{start_parent}..{end}']
+
+
+def get_cat_file_batch_check_size_cmd() -> List[str]:
+    return ['git', 'cat-file', '--batch-check=%(objectsize) %(objectsize:disk)']
+
+
+def git_count_objects(repo:pathlib.Path) -> Dict[str, int]:
+    """
+    `git count-objects -v` as a dictionary
+    """
+    result = {}
+
+    for line in check_output(get_count_objects_cmd(), repo=repo).splitlines():
+        key, value = line.split(':')
+        result[key.strip()] = int(value)
+
+    return result
+
+
+def get_count_objects_cmd() -> List[str]:
+    return ['git', 'count-objects', '-v']
+
+
+def get_pack_objects_cmd(pack_base:pathlib.Path, window:int, depth:int) -> List[str]:
+    return [
+        'git', 'pack-objects', '--revs', '--delta-base-offset', '-q',
+        f'--window={window}', f'--depth={depth}',
+        str(pack_base),
+    ]
+
+
+def get_prune_packed_cmd() -> List[str]:
+    return ['git', 'prune-packed']
+
+
+def get_commit_graph_write_cmd() -> List[str]:
+    return ['git', 'commit-graph', 'write', '--reachable']
+
+
+def get_multi_pack_index_write_cmd() -> List[str]:
+    return ['git', 'multi-pack-index', 'write']
+
+
+def analyze_range(repo:pathlib.Path, first_commit:str, last_commit:str) -> List[Dict]:
+    """
+    Attribute the bytes of the ipynb blobs written in the range
+    to the notebook path, the cell type, the output mime type and the colab metadata
+
+    Each distinct blob is counted once, as git stores it once,
+    under the first path it appears at.
+    Only one blob is in memory at a time.
+
+    Returns the rows of get_analysis_rows()
+    """
+    start_parent = git_parent_sha(repo=repo, commit=first_commit)
+
+    # blob sha : path
+    paths = {}
+
+    for commit in git_log_hash(repo=repo, start_parent=start_parent, end=last_commit):
+        for entry in git_diff_tree_raw(repo=repo, commit=commit):
+            if is_ipynb_entry(entry):
+                paths.setdefault(entry['new_sha'], entry['path'])
+
+    totals = collections.defaultdict(lambda: [0, 0])
+
+    for sha, content in git_cat_file_batch_iter(repo, tuple(paths)):
+        analyze_notebook(content, paths[sha], totals)
+
+    return get_analysis_rows(totals)
+
+
+def analyze_notebook(content:bytes, path:str, totals:Dict[Tuple[str, str], List[int]]):
+    """
+    Add the bytes of the notebook to the [count, bytes] totals of each (category, key)
+
+    The size of the cells, outputs and metadata is their compact json size,
+    so that they do not add up to the blob size exactly.
+    """
+    def add(category:str, key:str, n_bytes:int):
+        totals[(category, key)][0] += 1
+        totals[(category, key)][1] += n_bytes
+
+    add('path', path, len(content))
+
+    try:
+        ipynb_json = json.loads(content)
+        cells = ipynb_json["cells"]
+    except (ValueError, KeyError, TypeError):
+        add('invalid', path, len(content))
+        return
+
+    if 'colab' in ipynb_json.get("metadata", {}):
+        add('colab', 'metadata.colab', get_json_size(ipynb_json["metadata"]["colab"]))
+
+    for cell in cells:
+        add('cell_type', cell.get("cell_type", ''), get_json_size(cell))
+
+        if "id" in cell:
+            add('colab', 'cell.id', get_json_size(cell["id"]))
+
+        metadata = cell.get("metadata", {})
+
+        if 'colab' in metadata:
+            add('colab', 'cell.metadata.colab', get_json_size(metadata["colab"]))
+        if 'id' in metadata:
+            add('colab', 'cell.metadata.id', get_json_size(metadata["id"]))
+        if 'outputId' in metadata:
+            add('colab', 'cell.metadata.outputId', get_json_size(metadata["outputId"]))
+
+        for output in cell.get("outputs", []):
+            output_type = output.get("output_type", '')
+
+            if 'data' in output:
+                for mime, data in output["data"].items():
+                    add('output', mime, get_json_size(data))
+            elif 'stream' == output_type:
+                add('output', f'stream/{output.get("name", "")}', get_json_size(output.get("text", '')))
+            elif 'error' == output_type:
+                add('output', 'error', get_json_size(output.get("traceback", [])))
+
+            if 'outputId' in output.get("metadata", {}):
+                add('colab', 'output.metadata.outputId', get_json_size(output["metadata"]["outputId"]))
+
+
+def get_json_size(value) -> int:
+    return len(json.dumps(value, separators=(',', ':'), ensure_ascii=False).encode('utf-8'))
+
+
+def get_analysis_rows(totals:Dict[Tuple[str, str], List[int]]) -> List[Dict]:
+    """
+    category, key, count, bytes; the largest first within each category
+    """
+    return [
+        {'category': category, 'key': key, 'count': count, 'bytes': n_bytes}
+        for (category, key), (count, n_bytes) in sorted(
+            totals.items(), key=lambda item: (item[0][0], -item[1][1], item[0][1])
+        )
+    ]
+
+
+def write_analysis(rows:List[Dict], output, output_format:str='csv'):
+    """
+    output : text file object
+    """
+    if 'json' == output_format:
+        json.dump(rows, output, indent=1)
+        output.write('\n')
+    else:
+        assert 'csv' == output_format, output_format
+        writer = csv.DictWriter(output, fieldnames=('category', 'key', 'count', 'bytes'), lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def git_checkout(repo:pathlib.Path, commit:str):
+    check_output(get_checkout_cmd(commit), repo=repo)
+
+
+def git_add(repo:pathlib.Path, files:List[str]):
+    check_output(get_add_cmd(files), repo=repo)
+
+
+def git_commit(repo:pathlib.Path, commit_info:Dict[str, str]):
+    # the committer in the environment of this call only; no shared config or os.environ
+    check_output(get_commit_cmd(commit_info), repo=repo, env=get_commit_env(commit_info))
+
+
+def is_index_same_as_head(repo:pathlib.Path) -> bool:
+    """
+    Would committing the index produce the same tree as HEAD?
+    """
+    return git_write_tree(repo) == git_rev_parse(repo, 'HEAD^{tree}')
+
+
+def git_write_tree(repo:pathlib.Path) -> str:
+    return check_output(get_write_tree_cmd(), repo=repo).strip()
+
+
+def get_write_tree_cmd() -> List[str]:
+    return ['git', 'write-tree']
+
+
+def git_rev_parse(repo:pathlib.Path, rev:str) -> str:
+    return check_output(get_rev_parse_cmd(rev), repo=repo).strip()
+
+
+def get_rev_parse_cmd(rev:str) -> List[str]:
+    return ['git', 'rev-parse', '--verify', rev]
+
+
+def write_sha_map(sha_map:Dict[str, str], map_path:pathlib.Path):
+    """
+    One `<original sha> <rewritten sha>` pair per line
+    """
+    with map_path.open('w', encoding="utf-8") as f:
+        for old_sha, new_sha in sha_map.items():
+            f.write(f'{old_sha} {new_sha}\n')
+
+
+def check_output(cmd:List[str], repo:pathlib.Path=None, stderr=None, env:Dict[str, str]=None, input:str=None, encoding:str='utf-8') -> str:
+    return subprocess.check_output(cmd, cwd=repo, encoding=encoding, stderr=stderr, env=env, input=input)
+
+
+def get_checkout_cmd(commit):
+    return ['git', '-c', "advice.detachedHead=false", 'checkout', commit]
+
+
+def get_add_cmd(files:List[str]) -> List[str]:
+    return ['git', 'add', *files]
+
+
+def get_commit_cmd(commit_info) -> List[str]:
+    return [
+        'git', 'commit',
+            '--allow-empty',
+            '-m', commit_info["message"],
+            '--date', commit_info["date"],
+            '--author', f'{commit_info["author"]} <{commit_info["author_email"]}>',
+    ]
+
+
+def git_show_info(repo:pathlib.Path, commit:str) -> Dict[str, str]:
+    return get_commit_info_from_show(
+        check_output(
+            get_show_stat_commit(commit),
+            repo=repo
+        )
+    )
+
+
+def get_show_stat_commit(commit:str) -> List[str]:
+    return ['git', 'show', '--stat', "--format=fuller",commit]
+
+
+def git_parent_sha(repo:pathlib.Path, commit:str) -> str:
+    return git_show_info(repo, commit+'^')["sha"]
+
+
+def get_commit_info_from_show(output:str) -> Dict[str, str]:
+    lines = output.splitlines()
+
+    body = get_commit_message_body(lines)
+
+    result = {
+        "sha": lines[0].split('commit')[1].strip(),
+        "author": lines[1].split('Author:')[1].strip().split('<')[0].strip(),
+        "author_email": lines[1].split('<')[1].strip().strip('>'),
+        "date": lines[2].split('Date:')[1].strip(),
+        "committer": lines[3].split('Commit:')[1].strip().split('<')[0].strip(),
+        "committer_email": lines[3].split('<')[1].strip().strip('>'),
+        "commit_date": lines[4].split('Date:')[1].strip(),
+        'message': body,
+    }
+
+    return result
+
+
+def get_commit_message_body(lines:List[str]) -> str:
+    last_line = lines[-1].strip()
+
+    if ("file changed" in last_line) or ("files changed" in last_line):
+        n_files_str = last_line.split('file')[0].strip()
+
+        assert n_files_str.isnumeric(), (
+            pprint.pformat(lines),
+            last_line,
+            last_line.split('files')
+        )
+
+        n_files = int(n_files_str)
+
+        body = '\n'.join(
+            map(
+                lambda s:s.strip(),
+                lines[5:-n_files-1]
+            )
+        ).strip()
+
+    else:
+        # if no file changed
+        body = '\n'.join(
+            map(
+                lambda s:s.strip(),
+                lines[5:]
+            )
+        ).strip()
+
+    return body
+
+
+def assert_git_repo(repo:pathlib.Path) -> bool:
+    """
+    `.git` may be a folder, a file (worktrees and submodules), or
+    missing altogether (bare repositories and `GIT_DIR`)
+    """
+    assert repo.exists()
+    assert repo.is_dir()
+
+    repo_git_path = get_git_dir(repo)
+
+    assert repo_git_path.exists()
+    assert repo_git_path.is_dir()
+
+
+def get_git_dir(repo:pathlib.Path) -> pathlib.Path:
+    return pathlib.Path(check_output(get_git_dir_cmd(), repo=repo).strip())
+
+
+def get_git_dir_cmd() -> List[str]:
+    return ['git', 'rev-parse', '--absolute-git-dir']
+
+
+def is_inside_work_tree(repo:pathlib.Path) -> bool:
+    return 'true' == check_output(get_inside_work_tree_cmd(), repo=repo).strip()
+
+
+def get_inside_work_tree_cmd() -> List[str]:
+    return ['git', 'rev-parse', '--is-inside-work-tree']
+
+
+def is_inside_git_dir(repo:pathlib.Path) -> bool:
+    return 'true' == check_output(get_inside_git_dir_cmd(), repo=repo).strip()
+
+
+def get_inside_git_dir_cmd() -> List[str]:
+    return ['git', 'rev-parse', '--is-inside-git-dir']
+
+
+def start_temporary_branch_head(repo:pathlib.Path, start_parent:str, new_branch:str=None):
+    assert_git_repo(repo)
+
+    check_output(get_checkout_head_cmd(start_parent, new_branch), repo=repo)
+
+
+def get_checkout_head_cmd(start_parent:str, new_branch:str=None) -> List[str]:
+    cmd = ['git', 'checkout', start_parent]
+
+    if new_branch is not None:
+        cmd += ['-b', new_branch]
+
+    return cmd
+
+
+def switch_to_temporary_branch(repo:pathlib.Path, branch:str):
+    assert_git_repo(repo)
+
+    check_output(get_switch_cmd(branch), repo=repo)
+
+
+def get_switch_cmd(branch:str) -> List[str]:
+    return ['git', 'switch', branch]
+
+
+def get_repo_folder_path(parsed:argparse.Namespace) -> pathlib.Path:
+    """
+    --repo, then --git-dir, then the GIT_DIR environment variable
+
+    GIT_DIR is then dropped from the environment :
+    every git call runs in the returned folder, where git would resolve
+    a relative GIT_DIR again, or take the folder for a working tree of it.
+    """
+    if parsed.repo is not None:
+        p = pathlib.Path(parsed.repo)
+    elif parsed.git_dir is not None:
+        p = pathlib.Path(parsed.git_dir)
+    else:
+        p = pathlib.Path(os.environ.get('GIT_DIR', '.'))
+
+    p = p.resolve(strict=True)
+
+    os.environ.pop('GIT_DIR', None)
+
+    assert_git_repo(p)
+
+    return p
+
+
+def git_log_hash(repo:pathlib.Path, start_parent:str, end:str) -> Tuple[str]:
+    return tuple(
+        check_output(get_hash_log_cmd(start_parent, end), repo=repo).splitlines()
+    )
+
+
+def get_hash_log_cmd(start_parent:str, end:str) -> List[str]:
+    return ['git', 'log', '--reverse', '--pretty=format:%H', f'{start_parent}..{end}']
+
+
+def git_diff_fnames(repo:pathlib.Path, commit:str) -> Tuple[str]:
+    return tuple(
+        check_output(get_chg_files_cmd(commit), repo=repo).splitlines()
+    )
+
+
+def get_chg_files_cmd(commit:str) -> List[str]:
+    return ['git', 'diff-tree', '--no-commit-id', '--name-only', '-r', commit]
+
+
+def git_switch_c(repo:pathlib.Path, commit:str, branch:str):
+    check_output(get_switch_c_cmd(commit, branch), repo=repo)
+
+
+def get_switch_c_cmd(commit:str, branch:str) -> List[str]:
+    return ['git', 'switch', commit, '-c', branch]
+
+
+def get_current_branch(repo:pathlib.Path) -> str:
+    return check_output(
+        get_current_branch_cmd(),
+        repo=repo
+    ).strip()
+
+
+def get_current_branch_cmd() -> List[str]:
+    return ['git', 'branch', '--show-current']
+
+
+def git_branch(repo:pathlib.Path) -> Tuple[str]:
+    return tuple(
+        check_output(get_branch_cmd(), repo=repo).splitlines()
+    )
+
+
+def get_branch_cmd() -> List[str]:
+    return ['git', 'branch']
+
+
+def process_ipynb(src_path:pathlib.Path, clean_options:Dict=None, outputs_folder:pathlib.Path=None) -> Tuple[pathlib.Path]:
+    """
+    rewrite ipynb file using `jupyter nbconver --to notebook`
+
+    Returns the output files externalized to the outputs_folder
+    """
+    clean_options = get_clean_options(**(clean_options or {}))
+
+    assert src_path.exists()
+    assert src_path.is_file()
+    assert src_path.suffix == '.ipynb'
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = pathlib.Path(tmpdir)
+
+        src_after_ipynb_path = tmpdir / (src_path.name)
+
+        remove_colab_button(src_path, src_after_ipynb_path)
+
+    remove_id_from_file(src_path, src_path, transforms=clean_options['transforms'])
+
+    if clean_options['externalize_threshold'] is None:
+        externalized = tuple()
+    else:
+        externalized = externalize_outputs_file(src_path, outputs_folder, clean_options['externalize_threshold'])
+
+    # the notebook as written
+    if clean_options['validate']:
+        validate_notebook(json.loads(src_path.read_text(encoding="utf-8")))
+
+    return externalized
+
+
+def get_clean_options(externalize_threshold:int=None, externalize_folder:str='.ipynb_outputs', transforms:List[Union[str, Dict]]=None, validate:bool=False) -> Dict:
+    """
+    externalize_threshold : base64 outputs longer than this are moved to files
+    externalize_folder : folder of those files, relative to the repository
+    transforms : transform configuration, see compile_transforms()
+    validate : check the cleaned notebooks against the nbformat v4 schema, see validate_notebook()
+    """
+    return {
+        'externalize_threshold': externalize_threshold,
+        'externalize_folder': externalize_folder,
+        'transforms': get_default_transforms() if transforms is None else transforms,
+        'validate': validate,
+    }
+
+
+def get_output_options(clean_options:Dict) -> Dict:
+    """
+    The clean options changing the cleaned bytes, for the cache keys;
+    'validate' only checks them
+    """
+    return {key: value for key, value in clean_options.items() if 'validate' != key}
+
+
+def externalize_outputs_file(ipynb_path:pathlib.Path, outputs_folder:pathlib.Path, threshold:int) -> Tuple[pathlib.Path]:
+    """
+    Returns the output files written to the outputs_folder
+    """
+    ipynb_json = json.loads(ipynb_path.read_text(encoding="utf-8"))
+
+    outputs = externalize_outputs(ipynb_json, threshold)
+
+    if outputs:
+        write_ipynb_json(ipynb_json, ipynb_path)
+
+    result = []
+
+    for name, text in sorted(outputs.items()):
+        if not outputs_folder.exists():
+            outputs_folder.mkdir(parents=True)
+
+        output_path = outputs_folder / name
+        output_path.write_text(text, encoding="utf-8")
+
+        result.append(output_path)
+
+    return tuple(result)
+
+
+def externalize_outputs(ipynb_json:Dict, threshold:int) -> Dict[str, str]:
+    """
+    Replace base64 output data longer than the threshold with an empty string
+    and record its sha256 in the output metadata
+
+    Returns the original data of each sha256
+    """
+    outputs = {}
+
+    for cell in ipynb_json["cells"]:
+        for output in cell.get("outputs", []):
+            data = output.get("data", {})
+
+            for mime in tuple(data):
+                if not is_base64_mime(mime):
+                    continue
+
+                value = data[mime]
+                is_lines = isinstance(value, list)
+                text = ''.join(value) if is_lines else value
+
+                if len(text) <= threshold:
+                    continue
+
+                name = hashlib.sha256(text.encode()).hexdigest()
+                outputs[name] = text
+
+                data[mime] = ''
+                output.setdefault("metadata", {}).setdefault("rebase_ipynb", {})[mime] = {
+                    "sha256": name,
+                    "lines": is_lines,
+                }
+
+    return outputs
+
+
+def restore_outputs_file(ipynb_path:pathlib.Path, outputs_folder:pathlib.Path) -> bool:
+    """
+    Put the externalized outputs back into the notebook
+
+    Returns True if the notebook changed
+    """
+    ipynb_json = json.loads(ipynb_path.read_text(encoding="utf-8"))
+
+    result = restore_outputs(ipynb_json, outputs_folder)
+
+    if result:
+        write_ipynb_json(ipynb_json, ipynb_path)
+
+    return result
+
+
+def restore_outputs(ipynb_json:Dict, outputs_folder:pathlib.Path) -> bool:
+    result = False
+
+    for cell in ipynb_json["cells"]:
+        for output in cell.get("outputs", []):
+            metadata = output.get("metadata", {})
+
+            for mime, ref in metadata.pop("rebase_ipynb", {}).items():
+                text = (outputs_folder / ref["sha256"]).read_text(encoding="utf-8")
+
+                if ref["lines"]:
+                    output["data"][mime] = text.splitlines(keepends=True)
+                else:
+                    output["data"][mime] = text
+
+                result = True
+
+    return result
+
+
+def get_external_output_names(ipynb_json:Dict) -> Tuple[str]:
+    names = []
+
+    for cell in ipynb_json["cells"]:
+        for output in cell.get("outputs", []):
+            for ref in output.get("metadata", {}).get("rebase_ipynb", {}).values():
+                names.append(ref["sha256"])
+
+    return tuple(sorted(set(names)))
+
+
+def is_base64_mime(mime:str) -> bool:
+    """
+    nbformat stores binary output data as base64 text
+    """
+    if 'image/svg+xml' == mime:
+        return False
+
+    return mime.startswith('image/') or (mime in ('application/pdf',))
+
+
+def write_ipynb_json(ipynb_json:Dict, ipynb_path:pathlib.Path):
+    with ipynb_path.open('w', encoding="utf-8") as f:
+        json.dump(ipynb_json, f, indent=1, ensure_ascii=False)
+
+
+def jupyter_nbconvert_notebook(input_path:pathlib.Path, output_path:pathlib.Path, my_null):
+    check_output(get_nbconvert_ipynb_cmd(input_path, output_path), stderr=my_null)
+
+
+def get_nbconvert_ipynb_cmd(input_path:pathlib.Path, output_path:pathlib.Path) -> List[str]:
     return ['jupyter', 'nbconvert', "--to", "notebook", str(input_path), "--output", str(output_path)]
 
 
-def remove_id_from_file(src_path:pathlib.Path, dest_path:pathlib.Path, allowed:Tuple[str]=('view-in-github',)):
-    ipynb_json = json.loads(src_path.read_text())
+def remove_id_from_file(src_path:pathlib.Path, dest_path:pathlib.Path, allowed:Tuple[str]=('view-in-github',), transforms:List[Union[str, Dict]]=None, validate:bool=False):
+    """
+    transforms : transform configuration (default: remove the ids)
+    validate : check the result against the nbformat schema before writing
+    """
+    if transforms is None:
+        transforms = get_default_transforms(allowed)
+
+    ipynb_json = json.loads(src_path.read_text())
+
+    get_transform_visitor(json.dumps(transforms))(ipynb_json)
+
+    if 'remove_id' in get_transform_names(transforms):
+        for cell in ipynb_json["cells"]:
+            assert "id" not in cell
+
+    if validate:
+        validate_notebook(ipynb_json)
+
+    with dest_path.open('w', encoding="utf-8") as f:
+        json.dump(ipynb_json, f, indent=1, ensure_ascii=False)
+
+
+def validate_notebook(ipynb_json:Dict):
+    """
+    Raise ValueError if the notebook does not follow the nbformat v4 schema of its minor version
+
+    As nbformat does for now, cells without ids are accepted :
+    such notebooks are checked against the v4.4 schema, the last one without cell ids.
+    """
+    if 4 != ipynb_json.get("nbformat"):
+        raise ValueError(f"not a v4 notebook : {ipynb_json.get('nbformat')}")
+
+    nbformat_minor = ipynb_json.get("nbformat_minor", 0)
+
+    if (4 < nbformat_minor) and any(map(lambda cell: "id" not in cell, ipynb_json.get("cells", []))):
+        nbformat_minor = 4
+
+    get_notebook_validator(nbformat_minor)(ipynb_json)
+
+
+@functools.lru_cache(maxsize=None)
+def get_notebook_validator(nbformat_minor:int) -> Callable[[Dict], None]:
+    """
+    Compile the schema once in each process;
+    fastjsonschema if installed, otherwise the jsonschema validator nbformat depends on
+    """
+    schema = json.loads(get_nbformat_schema_path(nbformat_minor).read_text(encoding="utf-8"))
+
+    try:
+        import fastjsonschema
+    except ImportError:
+        import jsonschema
+
+        validator = jsonschema.Draft4Validator(schema)
+
+        def validate(ipynb_json:Dict):
+            error = jsonschema.exceptions.best_match(validator.iter_errors(ipynb_json))
+            if error is not None:
+                raise ValueError(error.message)
+
+        return validate
+
+    # JsonSchemaException is a ValueError
+    return fastjsonschema.compile(schema)
+
+
+def get_nbformat_schema_path(nbformat_minor:int) -> pathlib.Path:
+    """
+    The schema files shipped with nbformat; the latest one for a newer minor version
+
+    Located without importing nbformat
+    """
+    import importlib.util
+
+    folder = pathlib.Path(importlib.util.find_spec('nbformat').submodule_search_locations[0]) / 'v4'
+
+    path = folder / f'nbformat.v4.{nbformat_minor}.schema.json'
+
+    return path if path.exists() else folder / 'nbformat.v4.schema.json'
+
+
+def get_transforms() -> Dict[str, Dict]:
+    """
+    Registry of the transforms
+
+    scope : keys of each cell, or of the whole notebook
+    keys : paths of the keys the transform touches,
+        'a.b' for b in the dictionary a, 'a[].b' for b in each item of the list a
+    function : function(owner, key, **params) for each of the keys present in its owner;
+        params are the parameters of the configuration
+    """
+    return {
+        'remove_metadata_id': {'scope': 'cell', 'keys': ('metadata.id',), 'function': drop_key_unless_allowed},
+        'remove_id': {'scope': 'cell', 'keys': ('id',), 'function': drop_cell_id},
+        'remove_output_id': {'scope': 'cell', 'keys': ('metadata.colab', 'metadata.outputId'), 'function': drop_key},
+        'strip_execution_count': {'scope': 'cell', 'keys': ('execution_count', 'outputs[].execution_count'), 'function': reset_key},
+        'clear_large_outputs': {'scope': 'cell', 'keys': ('outputs',), 'function': drop_large_items},
+        'drop_widgets_metadata': {'scope': 'notebook', 'keys': ('metadata.widgets',), 'function': drop_key},
+    }
+
+
+def get_default_transforms(allowed:Tuple[str]=('view-in-github',)) -> List[Union[str, Dict]]:
+    return [
+        {'name': 'remove_metadata_id', 'allowed': list(allowed)},
+        'remove_id',
+        'remove_output_id',
+    ]
+
+
+def read_transforms_config(config_path:pathlib.Path) -> List[Union[str, Dict]]:
+    """
+    json file : {"transforms": ["remove_id", {"name": "clear_large_outputs", "max_kb": 100}, ...]}
+    """
+    transforms = json.loads(config_path.read_text(encoding="utf-8"))["transforms"]
+
+    # fail early on unknown names
+    compile_transforms(transforms)
+
+    return transforms
+
+
+def get_transform_names(transforms:List[Union[str, Dict]]) -> Tuple[str]:
+    return tuple(
+        t if isinstance(t, str) else t['name']
+        for t in transforms
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def get_transform_visitor(transforms_json:str) -> Callable[[Dict], None]:
+    """
+    Compile once per configuration
+    """
+    return compile_transforms(json.loads(transforms_json))
+
+
+def compile_transforms(transforms:List[Union[str, Dict]]) -> Callable[[Dict], None]:
+    """
+    Compile the configured transforms into one visitor
+    walking the cells once, whatever the number of transforms
+
+    The keys of all the transforms are merged into one tree for each scope :
+    a subtree no transform touches is never entered,
+    and each key present is looked up once and handed to the rules claiming it,
+    in the configured order, before its own subtree.
+
+    Each item is a transform name or a dictionary of the name and the parameters
+    """
+    registry = get_transforms()
+
+    trees = {'notebook': {}, 'cell': {}}
+
+    for transform in transforms:
+        if isinstance(transform, str):
+            transform = {'name': transform}
+
+        params = dict(transform)
+        name = params.pop('name')
+
+        assert name in registry, f"unknown transform {name}; choose from {tuple(registry)}"
+
+        for path in registry[name]['keys']:
+            add_key_rule(trees[registry[name]['scope']], path, (registry[name]['function'], params))
+
+    def visitor(ipynb_json:Dict):
+        visit_key_tree(ipynb_json, trees['notebook'])
+
+        if not trees['cell']:
+            return
+
+        for cell in ipynb_json["cells"]:
+            visit_key_tree(cell, trees['cell'])
+
+    return visitor
+
+
+def add_key_rule(tree:Dict[str, Dict], path:str, rule:Tuple[Callable, Dict]):
+    """
+    tree : {key: {'rules': [(function, params)], 'children': tree, 'items': tree of each list item}}
+    """
+    *parents, key = path.split('.')
+
+    for parent in parents:
+        node = tree.setdefault(parent.rstrip('[]'), {'rules': [], 'children': {}, 'items': {}})
+        tree = node['items'] if parent.endswith('[]') else node['children']
+
+    tree.setdefault(key, {'rules': [], 'children': {}, 'items': {}})['rules'].append(rule)
+
+
+def visit_key_tree(owner:Dict, tree:Dict[str, Dict]):
+    for key, node in tree.items():
+        if key not in owner:
+            continue
+
+        for function, params in node['rules']:
+            function(owner, key, **params)
+
+            if key not in owner:
+                break
+        else:
+            value = owner[key]
+
+            if node['children'] and isinstance(value, dict):
+                visit_key_tree(value, node['children'])
+
+            if node['items'] and isinstance(value, list):
+                for item in value:
+                    if isinstance(item, dict):
+                        visit_key_tree(item, node['items'])
+
 
-    for cell in ipynb_json["cells"]:
-        remove_metadata_id_from_cell(cell, allowed)
-        remove_id_from_cell(cell)
-        remove_output_id_from_cell(cell)
+def drop_key(owner:Dict, key:str):
+    del owner[key]
 
-    for cell in ipynb_json["cells"]:
-        assert "id" not in cell
 
-    with dest_path.open('w', encoding="utf-8") as f:
-        json.dump(ipynb_json, f, indent=1, ensure_ascii=False)
+def drop_key_unless_allowed(owner:Dict, key:str, allowed:Tuple[str]=('view-in-github',)):
+    if owner[key] not in allowed:
+        del owner[key]
+
+
+def drop_cell_id(cell:Dict, key:str):
+    if cell.get("cell_type") in ("markdown", "code"):
+        del cell[key]
 
 
-def remove_id_from_cell(cell:nbformat.NotebookNode):
+def reset_key(owner:Dict, key:str):
+    owner[key] = None
+
+
+def drop_large_items(owner:Dict, key:str, max_kb:float=100):
+    owner[key] = [
+        item for item in owner[key]
+        if len(json.dumps(item, ensure_ascii=False).encode()) <= (max_kb * 1024)
+    ]
+
+
+def remove_id_from_cell(cell:'nbformat.NotebookNode'):
     if cell.get("cell_type") in ("markdown", "code"):
         if "id" in cell:
             del cell["id"]
 
 
-def remove_output_id_from_cell(cell:nbformat.NotebookNode, allowed:Tuple[str]=('view-in-github',)):
+def remove_output_id_from_cell(cell:'nbformat.NotebookNode'):
     if "metadata" in cell:
         if "colab" in cell["metadata"]:
             del cell["metadata"]["colab"]
@@ -395,7 +3723,7 @@ def remove_output_id_from_cell(cell:nbformat.NotebookNode, allowed:Tuple[str]=('
             del cell["metadata"]["outputId"]
 
 
-def remove_metadata_id_from_cell(cell:nbformat.NotebookNode, allowed:Tuple[str]=('view-in-github',)):
+def remove_metadata_id_from_cell(cell:'nbformat.NotebookNode', allowed:Tuple[str]=('view-in-github',)):
     if "metadata" in cell:
         if "id" in cell["metadata"]:
             if cell["metadata"]["id"] not in allowed:
@@ -418,8 +3746,9 @@ def verify_processed_ipynb__without_colab_links(src_before_ipynb_path:pathlib.Pa
     with tempfile.TemporaryDirectory() as tmpdir:
         tmpdir = pathlib.Path(tmpdir)
 
-        src_after_ipynb_path = tmpdir / (src_before_ipynb_path.name)
-        dest_after_ipynb_path = tmpdir / (dest_before_ipynb_path.name)
+        # the two may have the same name
+        src_after_ipynb_path = tmpdir / ('src_' + src_before_ipynb_path.name)
+        dest_after_ipynb_path = tmpdir / ('dest_' + dest_before_ipynb_path.name)
 
         remove_colab_button(src_before_ipynb_path, src_after_ipynb_path)
         remove_colab_button(dest_before_ipynb_path, dest_after_ipynb_path)
@@ -443,8 +3772,9 @@ def verify_processed_ipynb(src_ipynb_path:pathlib.Path, dest_ipynb_path:pathlib.
 
     with tempfile.TemporaryDirectory() as tmpdir:
         tmpdir = pathlib.Path(tmpdir)
-        src_py_path = tmpdir / (src_ipynb_path.stem + '.py')
-        dest_py_path = tmpdir / (dest_ipynb_path.stem + '.py')
+        # the two may have the same name, e.g. in the worktree engine
+        src_py_path = tmpdir / ('src_' + src_ipynb_path.stem + '.py')
+        dest_py_path = tmpdir / ('dest_' + dest_ipynb_path.stem + '.py')
 
         check_output(get_nbconvert_python_cmd(src_ipynb_path, src_py_path))
         check_output(get_nbconvert_python_cmd(dest_ipynb_path, dest_py_path))
@@ -498,10 +3828,15 @@ def get_commiter_info_hash(repo, sha:str):
 def parse_argv(argv:List[str]) -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Unify ipynb format")
 
-    parser.add_argument(
-        "-r", "--repo", type=str, required=True,
+    repo_group = parser.add_mutually_exclusive_group()
+    repo_group.add_argument(
+        "-r", "--repo", type=str, default=None,
         help="repository folder"
     )
+    repo_group.add_argument(
+        "--git-dir", type=str, default=None,
+        help="git folder, for example a bare mirror (default: $GIT_DIR)"
+    )
     parser.add_argument(
         "-f", "--first", type=str, required=True,
         help="first commit"
@@ -514,14 +3849,585 @@ def parse_argv(argv:List[str]) -> argparse.Namespace:
         "-b", "--branch", type=str, required=True,
         help="temporary branch name"
     )
+    parser.add_argument(
+        "--drop-empty", action="store_true",
+        help="skip commits that become empty after processing"
+    )
+    parser.add_argument(
+        "--coalesce-window", type=int, default=None, metavar="SECONDS",
+        help="write consecutive commits of the same author within SECONDS as one commit, e.g. autosaves"
+    )
+    parser.add_argument(
+        "--map", type=str, default=None,
+        help="file to write the original to rewritten commit sha map"
+    )
+    parser.add_argument(
+        "--engine", choices=("worktree", "plumbing"), default=None,
+        help="'plumbing' needs no working tree (default: 'plumbing' only if there is no working tree)"
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=None,
+        help="'plumbing' engine: worker processes for the notebooks, the largest first (default: 1, in-process)"
+    )
+    parser.add_argument(
+        "--memory-budget", type=int, default=None,
+        help="'plumbing' engine with --jobs: MB of memory the notebooks in process may take (default: half of the available memory)"
+    )
+    parser.add_argument(
+        "--nice", type=int, default=None,
+        help="'plumbing' engine with --jobs: niceness increment of the worker processes"
+    )
+    parser.add_argument(
+        "--ionice", action="store_true",
+        help="'plumbing' engine with --jobs: run the worker processes in the idle io scheduling class"
+    )
+    parser.add_argument(
+        "--job", type=str, default=None,
+        help="'plumbing' engine: write the new branch as refs/rebase_ipynb/JOB/heads/BRANCH"
+    )
+    parser.add_argument(
+        "--backend", choices=tuple(get_backends()), default='subprocess',
+        help="'plumbing' engine: 'dulwich' reads and writes git objects in-process (default: subprocess)"
+    )
+    parser.add_argument(
+        "--sparse", action="store_true",
+        help="'worktree' engine: check out only the folders of the changed files during the run"
+    )
+    parser.add_argument(
+        "--rewrite-refs", type=str, action="append", default=[], metavar="PATTERN",
+        help="point the refs matching the pattern to the rewritten commits, e.g. 'refs/tags/'; may repeat"
+    )
+    parser.add_argument(
+        "--cache", type=str, default=None,
+        help="'plumbing' engine: processed blob cache folder, may be shared with other runs"
+    )
+    parser.add_argument(
+        "--events", type=str, default=None,
+        help="json lines progress events file, '-' for stderr"
+    )
+    parser.add_argument(
+        "--prometheus", type=str, default=None,
+        help="prometheus textfile collector file of the progress"
+    )
+    parser.add_argument(
+        "--externalize-threshold", type=int, default=None, metavar="N_CHARS",
+        help="move base64 outputs (images, pdf) longer than this to content addressed files"
+    )
+    parser.add_argument(
+        "--externalize-folder", type=str, default='.ipynb_outputs',
+        help="folder of the externalized outputs in the repository (default: .ipynb_outputs)"
+    )
+    parser.add_argument(
+        "--transforms", type=str, default=None,
+        help="json file of the transforms to apply (default: remove the ids)"
+    )
+    parser.add_argument(
+        "--validate", action="store_true",
+        help="check each cleaned notebook against the nbformat v4 schema"
+    )
+    parser.add_argument(
+        "--verify", choices=Verifier.levels, default='full',
+        help="'deferred' audits the whole rewritten range at the end and reports all mismatches; "
+             "'full' compares only the code and markdown in-process, no longer the nbconvert round-trip; "
+             "'nbconvert' compares the `jupyter nbconvert --to python` outputs as 'full' used to (default: full)"
+    )
+    parser.add_argument(
+        "--verify-sample", type=int, default=10, metavar="N",
+        help="--verify=sample checks one out of N notebook blobs (default: 10)"
+    )
+    parser.add_argument(
+        "--repack", action="store_true",
+        help="pack the new objects, then write the commit-graph and the multi-pack-index"
+    )
+    parser.add_argument(
+        "--pack-report", type=str, default=None,
+        help="json file comparing the original and the rewritten object counts and sizes; implies --repack"
+    )
+
+    return parser.parse_args(argv)
+
+
+def parse_fleet_argv(argv:List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="rebase_ipynb.py fleet", description="Unify ipynb format of many repositories")
+
+    parser.add_argument(
+        "manifest", type=str,
+        help="json lines file of the jobs : repo, first, last, branch"
+    )
+    parser.add_argument(
+        "--cache", type=str, required=True,
+        help="processed blob cache folder shared by all the jobs"
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=None,
+        help="number of worker processes (default: number of cpus)"
+    )
+    parser.add_argument(
+        "--nice", type=int, default=None,
+        help="niceness increment of the worker processes"
+    )
+    parser.add_argument(
+        "--ionice", action="store_true",
+        help="run the worker processes in the idle io scheduling class"
+    )
+    parser.add_argument(
+        "--summary", type=str, default=None,
+        help="json file to write the summary of each repository"
+    )
+
+    return parser.parse_args(argv)
+
+
+def main_fleet(argv:List[str]):
+    parsed = parse_fleet_argv(argv)
+
+    summary = process_fleet(
+        read_fleet_manifest(pathlib.Path(parsed.manifest)),
+        pathlib.Path(parsed.cache),
+        max_workers=parsed.jobs,
+        nice=parsed.nice,
+        ionice=parsed.ionice,
+    )
+
+    summary_txt = json.dumps(summary, indent=1)
+
+    if parsed.summary is None:
+        print(summary_txt)
+    else:
+        pathlib.Path(parsed.summary).write_text(summary_txt, encoding="utf-8")
+
+    if any(map(lambda s: 'ok' != s['status'], summary)):
+        sys.exit(1)
+
+
+def parse_restore_argv(argv:List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="rebase_ipynb.py restore", description="Put the externalized outputs back into the notebooks")
+
+    parser.add_argument(
+        "notebooks", type=str, nargs='+',
+        help="ipynb files"
+    )
+    parser.add_argument(
+        "--outputs-folder", type=str, default='.ipynb_outputs',
+        help="folder of the externalized outputs (default: .ipynb_outputs)"
+    )
+
+    return parser.parse_args(argv)
+
+
+def main_restore(argv:List[str]):
+    parsed = parse_restore_argv(argv)
+
+    for notebook in parsed.notebooks:
+        restore_outputs_file(pathlib.Path(notebook), pathlib.Path(parsed.outputs_folder))
+
+
+def parse_compare_argv(argv:List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="rebase_ipynb.py compare", description="Check that two configurations rewrite the same commits")
+
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("-r", "--repo", type=str, help="repository folder (default: current folder)")
+    group.add_argument("--git-dir", type=str, default=None, help="git directory, possibly of a bare repository")
+
+    parser.add_argument("-f", "--first", type=str, required=True, help="first commit")
+    parser.add_argument("-l", "--last", type=str, required=True, help="last commit")
+    parser.add_argument(
+        "--config-a", type=str, default='{"engine": "worktree"}',
+        help='json of the first configuration, e.g. \'{"engine": "worktree"}\' (default)'
+    )
+    parser.add_argument(
+        "--config-b", type=str, default='{"engine": "plumbing"}',
+        help='json of the second configuration : engine, backend, drop_empty, sparse, jobs, memory_budget, nice, ionice, coalesce_window, cache, '
+             'externalize_threshold, externalize_folder, transforms, validate (default: \'{"engine": "plumbing"}\')'
+    )
+    parser.add_argument(
+        "--branches", type=str, nargs=2, default=('determinism-a', 'determinism-b'),
+        help="new branch of each configuration (default: determinism-a determinism-b)"
+    )
+
+    return parser.parse_args(argv)
+
+
+def get_process_commits_kwargs(config:Dict) -> Dict:
+    """
+    Keyword arguments of process_commits() from a json configuration
+    """
+    config = dict(config)
+
+    kwargs = {}
+
+    for key in ('engine', 'backend', 'drop_empty', 'sparse', 'jobs', 'memory_budget', 'nice', 'ionice', 'coalesce_window'):
+        if key in config:
+            kwargs[key] = config.pop(key)
+
+    if 'cache' in config:
+        kwargs['cache'] = BlobCache(pathlib.Path(config.pop('cache')))
+
+    transforms = config.pop('transforms', None)
+
+    kwargs['clean_options'] = get_clean_options(
+        externalize_threshold=config.pop('externalize_threshold', None),
+        externalize_folder=config.pop('externalize_folder', '.ipynb_outputs'),
+        transforms=read_transforms_config(pathlib.Path(transforms)) if isinstance(transforms, str) else transforms,
+        validate=config.pop('validate', False),
+    )
+
+    assert not config, f"unknown configuration keys {sorted(config)}"
+
+    return kwargs
+
+
+def main_compare(argv:List[str]):
+    parsed = parse_compare_argv(argv)
+
+    report = compare_rewrites(
+        get_repo_folder_path(parsed), parsed.first, parsed.last,
+        (
+            get_process_commits_kwargs(json.loads(parsed.config_a)),
+            get_process_commits_kwargs(json.loads(parsed.config_b)),
+        ),
+        branches=tuple(parsed.branches),
+    )
+
+    print(json.dumps(report, indent=1))
+
+    if not report['identical']:
+        sys.exit(1)
+
+
+def parse_normalize_argv(argv:List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="rebase_ipynb.py normalize", description="Unify ipynb format of the working tree in place")
+
+    parser.add_argument(
+        "notebooks", type=str, nargs='*',
+        help="ipynb files (default: all ipynb files of the working tree not ignored by git)"
+    )
+    parser.add_argument(
+        "-r", "--repo", type=str, default='.',
+        help="root of the working tree (default: current folder)"
+    )
+    parser.add_argument(
+        "--stat-cache", type=str, default=None,
+        help="stat cache file (default: rebase_ipynb/normalize.json in the git directory)"
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=None,
+        help="maximum number of worker processes for the changed notebooks (default: idle cpus)"
+    )
+    parser.add_argument(
+        "--memory-budget", type=int, default=None,
+        help="MB of memory the notebooks in process may take (default: half of the available memory)"
+    )
+    parser.add_argument(
+        "--nice", type=int, default=None,
+        help="niceness increment of the worker processes"
+    )
+    parser.add_argument(
+        "--ionice", action="store_true",
+        help="run the worker processes in the idle io scheduling class"
+    )
+    parser.add_argument(
+        "--externalize-threshold", type=int, default=None,
+        help="move base64 outputs longer than this many characters to files"
+    )
+    parser.add_argument(
+        "--externalize-folder", type=str, default='.ipynb_outputs',
+        help="folder of the externalized outputs, relative to the repository (default: .ipynb_outputs)"
+    )
+    parser.add_argument(
+        "--transforms", type=str, default=None,
+        help="json file of the transforms to apply"
+    )
+    parser.add_argument(
+        "--validate", action="store_true",
+        help="check each cleaned notebook against the nbformat v4 schema"
+    )
+
+    return parser.parse_args(argv)
+
+
+def main_normalize(argv:List[str]):
+    """
+    Exits with 1 if any notebook was modified, as pre-commit hooks do
+    """
+    parsed = parse_normalize_argv(argv)
+
+    root = pathlib.Path(parsed.repo).resolve(strict=True)
+
+    if parsed.notebooks:
+        paths = [
+            pathlib.Path(os.path.relpath(pathlib.Path(notebook).resolve(), root)).as_posix()
+            for notebook in parsed.notebooks
+        ]
+    else:
+        paths = None
+
+    result = normalize_notebooks(
+        root, paths=paths,
+        cache_path=None if parsed.stat_cache is None else pathlib.Path(parsed.stat_cache),
+        clean_options=get_clean_options(
+            externalize_threshold=parsed.externalize_threshold,
+            externalize_folder=parsed.externalize_folder,
+            transforms=None if parsed.transforms is None else read_transforms_config(pathlib.Path(parsed.transforms)),
+            validate=parsed.validate,
+        ),
+        governor=get_governor(parsed),
+    )
+
+    for path in result['modified']:
+        print(f'normalized {path}')
+
+    if result['modified']:
+        sys.exit(1)
+
+
+def parse_textconv_argv(argv:List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="rebase_ipynb.py textconv", description="Print the code and markdown of a notebook for git diff")
+
+    parser.add_argument(
+        "notebook", type=str,
+        help="ipynb file given by git"
+    )
+    parser.add_argument(
+        "--cache", type=str, default=None,
+        help="converted text cache folder, keyed by the blob sha"
+    )
+
+    return parser.parse_args(argv)
+
+
+def main_textconv(argv:List[str]):
+    parsed = parse_textconv_argv(argv)
+
+    text = textconv_notebook(
+        pathlib.Path(parsed.notebook),
+        cache=None if parsed.cache is None else BlobCache(pathlib.Path(parsed.cache)),
+    )
+
+    sys.stdout.buffer.write(text.encode('utf-8'))
+
+
+def parse_install_textconv_argv(argv:List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="rebase_ipynb.py install-textconv", description="Register the notebook textconv diff driver")
+
+    parser.add_argument(
+        "-r", "--repo", type=str, default='.',
+        help="repository folder (default: current folder)"
+    )
+    parser.add_argument(
+        "--driver", type=str, default='ipynb',
+        help="name of the diff driver (default: ipynb)"
+    )
+
+    return parser.parse_args(argv)
+
+
+def main_install_textconv(argv:List[str]):
+    parsed = parse_install_textconv_argv(argv)
+
+    install_textconv(pathlib.Path(parsed.repo).resolve(strict=True), driver=parsed.driver)
+
+
+def parse_analyze_argv(argv:List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="rebase_ipynb.py analyze", description="Attribute the bytes of the notebooks in a range")
+
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("-r", "--repo", type=str, help="repository folder (default: current folder)")
+    group.add_argument("--git-dir", type=str, default=None, help="git directory, possibly of a bare repository")
+
+    parser.add_argument("-f", "--first", type=str, required=True, help="first commit")
+    parser.add_argument("-l", "--last", type=str, required=True, help="last commit")
+    parser.add_argument(
+        "-o", "--output", type=str, default=None,
+        help="file to write the result (default: standard output)"
+    )
+    parser.add_argument(
+        "--format", type=str, choices=('csv', 'json'), default=None,
+        help="output format (default: from the output file suffix, otherwise csv)"
+    )
+
+    return parser.parse_args(argv)
+
+
+def main_analyze(argv:List[str]):
+    parsed = parse_analyze_argv(argv)
+
+    rows = analyze_range(get_repo_folder_path(parsed), parsed.first, parsed.last)
+
+    output_format = parsed.format
+    if output_format is None:
+        output_format = 'json' if (parsed.output or '').endswith('.json') else 'csv'
+
+    if parsed.output is None:
+        write_analysis(rows, sys.stdout, output_format)
+    else:
+        with open(parsed.output, 'w', encoding="utf-8", newline='') as f:
+            write_analysis(rows, f, output_format)
+
+
+def parse_snapshot_argv(argv:List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="rebase_ipynb.py snapshot", description="Unify ipynb format of a whole tree in one commit")
+
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("-r", "--repo", type=str, help="repository folder (default: current folder)")
+    group.add_argument("--git-dir", type=str, default=None, help="git directory, possibly of a bare repository")
+
+    parser.add_argument("--ref", type=str, default='HEAD', help="commit of the tree to clean (default: HEAD)")
+    parser.add_argument("-b", "--branch", type=str, required=True, help="new branch")
+    parser.add_argument(
+        "-m", "--message", type=str, default='Unify ipynb format',
+        help="commit message (default: Unify ipynb format)"
+    )
+    parser.add_argument(
+        "--cache", type=str, default=None,
+        help="processed blob cache folder"
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=None,
+        help="maximum number of worker processes (default: idle cpus)"
+    )
+    parser.add_argument(
+        "--memory-budget", type=int, default=None,
+        help="MB of memory the notebooks in process may take (default: half of the available memory)"
+    )
+    parser.add_argument(
+        "--nice", type=int, default=None,
+        help="niceness increment of the worker processes"
+    )
+    parser.add_argument(
+        "--ionice", action="store_true",
+        help="run the worker processes in the idle io scheduling class"
+    )
+    parser.add_argument(
+        "--externalize-threshold", type=int, default=None,
+        help="move base64 outputs longer than this many characters to files"
+    )
+    parser.add_argument(
+        "--externalize-folder", type=str, default='.ipynb_outputs',
+        help="folder of the externalized outputs, relative to the repository (default: .ipynb_outputs)"
+    )
+    parser.add_argument(
+        "--transforms", type=str, default=None,
+        help="json file of the transforms to apply"
+    )
+    parser.add_argument(
+        "--validate", action="store_true",
+        help="check each cleaned notebook against the nbformat v4 schema"
+    )
+    parser.add_argument(
+        "--verify", choices=tuple(level for level in Verifier.levels if 'deferred' != level), default='full',
+        help="compare the code and markdown of each cleaned notebook with the original (default: full)"
+    )
+    parser.add_argument(
+        "--verify-sample", type=int, default=10, metavar="N",
+        help="--verify=sample checks one out of N notebook blobs (default: 10)"
+    )
 
     return parser.parse_args(argv)
 
 
+def main_snapshot(argv:List[str]):
+    parsed = parse_snapshot_argv(argv)
+
+    print(
+        process_snapshot(
+            get_repo_folder_path(parsed), parsed.ref, parsed.branch,
+            message=parsed.message,
+            cache=None if parsed.cache is None else BlobCache(pathlib.Path(parsed.cache)),
+            clean_options=get_clean_options(
+                externalize_threshold=parsed.externalize_threshold,
+                externalize_folder=parsed.externalize_folder,
+                transforms=None if parsed.transforms is None else read_transforms_config(pathlib.Path(parsed.transforms)),
+                validate=parsed.validate,
+            ),
+            governor=get_governor(parsed),
+            verifier=Verifier(parsed.verify, sample_rate=parsed.verify_sample),
+        )
+    )
+
+
+def get_governor(parsed:argparse.Namespace) -> ResourceGovernor:
+    return ResourceGovernor(
+        memory_budget=None if parsed.memory_budget is None else parsed.memory_budget * 2**20,
+        max_workers=parsed.jobs,
+        nice=parsed.nice,
+        ionice=parsed.ionice,
+    )
+
+
+def get_subcommands() -> Dict:
+    return {
+        'analyze': main_analyze,
+        'compare': main_compare,
+        'fleet': main_fleet,
+        'install-textconv': main_install_textconv,
+        'normalize': main_normalize,
+        'restore': main_restore,
+        'snapshot': main_snapshot,
+        'textconv': main_textconv,
+    }
+
+
 def main(argv:List[str]):
+    subcommands = get_subcommands()
+
+    if (1 < len(argv)) and (argv[1] in subcommands):
+        return subcommands[argv[1]](argv[2:])
+
     parsed = parse_argv(argv[1:])
 
-    process_commits(pathlib.Path(parsed.repo).absolute(), parsed.first, parsed.last, parsed.branch)
+    repo = get_repo_folder_path(parsed)
+
+    verifier = Verifier(parsed.verify, sample_rate=parsed.verify_sample)
+
+    with contextlib.ExitStack() as stack:
+        if parsed.events is None:
+            events = None
+        elif '-' == parsed.events:
+            events = sys.stderr
+        else:
+            events = stack.enter_context(open(parsed.events, 'a', encoding="utf-8"))
+
+        sha_map = process_commits(
+            repo, parsed.first, parsed.last, parsed.branch,
+            drop_empty=parsed.drop_empty,
+            engine=parsed.engine,
+            backend=parsed.backend,
+            job=parsed.job,
+            jobs=parsed.jobs,
+            memory_budget=None if parsed.memory_budget is None else parsed.memory_budget * 2**20,
+            nice=parsed.nice,
+            ionice=parsed.ionice,
+            coalesce_window=parsed.coalesce_window,
+            sparse=parsed.sparse,
+            cache=None if parsed.cache is None else BlobCache(pathlib.Path(parsed.cache)),
+            reporter=ProgressReporter(events=events, prometheus_path=parsed.prometheus),
+            clean_options=get_clean_options(
+                externalize_threshold=parsed.externalize_threshold,
+                externalize_folder=parsed.externalize_folder,
+                transforms=None if parsed.transforms is None else read_transforms_config(pathlib.Path(parsed.transforms)),
+                validate=parsed.validate,
+            ),
+            verifier=verifier,
+        )
+
+    if parsed.map is not None:
+        write_sha_map(sha_map, pathlib.Path(parsed.map))
+
+    if verifier.mismatches:
+        print(json.dumps(verifier.mismatches, indent=1), file=sys.stderr)
+        sys.exit(1)
+
+    if parsed.rewrite_refs:
+        rewrite_refs(repo, sha_map, parsed.rewrite_refs)
+
+    if parsed.repack or (parsed.pack_report is not None):
+        report = repack_rewritten(
+            repo, git_parent_sha(repo, parsed.first), parsed.last, parsed.branch, job=parsed.job
+        )
+
+        if parsed.pack_report is not None:
+            pathlib.Path(parsed.pack_report).write_text(json.dumps(report, indent=1), encoding="utf-8")
 
 
 if __name__ == '__main__':
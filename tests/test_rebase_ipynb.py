@@ -1,4 +1,6 @@
+import io
 import json
+import os
 import pathlib
 import random
 import shutil
@@ -7,7 +9,7 @@ import sys
 import tempfile
 import urllib.parse as up
 
-from typing import Dict, List, Tuple, Union
+from typing import Callable, Dict, List, Tuple, Union
 
 import pytest
 
@@ -159,6 +161,72 @@ def repo_info(request) -> Repo_Info:
         }
 
 
+def make_notebook(sources:Tuple[str], cell_id_prefix:str='cell') -> str:
+    return json.dumps(
+        {
+            "cells": [
+                {
+                    "cell_type": "code",
+                    "execution_count": None,
+                    "id": f"{cell_id_prefix}{i}",
+                    "metadata": {"id": f"{cell_id_prefix}{i}"},
+                    "outputs": [],
+                    "source": [source],
+                }
+                for i, source in enumerate(sources)
+            ],
+            "metadata": {},
+            "nbformat": 4,
+            "nbformat_minor": 5,
+        },
+        indent=1,
+    )
+
+
+def git_commit_all(repo:pathlib.Path, message:str) -> str:
+    subprocess.check_call(['git', 'add', '-A'], cwd=repo)
+    subprocess.check_call(['git', 'commit', '-q', '-m', message], cwd=repo)
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=repo, encoding='utf-8').strip()
+
+
+@pytest.fixture
+def local_repo_info() -> Repo_Info:
+    """
+    Offline repository
+    the second notebook commit only changes cell ids
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        repo = pathlib.Path(tmpdir) / 'local'
+        repo.mkdir()
+
+        subprocess.check_call(['git', 'init', '-q', '-b', 'main'], cwd=repo)
+        subprocess.check_call(['git', 'config', 'user.name', 'Test User'], cwd=repo)
+        subprocess.check_call(['git', 'config', 'user.email', 'test@example.com'], cwd=repo)
+
+        (repo / 'README.md').write_text('local\n')
+        (repo / 'data').mkdir()
+        (repo / 'data' / 'big.bin').write_bytes(bytes(range(256)) * 16)
+        root = git_commit_all(repo, 'root')
+
+        (repo / 'nb').mkdir()
+        (repo / 'nb' / 'a.ipynb').write_text(make_notebook(('a = 1\n',), 'x'))
+        first = git_commit_all(repo, 'add a.ipynb')
+
+        (repo / 'nb' / 'a.ipynb').write_text(make_notebook(('a = 1\n',), 'y'))
+        ids_only = git_commit_all(repo, 'colab save')
+
+        (repo / 'nb' / 'a.ipynb').write_text(make_notebook(('a = 1\n', 'b = 2\n'), 'z'))
+        last = git_commit_all(repo, 'add b')
+
+        yield {
+            'path': repo,
+            'root': root,
+            'first': first,
+            'last': last,
+            'commits_original': (first, ids_only, last),
+        }
+
+
 def test_get_commit_info_from_show__two_files_changed():
     git_show_msg = (
         "commit c759024d70d6719b33cc8e10533f2bcdbcd18abe\n"
@@ -302,6 +370,23 @@ def test_verify_processed_ipynb__not_equal():
     assert not rebase_ipynb.verify_processed_ipynb(src_ipynb_path, dest_ipynb_path)
 
 
+def test_verifier__nbconvert_same_file_name(tmp_path:pathlib.Path):
+    # as in the worktree engine : the original and the processed file share the name
+    src = tmp_path / 'src' / 'a.ipynb'
+    dest = tmp_path / 'dest' / 'a.ipynb'
+
+    src.parent.mkdir()
+    dest.parent.mkdir()
+
+    shutil.copy(test_folder / 'ne_colab.ipynb', src)
+    shutil.copy(test_folder / 'eq_local_with_button.ipynb', dest)
+
+    # function under test
+    assert not rebase_ipynb.Verifier('nbconvert').verify(src, dest, '0' * 40)
+
+    assert rebase_ipynb.Verifier('nbconvert').verify(src, src, '0' * 40)
+
+
 def test_remove_colab_button__eq_local():
     src_ipynb_path = test_folder / 'eq_local_with_button.ipynb'
     assert src_ipynb_path.exists()
@@ -575,6 +660,1295 @@ def test_process_commits(repo_info:Repo_Info):
             )
 
 
+def test_process_commits__drop_empty(local_repo_info:Repo_Info):
+    repo = local_repo_info["path"]
+    first, ids_only, last = local_repo_info["commits_original"]
+
+    # function under test
+    sha_map = rebase_ipynb.process_commits(repo, first, last, 'cleaned', drop_empty=True)
+
+    new_shas = subprocess.check_output(
+        ['git', 'log', '--reverse', '--pretty=format:%H', f'{local_repo_info["root"]}..cleaned'],
+        cwd=repo, encoding='utf-8'
+    ).splitlines()
+
+    # the ids only commit is gone
+    assert len(new_shas) == 2, new_shas
+
+    assert set(sha_map) == {first, ids_only, last}
+    assert sha_map[first] == new_shas[0]
+    assert sha_map[ids_only] == new_shas[0]
+    assert sha_map[last] == new_shas[1]
+
+
+def test_process_commits__keep_empty(local_repo_info:Repo_Info):
+    repo = local_repo_info["path"]
+    first, ids_only, last = local_repo_info["commits_original"]
+
+    sha_map = rebase_ipynb.process_commits(repo, first, last, 'cleaned')
+
+    assert len(set(sha_map.values())) == 3
+
+
+def test_write_sha_map():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        map_path = pathlib.Path(tmpdir) / 'map.txt'
+
+        rebase_ipynb.write_sha_map({'a' * 40: 'b' * 40, 'c' * 40: 'b' * 40}, map_path)
+
+        assert map_path.read_text().splitlines() == [
+            f"{'a' * 40} {'b' * 40}",
+            f"{'c' * 40} {'b' * 40}",
+        ]
+
+
+def test_process_commits__plumbing_same_as_worktree(local_repo_info:Repo_Info):
+    repo = local_repo_info["path"]
+    first = local_repo_info["first"]
+    last = local_repo_info["last"]
+
+    sha_map_worktree = rebase_ipynb.process_commits(repo, first, last, 'worktree', engine='worktree')
+
+    # function under test
+    sha_map_plumbing = rebase_ipynb.process_commits(repo, first, last, 'plumbing', engine='plumbing')
+
+    assert sha_map_plumbing == sha_map_worktree
+
+    head = subprocess.check_output(['git', 'rev-parse', 'plumbing'], cwd=repo, encoding='utf-8').strip()
+    assert head == sha_map_worktree[local_repo_info["commits_original"][-1]]
+
+
+def test_process_commits__bare(local_repo_info:Repo_Info):
+    bare = local_repo_info["path"].parent / 'bare.git'
+    subprocess.check_call(['git', 'clone', '-q', '--bare', str(local_repo_info["path"]), str(bare)])
+
+    rebase_ipynb.assert_git_repo(bare)
+    assert 'plumbing' == rebase_ipynb.get_default_engine(bare)
+
+    first, ids_only, last = local_repo_info["commits_original"]
+
+    # function under test
+    sha_map = rebase_ipynb.process_commits(bare, first, last, 'cleaned', drop_empty=True)
+
+    assert sha_map[ids_only] == sha_map[first]
+
+    nb = json.loads(
+        subprocess.check_output(['git', 'show', 'cleaned:nb/a.ipynb'], cwd=bare, encoding='utf-8')
+    )
+
+    assert 2 == len(nb["cells"])
+    for cell in nb["cells"]:
+        assert "id" not in cell
+        assert "id" not in cell["metadata"]
+
+
+def test_main__git_dir_env_relative(local_repo_info:Repo_Info, monkeypatch:pytest.MonkeyPatch):
+    repo = local_repo_info["path"]
+    mirror = repo.parent / 'mirror.git'
+    subprocess.check_call(['git', 'clone', '-q', '--mirror', str(repo), str(mirror)])
+
+    monkeypatch.chdir(repo.parent)
+    monkeypatch.setenv('GIT_DIR', 'mirror.git')
+
+    # function under test
+    rebase_ipynb.main(['rebase_ipynb.py', '-f', local_repo_info["first"], '-l', local_repo_info["last"], '-b', 'c1'])
+
+    assert 'GIT_DIR' not in os.environ
+    assert 2 == len(json.loads(
+        subprocess.check_output(['git', 'show', 'c1:nb/a.ipynb'], cwd=mirror, encoding='utf-8')
+    )["cells"])
+
+
+def test_main__git_dir_env_dot_git(local_repo_info:Repo_Info, monkeypatch:pytest.MonkeyPatch, tmp_path:pathlib.Path):
+    repo = local_repo_info["path"]
+
+    assert 'plumbing' == rebase_ipynb.get_default_engine(repo / '.git')
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('GIT_DIR', str(repo / '.git'))
+
+    # function under test
+    rebase_ipynb.main(['rebase_ipynb.py', '-f', local_repo_info["first"], '-l', local_repo_info["last"], '-b', 'c2'])
+
+    # plumbing : nothing checked out inside .git, the working tree untouched
+    assert not (repo / '.git' / 'nb').exists()
+    assert '' == subprocess.check_output(['git', 'status', '--porcelain'], cwd=repo, encoding='utf-8')
+    assert 'main' == subprocess.check_output(['git', 'branch', '--show-current'], cwd=repo, encoding='utf-8').strip()
+    subprocess.check_call(['git', 'rev-parse', '--verify', '-q', 'c2'], cwd=repo, stdout=subprocess.DEVNULL)
+
+
+def test_assert_git_repo__worktree_git_file(local_repo_info:Repo_Info):
+    repo = local_repo_info["path"]
+    worktree = repo.parent / 'other'
+
+    subprocess.check_call(['git', 'worktree', 'add', '-q', str(worktree), local_repo_info["root"]], cwd=repo)
+
+    # .git is a file
+    assert (worktree / '.git').is_file()
+
+    rebase_ipynb.assert_git_repo(worktree)
+    assert 'worktree' == rebase_ipynb.get_default_engine(worktree)
+
+
+@pytest.mark.parametrize('engine', ('worktree', 'plumbing'))
+def test_process_commits__delete_rename(local_repo_info:Repo_Info, engine:str):
+    repo = local_repo_info["path"]
+    first = local_repo_info["first"]
+
+    subprocess.check_call(['git', 'mv', 'nb/a.ipynb', 'nb/renamed.ipynb'], cwd=repo)
+    subprocess.check_call(['git', 'rm', '-q', 'data/big.bin'], cwd=repo)
+    last = git_commit_all(repo, 'rename and delete')
+
+    # function under test
+    sha_map = rebase_ipynb.process_commits(repo, first, last, 'cleaned', engine=engine)
+
+    assert sha_map[last] == subprocess.check_output(
+        ['git', 'rev-parse', 'cleaned'], cwd=repo, encoding='utf-8'
+    ).strip()
+
+    files = subprocess.check_output(
+        ['git', 'ls-tree', '-r', '--name-only', 'cleaned'], cwd=repo, encoding='utf-8'
+    ).splitlines()
+
+    assert files == ['README.md', 'nb/renamed.ipynb']
+
+
+@pytest.mark.parametrize('drop_empty', (False, True))
+def test_process_commits__dulwich_same_as_subprocess(local_repo_info:Repo_Info, drop_empty:bool):
+    pytest.importorskip('dulwich')
+
+    repo = local_repo_info["path"]
+    first = local_repo_info["first"]
+
+    subprocess.check_call(['git', 'mv', 'nb/a.ipynb', 'nb/renamed.ipynb'], cwd=repo)
+    subprocess.check_call(['git', 'rm', '-q', 'data/big.bin'], cwd=repo)
+    last = git_commit_all(repo, 'rename and delete\n\n  indented body  \n')
+
+    sha_map_subprocess = rebase_ipynb.process_commits(
+        repo, first, last, 'subprocess', drop_empty=drop_empty, engine='plumbing', backend='subprocess'
+    )
+
+    # function under test
+    sha_map_dulwich = rebase_ipynb.process_commits(
+        repo, first, last, 'dulwich', drop_empty=drop_empty, engine='plumbing', backend='dulwich'
+    )
+
+    assert sha_map_dulwich == sha_map_subprocess
+
+    head = subprocess.check_output(['git', 'rev-parse', 'dulwich'], cwd=repo, encoding='utf-8').strip()
+    assert head == sha_map_subprocess[last]
+
+
+def test_format_git_date__parse_git_date():
+    date = 'Wed Jan 4 20:57:54 2023 -0330'
+
+    timestamp, tz_offset = rebase_ipynb.parse_git_date(date)
+
+    assert -(3 * 3600 + 30 * 60) == tz_offset
+    assert date == rebase_ipynb.format_git_date(timestamp, tz_offset)
+
+
+@pytest.fixture
+def assert_same_rewrite(local_repo_info:Repo_Info) -> Callable[[Dict, Dict], Dict]:
+    """
+    Check that two configurations of process_commits() rewrite the local repo into the same commits
+    """
+    def check(config_a:Dict, config_b:Dict) -> Dict:
+        report = rebase_ipynb.compare_rewrites(
+            local_repo_info["path"], local_repo_info["first"], local_repo_info["last"], (config_a, config_b)
+        )
+
+        assert report['identical'], json.dumps(report['divergence'], indent=1)
+        assert report['divergence'] is None
+
+        return report
+
+    return check
+
+
+@pytest.mark.parametrize(
+    'config_a, config_b',
+    (
+        ({'engine': 'worktree'}, {'engine': 'plumbing'}),
+        ({'engine': 'worktree', 'drop_empty': True}, {'engine': 'plumbing', 'drop_empty': True}),
+        ({'engine': 'plumbing', 'backend': 'subprocess'}, {'engine': 'plumbing', 'backend': 'dulwich'}),
+        ({'engine': 'worktree'}, {'engine': 'plumbing', 'jobs': 2}),
+        ({'engine': 'plumbing', 'drop_empty': True}, {'engine': 'plumbing', 'drop_empty': True, 'jobs': 2}),
+    )
+)
+def test_compare_rewrites__identical(assert_same_rewrite, config_a:Dict, config_b:Dict):
+    if 'dulwich' == config_b.get('backend'):
+        pytest.importorskip('dulwich')
+
+    # function under test
+    report = assert_same_rewrite(config_a, config_b)
+
+    assert 3 == report['commits']
+
+
+def test_compare_rewrites__divergence(local_repo_info:Repo_Info):
+    repo = local_repo_info["path"]
+    first, ids_only, _ = local_repo_info["commits_original"]
+
+    nb = json.loads((repo / 'nb' / 'a.ipynb').read_text())
+    nb["cells"][0]["execution_count"] = 3
+    (repo / 'nb' / 'a.ipynb').write_text(json.dumps(nb, indent=1))
+    last = git_commit_all(repo, 'executed')
+
+    default_transforms = rebase_ipynb.get_default_transforms()
+
+    # function under test
+    report = rebase_ipynb.compare_rewrites(
+        repo, first, last,
+        (
+            {'engine': 'plumbing'},
+            {'engine': 'plumbing', 'clean_options': rebase_ipynb.get_clean_options(
+                transforms=default_transforms + ['strip_execution_count']
+            )},
+        )
+    )
+
+    assert not report['identical']
+
+    divergence = report['divergence']
+    assert last == divergence['commit']
+    assert 'nb/a.ipynb' == divergence['path']
+    assert divergence['blob_a'] != divergence['blob_b']
+    assert '-   "execution_count": 3,' in divergence['diff']
+    assert '+   "execution_count": null,' in divergence['diff']
+
+
+def test_get_process_commits_kwargs():
+    kwargs = rebase_ipynb.get_process_commits_kwargs(
+        {'engine': 'plumbing', 'drop_empty': True, 'externalize_threshold': 100, 'jobs': 2, 'nice': 5, 'ionice': True}
+    )
+
+    assert 'plumbing' == kwargs['engine']
+    assert kwargs['drop_empty']
+    assert 5 == kwargs['nice']
+    assert kwargs['ionice']
+    assert 100 == kwargs['clean_options']['externalize_threshold']
+
+    with pytest.raises(AssertionError):
+        rebase_ipynb.get_process_commits_kwargs({'engines': 'plumbing'})
+
+
+def test_normalize_notebooks(local_repo_info:Repo_Info):
+    repo = local_repo_info["path"]
+    nb_path = repo / 'nb' / 'a.ipynb'
+
+    # function under test
+    result = rebase_ipynb.normalize_notebooks(repo)
+
+    assert ['nb/a.ipynb'] == result['modified']
+    assert (rebase_ipynb.get_git_dir(repo) / 'rebase_ipynb' / 'normalize.json').exists()
+    for cell in json.loads(nb_path.read_text())["cells"]:
+        assert "id" not in cell
+
+    # nothing changed
+    assert ['nb/a.ipynb'] == rebase_ipynb.normalize_notebooks(repo)['skipped']
+
+    # touched only
+    st = os.stat(nb_path)
+    os.utime(nb_path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    assert ['nb/a.ipynb'] == rebase_ipynb.normalize_notebooks(repo)['skipped']
+
+    # edited
+    nb_path.write_text(make_notebook(['x = 1'], 'edited'))
+    (repo / 'b.ipynb').write_text(make_notebook(['y = 2']))
+
+    result = rebase_ipynb.normalize_notebooks(repo, max_workers=2)
+
+    assert ['b.ipynb', 'nb/a.ipynb'] == sorted(result['modified'])
+    assert [] == result['skipped']
+
+    # other clean options invalidate the cache
+    result = rebase_ipynb.normalize_notebooks(
+        repo, clean_options=rebase_ipynb.get_clean_options(externalize_threshold=1000)
+    )
+
+    assert ['b.ipynb', 'nb/a.ipynb'] == sorted(result['unchanged'])
+
+
+def test_is_stat_clean():
+    st = os.stat(__file__)
+    entry = rebase_ipynb.get_stat_entry(st, 'sha')
+
+    assert rebase_ipynb.is_stat_clean(entry, st, st.st_mtime_ns + 1)
+    assert not rebase_ipynb.is_stat_clean(None, st, st.st_mtime_ns + 1)
+    # racily clean
+    assert not rebase_ipynb.is_stat_clean(entry, st, st.st_mtime_ns)
+
+
+def test_get_git_blob_sha(tmp_path:pathlib.Path):
+    path = tmp_path / 'a.ipynb'
+    path.write_text(make_notebook(['x = 1']))
+
+    assert rebase_ipynb.get_git_blob_sha(path.read_bytes()) == subprocess.check_output(
+        ['git', 'hash-object', str(path)], encoding='utf-8'
+    ).strip()
+
+
+def test_textconv_notebook__cache(tmp_path:pathlib.Path):
+    path = tmp_path / 'a.ipynb'
+    path.write_text(make_notebook(['x = 1', 'y = 2']))
+
+    cache = rebase_ipynb.BlobCache(tmp_path / 'cache')
+
+    # function under test
+    text = rebase_ipynb.textconv_notebook(path, cache)
+
+    assert '# In[code]:\nx = 1\n' in text
+    assert (0, 1) == (cache.hits, cache.misses)
+
+    assert text == rebase_ipynb.textconv_notebook(path, cache)
+    assert (1, 1) == (cache.hits, cache.misses)
+
+    # not a notebook
+    path.write_text('not json')
+    assert 'not json' == rebase_ipynb.textconv_notebook(path)
+
+
+def test_install_textconv(local_repo_info:Repo_Info):
+    repo = local_repo_info["path"]
+
+    # function under test
+    rebase_ipynb.install_textconv(repo)
+    rebase_ipynb.install_textconv(repo)
+
+    attributes = (repo / '.git' / 'info' / 'attributes').read_text().splitlines()
+    assert 1 == attributes.count('*.ipynb diff=ipynb')
+
+    log = subprocess.check_output(
+        ['git', 'log', '-p', '--format=', local_repo_info["last"], '--', 'nb/a.ipynb'], cwd=repo, encoding='utf-8'
+    )
+
+    assert '+# In[code]:' in log
+    assert '"cells"' not in log
+    assert any((repo / '.git' / 'rebase_ipynb' / 'textconv').iterdir())
+
+
+def test_install_textconv__linked_worktree(local_repo_info:Repo_Info):
+    repo = local_repo_info["path"]
+    worktree = repo.parent / 'linked'
+    subprocess.check_call(['git', 'worktree', 'add', '-q', str(worktree), local_repo_info["last"]], cwd=repo)
+
+    # function under test
+    rebase_ipynb.install_textconv(worktree)
+
+    assert 'nb/a.ipynb: diff: ipynb' == subprocess.check_output(
+        ['git', 'check-attr', 'diff', 'nb/a.ipynb'], cwd=worktree, encoding='utf-8'
+    ).strip()
+    assert '+# In[code]:' in subprocess.check_output(
+        ['git', 'log', '-p', '--format=', '-1', '--', 'nb/a.ipynb'], cwd=worktree, encoding='utf-8'
+    )
+    assert any((repo / '.git' / 'rebase_ipynb' / 'textconv').iterdir())
+
+
+def test_analyze_range(local_repo_info:Repo_Info):
+    repo = local_repo_info["path"]
+    first = local_repo_info["first"]
+
+    nb = make_notebook_with_image('iVBORw0KGgo' * 100)
+    nb["metadata"]["colab"] = {"name": "plot.ipynb"}
+    (repo / 'plot.ipynb').write_text(json.dumps(nb))
+    # same blob twice
+    (repo / 'copy.ipynb').write_text(json.dumps(nb))
+    last = git_commit_all(repo, 'plot')
+
+    # function under test
+    rows = rebase_ipynb.analyze_range(repo, first, last)
+
+    totals = {(row['category'], row['key']): row for row in rows}
+
+    assert 3 == totals[('path', 'nb/a.ipynb')]['count']
+    # counted once, at the first path in the diff
+    assert 1 == totals[('path', 'copy.ipynb')]['count']
+    assert ('path', 'plot.ipynb') not in totals
+    assert 2 == totals[('output', 'image/png')]['count']
+    assert 2000 < totals[('output', 'image/png')]['bytes']
+    assert 1 == totals[('colab', 'metadata.colab')]['count']
+    assert 0 < totals[('colab', 'cell.id')]['bytes']
+    assert 0 < totals[('cell_type', 'code')]['bytes']
+
+    output = io.StringIO()
+    rebase_ipynb.write_analysis(rows, output, 'csv')
+    assert output.getvalue().startswith('category,key,count,bytes\n')
+
+    output = io.StringIO()
+    rebase_ipynb.write_analysis(rows, output, 'json')
+    assert rows == json.loads(output.getvalue())
+
+
+def test_git_cat_file_batch_to_files(local_repo_info:Repo_Info, tmp_path:pathlib.Path):
+    repo = local_repo_info["path"]
+
+    shas = [rebase_ipynb.git_rev_parse(repo, f'HEAD:{path}') for path in ('nb/a.ipynb', 'data/big.bin', 'README.md')]
+    paths = [tmp_path / str(i) for i in range(len(shas))]
+
+    # function under test
+    sizes = rebase_ipynb.git_cat_file_batch_to_files(repo, shas, paths, chunk_size=100)
+
+    for sha, path, size in zip(shas, paths, sizes):
+        assert rebase_ipynb.git_cat_file_blob(repo, sha) == path.read_bytes()
+        assert size == path.stat().st_size
+
+    assert tuple() == rebase_ipynb.git_cat_file_batch_to_files(repo, [], [])
+
+
+def test_git_cat_file_batch_iter(local_repo_info:Repo_Info):
+    repo = local_repo_info["path"]
+
+    shas = [rebase_ipynb.git_rev_parse(repo, f'HEAD:{path}') for path in ('nb/a.ipynb', 'data/big.bin', 'README.md')]
+
+    # function under test
+    result = rebase_ipynb.git_cat_file_batch_iter(repo, shas)
+
+    assert not isinstance(result, (list, tuple, dict))
+    assert [(sha, rebase_ipynb.git_cat_file_blob(repo, sha)) for sha in shas] == list(result)
+
+    assert [] == list(rebase_ipynb.git_cat_file_batch_iter(repo, []))
+
+
+def test_process_snapshot(local_repo_info:Repo_Info, tmp_path:pathlib.Path):
+    repo = local_repo_info["path"]
+    last = local_repo_info["last"]
+
+    (repo / 'nb' / 'b.ipynb').write_text(make_notebook(['y = 2'], 'b'))
+    # same blob at two paths
+    (repo / 'c.ipynb').write_text(make_notebook(['y = 2'], 'b'))
+    head = git_commit_all(repo, 'more notebooks')
+
+    cache = rebase_ipynb.BlobCache(tmp_path / 'cache')
+    verifier = rebase_ipynb.Verifier('full')
+
+    # function under test
+    new_commit = rebase_ipynb.process_snapshot(repo, 'HEAD', 'snapshot', cache=cache, max_workers=2, verifier=verifier)
+
+    # every distinct original blob checked
+    assert {
+        rebase_ipynb.git_rev_parse(repo, f'HEAD:{path}') for path in ('nb/a.ipynb', 'nb/b.ipynb', 'c.ipynb')
+    } == verifier.verified
+
+    assert head == subprocess.check_output(
+        ['git', 'rev-parse', 'snapshot^'], cwd=repo, encoding='utf-8'
+    ).strip()
+    assert new_commit == subprocess.check_output(['git', 'rev-parse', 'snapshot'], cwd=repo, encoding='utf-8').strip()
+
+    for path in ('nb/a.ipynb', 'nb/b.ipynb', 'c.ipynb'):
+        nb = json.loads(subprocess.check_output(['git', 'show', f'snapshot:{path}'], cwd=repo, encoding='utf-8'))
+        for cell in nb["cells"]:
+            assert "id" not in cell
+            assert "id" not in cell["metadata"]
+
+    # the same blob as rewriting the history
+    rebase_ipynb.process_commits(repo, local_repo_info["first"], last, 'history', engine='plumbing')
+    assert subprocess.check_output(
+        ['git', 'rev-parse', 'history:nb/a.ipynb'], cwd=repo, encoding='utf-8'
+    ) == subprocess.check_output(['git', 'rev-parse', 'snapshot:nb/a.ipynb'], cwd=repo, encoding='utf-8')
+
+    # nothing left to clean
+    assert new_commit == rebase_ipynb.process_snapshot(repo, 'snapshot', 'snapshot-again')
+
+    # two distinct blobs from the cache
+    rebase_ipynb.process_snapshot(repo, 'HEAD', 'snapshot-cached', cache=cache)
+    assert 2 == cache.hits
+    assert subprocess.check_output(
+        ['git', 'rev-parse', 'snapshot^{tree}'], cwd=repo, encoding='utf-8'
+    ) == subprocess.check_output(['git', 'rev-parse', 'snapshot-cached^{tree}'], cwd=repo, encoding='utf-8')
+
+
+def test_resource_governor__get_n_workers():
+    governor = rebase_ipynb.ResourceGovernor(memory_budget=3 * 2**20, max_workers=8, worker_memory=2**20)
+
+    assert 1 == governor.get_n_workers(1)
+    assert governor.get_n_workers(100) <= 3
+
+    # no budget for even one worker
+    assert 1 == rebase_ipynb.ResourceGovernor(memory_budget=1, worker_memory=2**20).get_n_workers(10)
+
+    # the main process takes its share first
+    assert 2 * 2**20 == governor.get_pool_budget()
+    assert 1 == rebase_ipynb.ResourceGovernor(
+        memory_budget=3 * 2**20, max_workers=8, worker_memory=2**20, parent_memory=2 * 2**20
+    ).get_n_workers(100)
+
+
+def test_git_backend__incomplete(tmp_path:pathlib.Path):
+    class ReadOnlyBackend(rebase_ipynb.GitBackend):
+        def read_blob(self, sha:str) -> bytes:
+            return b''
+
+    # at once, not partway through a rewrite
+    with pytest.raises(TypeError, match='abstract'):
+        ReadOnlyBackend(tmp_path)
+
+
+@pytest.mark.parametrize('backend', ('subprocess', 'dulwich'))
+def test_backend_read_blob_to_file(local_repo_info:Repo_Info, tmp_path:pathlib.Path, backend:str):
+    repo = local_repo_info["path"]
+
+    shas = [rebase_ipynb.git_rev_parse(repo, f'HEAD:{path}') for path in ('nb/a.ipynb', 'data/big.bin')]
+    paths = [tmp_path / 'a', tmp_path / 'b']
+
+    with rebase_ipynb.get_backends()[backend](repo) as git_backend:
+        # function under test
+        for sha, path in zip(shas, paths):
+            git_backend.read_blob_to_file(sha, path)
+
+        assert [git_backend.read_blob(sha) for sha in shas] == [path.read_bytes() for path in paths]
+        assert tuple(path.stat().st_size for path in paths) == git_backend.get_blob_sizes(shas)
+
+
+def test_resource_governor__map():
+    governor = rebase_ipynb.ResourceGovernor(
+        memory_budget=10 * 2**20, max_workers=2, memory_factor=1, worker_memory=2**20, nice=1
+    )
+
+    # the second one takes the whole budget and runs alone
+    sizes = [1000, 20 * 2**20, 1000, 1000]
+
+    # function under test
+    result = governor.map(pow, sizes, [2, 3, 4, 5], [2, 2, 2, 2])
+
+    assert [4, 9, 16, 25] == result
+
+
+def test_validate_notebook():
+    nb = json.loads(make_notebook(['x = 1', 'y = 2']))
+
+    # function under test
+    rebase_ipynb.validate_notebook(nb)
+
+    # ids removed
+    for cell in nb["cells"]:
+        del cell["id"]
+    rebase_ipynb.validate_notebook(nb)
+
+    nb["cells"][0]["cell_type"] = "unknown"
+    with pytest.raises(ValueError):
+        rebase_ipynb.validate_notebook(nb)
+
+    # not an assert : still raised under python -O
+    with pytest.raises(ValueError):
+        rebase_ipynb.validate_notebook({"nbformat": 3, "worksheets": []})
+
+
+def test_process_ipynb__validate_as_written(tmp_path:pathlib.Path, monkeypatch:pytest.MonkeyPatch):
+    ipynb_path = tmp_path / 'plot.ipynb'
+    ipynb_path.write_text(json.dumps(make_notebook_with_image('iVBORw0KGgo' * 100)))
+
+    validated = []
+    monkeypatch.setattr(rebase_ipynb, 'validate_notebook', validated.append)
+
+    # function under test
+    rebase_ipynb.process_ipynb(
+        ipynb_path, rebase_ipynb.get_clean_options(externalize_threshold=100, validate=True), tmp_path / 'outputs'
+    )
+
+    # after the externalization
+    assert [json.loads(ipynb_path.read_text(encoding="utf-8"))] == validated
+    assert '' == validated[0]["cells"][0]["outputs"][0]["data"]["image/png"]
+
+
+def test_get_cache_key__validate():
+    # the same cleaned bytes
+    for options in ({}, {'externalize_threshold': 100}):
+        assert rebase_ipynb.get_cache_key('a' * 40, rebase_ipynb.get_clean_options(**options)) == rebase_ipynb.get_cache_key(
+            'a' * 40, rebase_ipynb.get_clean_options(validate=True, **options)
+        )
+
+    assert 'a' * 40 == rebase_ipynb.get_cache_key('a' * 40, rebase_ipynb.get_clean_options(validate=True))
+
+
+def test_process_commits__validate(local_repo_info:Repo_Info):
+    repo = local_repo_info["path"]
+
+    # function under test
+    sha_map = rebase_ipynb.process_commits(
+        repo, local_repo_info["first"], local_repo_info["last"], 'validated', engine='plumbing',
+        clean_options=rebase_ipynb.get_clean_options(validate=True),
+    )
+
+    assert 3 == len(sha_map)
+
+
+def test_process_commits__job_namespace(local_repo_info:Repo_Info):
+    repo = local_repo_info["path"]
+    first = local_repo_info["first"]
+    last = local_repo_info["last"]
+
+    user_config = subprocess.check_output(['git', 'config', '--local', '--list'], cwd=repo, encoding='utf-8')
+
+    # function under test
+    sha_map_worktree = rebase_ipynb.process_commits(repo, first, last, 'cleaned', engine='worktree')
+    sha_map_job = rebase_ipynb.process_commits(repo, first, last, 'cleaned', engine='plumbing', job='job1')
+
+    assert sha_map_job == sha_map_worktree
+    assert sha_map_job[last] == subprocess.check_output(
+        ['git', 'rev-parse', 'refs/rebase_ipynb/job1/heads/cleaned'], cwd=repo, encoding='utf-8'
+    ).strip()
+
+    # no config written; locks released
+    assert user_config == subprocess.check_output(['git', 'config', '--local', '--list'], cwd=repo, encoding='utf-8')
+    assert [] == list((repo / '.git' / 'rebase_ipynb' / 'locks').iterdir())
+
+
+def test_job_lock(tmp_path:pathlib.Path):
+    lock_path = tmp_path / 'locks' / 'refs%2Fheads%2Fcleaned.lock'
+
+    with rebase_ipynb.job_lock(lock_path, 'job1'):
+        assert 'job job1' in lock_path.read_text()
+
+        with pytest.raises(FileExistsError, match='job job1'):
+            with rebase_ipynb.job_lock(lock_path, 'job2'):
+                pass
+
+    assert not lock_path.exists()
+
+
+def test_startup__lazy_imports(record_property):
+    """
+    Cold start benchmark : importing the module loads none of the heavy packages
+    and takes a small multiple of importing the standard library modules it needs
+    """
+    heavy = ('nbformat', 'nbconvert', 'jsonschema', 'fastjsonschema', 'dulwich', 'concurrent.futures')
+    stdlib = (
+        'abc, argparse, calendar, collections, contextlib, csv, difflib, functools, hashlib, json, '
+        'os, pathlib, pprint, shlex, shutil, sys, tempfile, time, subprocess, typing, urllib.parse'
+    )
+
+    def cold_import(statement:str) -> Dict:
+        output = subprocess.check_output(
+            [
+                sys.executable, '-c',
+                'import json, sys, time\n'
+                't = time.perf_counter()\n'
+                f'{statement}\n'
+                f'print(json.dumps({{"seconds": time.perf_counter() - t, "heavy": [m for m in {heavy!r} if m in sys.modules]}}))'
+            ],
+            cwd=proj_folder, encoding='utf-8'
+        )
+        return json.loads(output)
+
+    # the first run may compile the module
+    cold_import('import rebase_ipynb')
+
+    # best of a few runs : the least disturbed by the other processes of the host
+    baseline = min(cold_import(f'import {stdlib}')['seconds'] for _ in range(3))
+    results = [cold_import('import rebase_ipynb') for _ in range(3)]
+    seconds = min(result['seconds'] for result in results)
+
+    record_property('import_seconds', seconds)
+    record_property('stdlib_import_seconds', baseline)
+
+    assert [] == results[0]['heavy']
+    # about 0.04 second against 0.02 second of the standard library modules
+    assert 3 * baseline > seconds, (seconds, baseline)
+
+
+def test_verifier__full_in_process(id_sample_path):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dest = pathlib.Path(tmp_dir) / id_sample_path.name
+        rebase_ipynb.remove_id_from_file(id_sample_path, dest)
+
+        # function under test
+        assert rebase_ipynb.Verifier('full').verify(id_sample_path, dest, '0' * 40)
+
+        nb = json.loads(dest.read_text(encoding="utf-8"))
+        nb["cells"][-1]["source"] = ["changed"]
+        dest.write_text(json.dumps(nb), encoding="utf-8")
+
+        assert not rebase_ipynb.Verifier('full').verify(id_sample_path, dest, '1' * 40)
+
+
+def test_resource_governor__imap_unordered_largest_first(monkeypatch:pytest.MonkeyPatch):
+    # the pool, whatever the load of the host
+    monkeypatch.setattr(rebase_ipynb, 'get_idle_cores', lambda: 2)
+
+    # one at a time within the budget : completes in the submission order
+    governor = rebase_ipynb.ResourceGovernor(
+        memory_budget=101, max_workers=2, memory_factor=1, worker_memory=1, parent_memory=1
+    )
+    assert 2 == governor.get_n_workers(3)
+
+    # function under test
+    order = [i for i, _ in governor.imap_unordered(abs, [60, 100, 70], [-1, -2, -3])]
+
+    assert [1, 2, 0] == order
+
+    assert {'pending': 0, 'running': 0} == governor.depths
+
+
+def test_blob_scheduler__temporary_files(local_repo_info:Repo_Info, monkeypatch:pytest.MonkeyPatch):
+    repo = local_repo_info["path"]
+    commits = local_repo_info["commits_original"]
+
+    tmp_dirs = []
+
+    class RecordingTemporaryDirectory(tempfile.TemporaryDirectory):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            tmp_dirs.append(pathlib.Path(self.name))
+
+    with rebase_ipynb.SubprocessBackend(repo) as backend:
+        changes = [backend.get_changes(commit) for commit in commits]
+        blob_shas = [entries[0]['new_sha'] for entries in changes]
+
+        monkeypatch.setattr(tempfile, 'TemporaryDirectory', RecordingTemporaryDirectory)
+
+        scheduler = rebase_ipynb.BlobScheduler(backend, rebase_ipynb.ResourceGovernor(max_workers=1))
+
+        # function under test
+        results = scheduler.run(changes)
+
+        next(results)
+        # the blob of the first commit, still there until the next commit is asked for
+        assert [blob_shas[0]] == [p.name for p in tmp_dirs[0].iterdir()]
+
+        next(results)
+        # read once needed; gone once written
+        assert [blob_shas[1]] == [p.name for p in tmp_dirs[0].iterdir()]
+
+        next(results)
+        assert [blob_shas[2]] == [p.name for p in tmp_dirs[0].iterdir()]
+
+        with pytest.raises(StopIteration):
+            next(results)
+
+
+def test_process_commits__jobs_worktree(local_repo_info:Repo_Info):
+    # not silently serial
+    with pytest.raises(AssertionError, match='plumbing'):
+        rebase_ipynb.process_commits(
+            local_repo_info["path"], local_repo_info["first"], local_repo_info["last"], 'cleaned',
+            engine='worktree', jobs=2,
+        )
+
+
+def test_process_commits__jobs_externalize_cache(local_repo_info:Repo_Info, tmp_path:pathlib.Path):
+    repo = local_repo_info["path"]
+    first = local_repo_info["first"]
+
+    for i in range(3):
+        (repo / f'plot{i}.ipynb').write_text(json.dumps(make_notebook_with_image('iVBORw0KGgo' * (100 + i))))
+    # the same image in a later commit
+    (repo / 'nb' / 'plot.ipynb').write_text(json.dumps(make_notebook_with_image('iVBORw0KGgo' * 100)))
+    last = git_commit_all(repo, 'plots')
+
+    clean_options = rebase_ipynb.get_clean_options(externalize_threshold=100)
+
+    sha_map_serial = rebase_ipynb.process_commits(
+        repo, first, last, 'serial', engine='plumbing', clean_options=clean_options
+    )
+
+    events = io.StringIO()
+    cache = rebase_ipynb.BlobCache(tmp_path / 'cache')
+
+    # function under test
+    sha_map_jobs = rebase_ipynb.process_commits(
+        repo, first, last, 'jobs', engine='plumbing', clean_options=clean_options, jobs=2, cache=cache,
+        reporter=rebase_ipynb.ProgressReporter(events=events),
+    )
+
+    assert sha_map_jobs == sha_map_serial
+
+    queues = [record for record in map(json.loads, events.getvalue().splitlines()) if 'queues' == record['event']]
+    assert queues
+    assert {'pending', 'running', 'buffered'} <= set(queues[-1])
+
+    # all from the cache, in lower priority workers
+    assert sha_map_serial == rebase_ipynb.process_commits(
+        repo, first, last, 'cached', engine='plumbing', clean_options=clean_options, jobs=2, cache=cache,
+        nice=1, ionice=True,
+    )
+    assert 0 < cache.hits
+
+
+def test_get_coalesced_groups():
+    def info(sha:str, author:str, seconds:int) -> Dict[str, str]:
+        return {
+            'sha': sha, 'author': author, 'author_email': f'{author}@example.com',
+            'date': rebase_ipynb.format_git_date(1700000000 + seconds, 3600 * 9),
+        }
+
+    # function under test
+    result = rebase_ipynb.get_coalesced_groups(
+        [info('a', 'x', 0), info('b', 'x', 30), info('c', 'x', 70), info('d', 'y', 80), info('e', 'x', 90)], 60
+    )
+
+    assert (('a', 'b'), ('c',), ('d',), ('e',)) == result
+
+    assert (None, None, None) == rebase_ipynb.get_group_bases(result[1:], 'start')
+    assert ('start', None) == rebase_ipynb.get_group_bases(result[:2], 'start')
+
+
+def commit_at(repo:pathlib.Path, message:str, date:str, author:str='Test User') -> str:
+    env = dict(os.environ, GIT_AUTHOR_DATE=date, GIT_COMMITTER_DATE=date)
+    subprocess.check_call(['git', 'add', '-A'], cwd=repo)
+    subprocess.check_call(['git', '-c', f'user.name={author}', 'commit', '-q', '-m', message], cwd=repo, env=env)
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=repo, encoding='utf-8').strip()
+
+
+@pytest.mark.parametrize(
+    "config", (
+        {'engine': 'worktree'},
+        {'engine': 'plumbing'},
+        {'engine': 'plumbing', 'backend': 'dulwich'},
+        {'engine': 'plumbing', 'jobs': 2},
+    )
+)
+def test_process_commits__coalesce_window(local_repo_info:Repo_Info, config:Dict):
+    repo = local_repo_info["path"]
+    first = local_repo_info["first"]
+
+    autosaves = []
+    for i, sources in enumerate((('a = 1',), ('a = 1', 'b = 2'), ('a = 1', 'b = 2', 'c = 3'))):
+        (repo / 'autosave.ipynb').write_text(make_notebook(sources))
+        if 1 == i:
+            (repo / 'scratch.ipynb').write_text(make_notebook(('scratch',)))
+        elif 2 == i:
+            (repo / 'scratch.ipynb').unlink()
+        autosaves.append(commit_at(repo, f'autosave {i}', f'2030-01-01T00:00:{10 * i:02d}+0000'))
+
+    (repo / 'autosave.ipynb').write_text(make_notebook(('a = 1', 'b = 2', 'c = 3', '# reviewed')))
+    other = commit_at(repo, 'review', '2030-01-01T00:00:30+0000', author='Other User')
+
+    serial = rebase_ipynb.process_commits(repo, first, other, 'serial', **config)
+
+    verifier = rebase_ipynb.Verifier('deferred')
+
+    # function under test
+    sha_map = rebase_ipynb.process_commits(
+        repo, first, other, 'coalesced', coalesce_window=60, verifier=verifier, **config
+    )
+
+    assert list(sha_map) == list(serial)
+    assert 1 == len(set(sha_map[commit] for commit in autosaves))
+    assert sha_map[other] != sha_map[autosaves[-1]]
+    assert len(set(sha_map.values())) < len(set(serial.values()))
+
+    assert not verifier.mismatches
+
+    # the same final tree, and the commit info of the last autosave
+    assert rebase_ipynb.git_rev_parse(repo, 'serial^{tree}') == rebase_ipynb.git_rev_parse(repo, 'coalesced^{tree}')
+    assert (
+        rebase_ipynb.git_rev_parse(repo, serial[autosaves[-1]] + '^{tree}')
+        == rebase_ipynb.git_rev_parse(repo, sha_map[autosaves[-1]] + '^{tree}')
+    )
+    assert 'autosave 2' == rebase_ipynb.git_show_info(repo, sha_map[autosaves[0]])['message']
+
+
+def test_rewrite_refs(local_repo_info:Repo_Info):
+    repo = local_repo_info["path"]
+    first, ids_only, last = local_repo_info["commits_original"]
+
+    subprocess.check_call(['git', 'tag', 'light', ids_only], cwd=repo)
+    subprocess.check_call(['git', 'tag', '-a', 'v1', '-m', 'release v1', last], cwd=repo)
+    subprocess.check_call(['git', 'branch', 'release', first], cwd=repo)
+    subprocess.check_call(['git', 'tag', 'untouched', local_repo_info["root"]], cwd=repo)
+
+    sha_map = rebase_ipynb.process_commits(repo, first, last, 'cleaned', drop_empty=True, engine='plumbing')
+
+    # function under test
+    updates = rebase_ipynb.rewrite_refs(repo, sha_map, ['refs/tags/', 'refs/heads/release'])
+
+    assert set(updates) == {'refs/tags/light', 'refs/tags/v1', 'refs/heads/release'}
+
+    def rev_parse(rev:str) -> str:
+        return subprocess.check_output(['git', 'rev-parse', rev], cwd=repo, encoding='utf-8').strip()
+
+    assert rev_parse('light') == sha_map[ids_only]
+    assert rev_parse('release') == sha_map[first]
+    assert rev_parse('v1^{commit}') == sha_map[last]
+    assert rev_parse('untouched') == local_repo_info["root"]
+
+    assert 'tag' == subprocess.check_output(['git', 'cat-file', '-t', 'v1'], cwd=repo, encoding='utf-8').strip()
+    assert 'release v1' in subprocess.check_output(['git', 'cat-file', 'tag', 'v1'], cwd=repo, encoding='utf-8')
+
+
+def test_get_rewritten_tag__signed():
+    content = (
+        b"object " + b"1" * 40 + b"\n"
+        b"type commit\n"
+        b"tag v1\n"
+        b"tagger A U Thor <author@example.com> 1700000000 +0000\n"
+        b"\n"
+        b"release v1\n"
+        b"-----BEGIN PGP SIGNATURE-----\n"
+        b"abc\n"
+        b"-----END PGP SIGNATURE-----\n"
+    )
+
+    result = rebase_ipynb.get_rewritten_tag(content, "2" * 40)
+
+    assert result == (
+        b"object " + b"2" * 40 + b"\n"
+        b"type commit\n"
+        b"tag v1\n"
+        b"tagger A U Thor <author@example.com> 1700000000 +0000\n"
+        b"\n"
+        b"release v1\n"
+    )
+
+
+def test_get_cat_file_batch_objects():
+    output = b"a" * 40 + b" blob 3\nabc\n" + b"b" * 40 + b" blob 0\n\n"
+
+    assert rebase_ipynb.get_cat_file_batch_objects(output) == [("a" * 40, b"abc"), ("b" * 40, b"")]
+
+    assert rebase_ipynb.get_cat_file_batch_objects(b"HEAD:no_such_file missing\n") == [("HEAD:no_such_file", None)]
+
+
+def test_process_fleet(local_repo_info:Repo_Info):
+    repo = local_repo_info["path"]
+    clone = repo.parent / 'clone'
+    subprocess.check_call(['git', 'clone', '-q', str(repo), str(clone)])
+
+    manifest_path = repo.parent / 'manifest.jsonl'
+    manifest_path.write_text(
+        '\n'.join(
+            json.dumps({
+                'repo': path.name,
+                'first': local_repo_info["first"],
+                'last': local_repo_info["last"],
+                'branch': 'cleaned',
+            })
+            for path in (repo, clone)
+        )
+    )
+
+    jobs = rebase_ipynb.read_fleet_manifest(manifest_path)
+    assert jobs[1]['repo'] == str(clone.resolve())
+
+    # function under test
+    summary = rebase_ipynb.process_fleet(jobs, repo.parent / 'cache', max_workers=1)
+
+    assert ['ok', 'ok'] == [s['status'] for s in summary]
+    assert summary[0]['head'] == summary[1]['head']
+
+    # same notebooks in the clone
+    assert 0 == summary[1]['cache_misses']
+    assert summary[0]['cache_misses'] == summary[1]['cache_hits']
+
+
+def test_process_fleet_job__error(local_repo_info:Repo_Info):
+    job = {
+        'repo': str(local_repo_info["path"]),
+        'first': local_repo_info["first"],
+        'last': 'no_such_commit',
+        'branch': 'cleaned',
+    }
+
+    summary = rebase_ipynb.process_fleet_job(job, local_repo_info["path"].parent / 'cache')
+
+    assert 'error' == summary['status']
+
+
+def test_process_commits__progress_events(local_repo_info:Repo_Info):
+    repo = local_repo_info["path"]
+    prometheus_path = repo.parent / 'rebase_ipynb.prom'
+
+    events = io.StringIO()
+    reporter = rebase_ipynb.ProgressReporter(events=events, prometheus_path=prometheus_path)
+
+    # function under test
+    rebase_ipynb.process_commits(
+        repo, local_repo_info["first"], local_repo_info["last"], 'cleaned',
+        engine='plumbing', reporter=reporter,
+    )
+
+    records = [json.loads(line) for line in events.getvalue().splitlines()]
+
+    assert ['start', 'commit', 'commit', 'commit', 'finish'] == [r['event'] for r in records]
+    assert [0, 1, 2, 3, 3] == [r['commits_done'] for r in records]
+    assert 0 == records[-1]['commits_remaining']
+    assert 3 == records[-1]['notebooks']
+    assert records[-1]['bytes_out'] < records[-1]['bytes_in']
+    assert 'process' in records[-1]['stage_seconds']
+    assert all(r['branch'] == 'cleaned' for r in records)
+
+    prometheus_txt = prometheus_path.read_text()
+    assert 'rebase_ipynb_commits_done{branch="cleaned"} 3' in prometheus_txt
+    assert 'rebase_ipynb_stage_seconds_total{branch="cleaned",stage="process"}' in prometheus_txt
+
+
+def make_notebook_with_image(png:str) -> Dict:
+    return {
+        "cells": [
+            {
+                "cell_type": "code",
+                "execution_count": 1,
+                "metadata": {},
+                "outputs": [
+                    {
+                        "data": {"image/png": png, "text/plain": ["<Figure>"]},
+                        "metadata": {},
+                        "output_type": "display_data",
+                    },
+                    {
+                        "data": {"image/png": png.splitlines(keepends=True)},
+                        "metadata": {"needs_background": "light"},
+                        "output_type": "display_data",
+                    },
+                ],
+                "source": ["plot()"],
+            }
+        ],
+        "metadata": {},
+        "nbformat": 4,
+        "nbformat_minor": 5,
+    }
+
+
+def test_externalize_outputs__restore():
+    png = ('iVBORw0KGgo' * 20 + '\n') * 10
+
+    original = make_notebook_with_image(png)
+    ipynb_json = json.loads(json.dumps(original))
+
+    # function under test 1
+    outputs = rebase_ipynb.externalize_outputs(ipynb_json, threshold=100)
+
+    # same image twice : one file
+    assert 1 == len(outputs)
+    assert png == tuple(outputs.values())[0]
+
+    for output in ipynb_json["cells"][0]["outputs"]:
+        assert '' == output["data"]["image/png"]
+    assert ["<Figure>"] == ipynb_json["cells"][0]["outputs"][0]["data"]["text/plain"]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        outputs_folder = pathlib.Path(tmpdir)
+        for name, text in outputs.items():
+            (outputs_folder / name).write_text(text)
+
+        # function under test 2
+        assert rebase_ipynb.restore_outputs(ipynb_json, outputs_folder)
+
+    assert original == ipynb_json
+
+
+def test_externalize_outputs__threshold():
+    ipynb_json = make_notebook_with_image('iVBORw0KGgo')
+
+    assert {} == rebase_ipynb.externalize_outputs(ipynb_json, threshold=100)
+    assert 'iVBORw0KGgo' == ipynb_json["cells"][0]["outputs"][0]["data"]["image/png"]
+
+
+@pytest.mark.parametrize('engine', ('worktree', 'plumbing'))
+def test_process_commits__externalize(local_repo_info:Repo_Info, engine:str):
+    repo = local_repo_info["path"]
+    png = 'iVBORw0KGgo' * 100
+
+    (repo / 'nb' / 'plot.ipynb').write_text(json.dumps(make_notebook_with_image(png), indent=1))
+    last = git_commit_all(repo, 'plot')
+
+    clean_options = rebase_ipynb.get_clean_options(externalize_threshold=1000)
+
+    # function under test
+    rebase_ipynb.process_commits(
+        repo, local_repo_info["first"], last, 'cleaned', engine=engine, clean_options=clean_options,
+        cache=rebase_ipynb.BlobCache(repo.parent / 'cache'),
+    )
+
+    files = subprocess.check_output(
+        ['git', 'ls-tree', '-r', '--name-only', 'cleaned'], cwd=repo, encoding='utf-8'
+    ).splitlines()
+
+    output_name = rebase_ipynb.hashlib.sha256(png.encode()).hexdigest()
+    assert f'.ipynb_outputs/{output_name}' in files
+
+    nb_txt = subprocess.check_output(['git', 'show', 'cleaned:nb/plot.ipynb'], cwd=repo, encoding='utf-8')
+    assert png not in nb_txt
+    assert output_name in nb_txt
+
+
+def test_process_commits__externalize_cache_hit(local_repo_info:Repo_Info):
+    repo = local_repo_info["path"]
+
+    (repo / 'nb' / 'plot.ipynb').write_text(json.dumps(make_notebook_with_image('iVBORw0KGgo' * 100), indent=1))
+    last = git_commit_all(repo, 'plot')
+
+    clean_options = rebase_ipynb.get_clean_options(externalize_threshold=1000)
+
+    sha_maps = []
+
+    for branch in ('cleaned', 'cached'):
+        cache = rebase_ipynb.BlobCache(repo.parent / 'cache')
+        sha_maps.append(
+            rebase_ipynb.process_commits(
+                repo, local_repo_info["first"], last, branch, engine='plumbing',
+                clean_options=clean_options, cache=cache,
+            )
+        )
+
+    # second run from the cache only
+    assert 0 == cache.misses
+    assert sha_maps[0] == sha_maps[1]
+
+
+def test_repack_rewritten(local_repo_info:Repo_Info):
+    repo = local_repo_info["path"]
+    first = local_repo_info["first"]
+    last = local_repo_info["last"]
+
+    rebase_ipynb.process_commits(repo, first, last, 'cleaned', engine='plumbing')
+
+    # function under test
+    report = rebase_ipynb.repack_rewritten(repo, local_repo_info["root"], last, 'cleaned')
+
+    assert 0 < report['original']['objects']
+    assert report['rewritten']['objects'] == report['rewritten_before_repack']['objects']
+    assert report['rewritten']['disk_size'] <= report['rewritten_before_repack']['disk_size']
+    assert report['loose_after_repack']['count'] < report['loose_before_repack']['count']
+
+    git_dir = repo / '.git'
+    assert (git_dir / 'objects' / 'info' / 'commit-graph').exists()
+    assert (git_dir / 'objects' / 'pack' / 'multi-pack-index').exists()
+    assert (git_dir / 'objects' / 'pack' / f"pack-{report['pack']}.pack").exists()
+
+
+@pytest.mark.parametrize('engine', ('worktree', 'plumbing'))
+def test_process_commits__verify_deferred(local_repo_info:Repo_Info, engine:str):
+    repo = local_repo_info["path"]
+    first, ids_only, last = local_repo_info["commits_original"]
+
+    verifier = rebase_ipynb.Verifier('deferred')
+
+    # function under test
+    sha_map = rebase_ipynb.process_commits(repo, first, last, 'cleaned', engine=engine, verifier=verifier)
+
+    assert [] == verifier.mismatches
+    assert 3 == len(verifier.fingerprints)
+
+    # every mismatch at once
+    wrong_map = {first: sha_map[last], ids_only: sha_map[last], last: sha_map[last]}
+    mismatches = rebase_ipynb.audit_rewrite(repo, wrong_map, verifier.fingerprints)
+
+    assert sorted([first, ids_only]) == sorted(m['commit'] for m in mismatches)
+    assert all('nb/a.ipynb' == m['path'] for m in mismatches)
+
+    # the same map is right only if the commits were coalesced
+    assert [] == rebase_ipynb.audit_rewrite(
+        repo, wrong_map, verifier.fingerprints, groups=((first, ids_only, last),), start_parent=local_repo_info["root"]
+    )
+
+
+def test_verifier__none_sample():
+    src_ipynb_path = test_folder / 'ne_colab.ipynb'
+    dest_ipynb_path = test_folder / 'eq_local_with_button.ipynb'
+
+    assert rebase_ipynb.Verifier('none').verify(src_ipynb_path, dest_ipynb_path, 'f' * 40)
+
+    sample = rebase_ipynb.Verifier('sample', sample_rate=2)
+
+    # 0xffffffff is odd : not in the sample
+    assert sample.verify(src_ipynb_path, dest_ipynb_path, 'f' * 40)
+    assert not sample.verify(src_ipynb_path, dest_ipynb_path, '0' * 40)
+
+
+def test_get_notebook_text():
+    ipynb_json = json.loads(make_notebook(('a = 1\n', 'b = 2\n'), 'x'))
+
+    text = rebase_ipynb.get_notebook_text(ipynb_json)
+
+    assert 'a = 1\n' in text
+    assert 'b = 2\n' in text
+    assert 'x0' not in text
+
+
+def test_blob_cache():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = rebase_ipynb.BlobCache(pathlib.Path(tmpdir) / 'cache')
+
+        assert cache.get('ab' * 20) is None
+
+        cache.put('ab' * 20, b'{}')
+
+        assert rebase_ipynb.BlobCache(pathlib.Path(tmpdir) / 'cache').get('ab' * 20) == b'{}'
+        assert 1 == cache.misses
+
+
+def test_get_index_info_lines():
+    entries = (
+        {'status': 'D', 'new_mode': '000000', 'new_sha': '0' * 40, 'path': 'old.ipynb'},
+        {'status': 'A', 'new_mode': '100644', 'new_sha': '1' * 40, 'path': 'new.ipynb'},
+        {'status': 'M', 'new_mode': '100755', 'new_sha': '2' * 40, 'path': 'run.sh'},
+    )
+
+    result = rebase_ipynb.get_index_info_lines(entries, {'new.ipynb': '3' * 40})
+
+    assert result == [
+        f"0 {'0' * 40}\told.ipynb\0",
+        f"100644 {'3' * 40}\tnew.ipynb\0",
+        f"100755 {'2' * 40}\trun.sh\0",
+    ]
+
+
+def test_process_commits__sparse(local_repo_info:Repo_Info):
+    repo = local_repo_info["path"]
+    first = local_repo_info["first"]
+    last = local_repo_info["last"]
+
+    sha_map_full = rebase_ipynb.process_commits(repo, first, last, 'full')
+
+    subprocess.check_call(['git', 'switch', '-q', 'main'], cwd=repo)
+
+    # function under test
+    sha_map_sparse = rebase_ipynb.process_commits(repo, first, last, 'sparse', sparse=True)
+
+    assert sha_map_sparse == sha_map_full
+
+    # sparse checkout is over
+    assert not rebase_ipynb.is_sparse_checkout(repo)
+    assert (repo / 'README.md').exists()
+
+
+def test_sparse_checkout(local_repo_info:Repo_Info):
+    repo = local_repo_info["path"]
+
+    with rebase_ipynb.sparse_checkout(repo, ('nb',), job='first'):
+        assert (repo / 'nb' / 'a.ipynb').exists()
+        assert not (repo / 'data' / 'big.bin').exists()
+
+        # core.sparseCheckout is shared : a second job fails at once
+        with pytest.raises(FileExistsError, match='first'):
+            with rebase_ipynb.sparse_checkout(repo, ('data',), job='second'):
+                pass
+
+    assert (repo / 'data' / 'big.bin').exists()
+
+
+def test_get_sparse_folders():
+    fnames = ('README.md', 'a/b/c.ipynb', 'a/d.ipynb', 'a/b/e.py')
+
+    assert rebase_ipynb.get_sparse_folders(fnames) == ('a', 'a/b')
+
+
+def test_get_diff_tree_raw_entries():
+    output = (
+        ":100644 100644 1111111111111111111111111111111111111111 2222222222222222222222222222222222222222 M\0a b.ipynb\0"
+        ":100644 000000 3333333333333333333333333333333333333333 0000000000000000000000000000000000000000 D\0c.txt\0"
+    )
+
+    result = rebase_ipynb.get_diff_tree_raw_entries(output)
+
+    assert 2 == len(result)
+
+    assert result[0]['path'] == 'a b.ipynb'
+    assert result[0]['status'] == 'M'
+    assert result[0]['new_sha'] == '2' * 40
+
+    assert result[1]['path'] == 'c.txt'
+    assert result[1]['status'] == 'D'
+    assert result[1]['new_mode'] == '000000'
+
+
+def test_get_clean_message():
+    assert rebase_ipynb.get_clean_message("\ntitle  \n\n\n\nbody\n\n") == "title\n\nbody\n"
+
+
 def test_remove_id_from_cell__markdown_cell():
     """Test the removal of the id from the markdown cell."""
     cell = {
@@ -641,6 +2015,81 @@ def id_sample_path():
     return input_path
 
 
+def test_compile_transforms__configured():
+    ipynb_json = {
+        "cells": [
+            {
+                "cell_type": "code",
+                "execution_count": 3,
+                "id": "abc",
+                "metadata": {"id": "abc"},
+                "outputs": [
+                    {"output_type": "execute_result", "execution_count": 3, "data": {"text/plain": "x" * 4096}, "metadata": {}},
+                    {"output_type": "stream", "name": "stdout", "text": "small"},
+                ],
+                "source": "x",
+            },
+            {
+                "cell_type": "markdown",
+                "metadata": {},
+                "source": "# title",
+            },
+        ],
+        "metadata": {"widgets": {"state": {}}, "kernelspec": {}},
+        "nbformat": 4,
+        "nbformat_minor": 5,
+    }
+
+    # function under test
+    visitor = rebase_ipynb.compile_transforms(
+        ['strip_execution_count', {'name': 'clear_large_outputs', 'max_kb': 1}, 'drop_widgets_metadata']
+    )
+    visitor(ipynb_json)
+
+    code_cell = ipynb_json["cells"][0]
+
+    assert code_cell["execution_count"] is None
+    assert [{"output_type": "stream", "name": "stdout", "text": "small"}] == code_cell["outputs"]
+    assert {"kernelspec": {}} == ipynb_json["metadata"]
+
+    # not configured
+    assert "abc" == code_cell["id"]
+
+
+def test_add_key_rule__merged_tree():
+    tree = {}
+
+    # function under test
+    for name in ('remove_metadata_id', 'remove_output_id', 'strip_execution_count', 'clear_large_outputs'):
+        for path in rebase_ipynb.get_transforms()[name]['keys']:
+            rebase_ipynb.add_key_rule(tree, path, (name, {}))
+
+    # each key once, the rules at the level of the keys they touch
+    assert ['metadata', 'execution_count', 'outputs'] == list(tree)
+    assert [] == tree['metadata']['rules']
+    assert ['id', 'colab', 'outputId'] == list(tree['metadata']['children'])
+    assert [('clear_large_outputs', {})] == tree['outputs']['rules']
+    assert [('strip_execution_count', {})] == tree['outputs']['items']['execution_count']['rules']
+
+
+def test_compile_transforms__unknown():
+    with pytest.raises(AssertionError):
+        rebase_ipynb.compile_transforms(['no_such_transform'])
+
+
+def test_remove_id_from_file__default_transforms_same(id_sample_path):
+    with tempfile.TemporaryDirectory() as folder:
+        default_path = pathlib.Path(folder) / "default.ipynb"
+        configured_path = pathlib.Path(folder) / "configured.ipynb"
+
+        rebase_ipynb.remove_id_from_file(id_sample_path, default_path)
+        rebase_ipynb.remove_id_from_file(
+            id_sample_path, configured_path, transforms=rebase_ipynb.get_default_transforms()
+        )
+
+        assert default_path.read_bytes() == configured_path.read_bytes()
+
+
 def test_remove_id_from_file__id_sample(id_sample_path):
     input_path = id_sample_path
 